@@ -64,3 +64,13 @@
     --custom_attributes "package,cryptographic_relevance,justification" \
     --api_key "$MISTRAL_API_KEY" \
     --query_restriction 1
+
+# collaborative run: all models answer every package, the majority decides
+# (api keys of further providers are read from OPENAI_API_KEY, GEMINI_API_KEY, MISTRAL_API_KEY)
+./do_query_llm_no_gpu Fedora openai.gpt-5 \
+    --vote_with gemini.gemini-2.5-flash mistral.codestral-2508 \
+    --vote majority \
+    --base_package_list "./csv/dnf-packages-with-desc-depend-prompt1v2.csv" \
+    --template_alternative prompt1v2 \
+    --custom_attributes "package,cryptographic_relevance,justification" \
+    --query_restriction 1
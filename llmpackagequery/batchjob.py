@@ -0,0 +1,339 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import tempfile
+
+from abc import ABC, abstractmethod
+from time import sleep
+from typing import TYPE_CHECKING, Dict, Iterator, List, Tuple
+
+from query import SYSTEM_PROMPT, register
+from ratelimit import classify_error
+from request import RequestManger
+
+if TYPE_CHECKING:
+    # the clients are created with their query handler
+    from google import genai
+    from mistralai import Mistral
+    from openai import OpenAI
+
+log = logging.getLogger(__name__)
+
+# answer text and token usage (prompt, completion) of a batch item
+BatchAnswer = Tuple[str, Tuple[int, int] | None]
+
+class BatchJob(ABC):
+    """
+    Asynchronous batch job of a provider. The prompts are written to a
+    JSON lines file in the format of the provider, which is uploaded and
+    submitted as one job. The job is polled until it finished and the
+    answers are downloaded. Failed items are missing in the answers.
+    """
+    model_name: str
+    poll_interval: float
+
+    # terminal states of the jobs of the provider
+    FINISHED_STATES: Tuple[str, ...] = ()
+    # longest wait between polls while polling fails
+    MAX_POLL_INTERVAL: float = 900.0
+
+    def __init__(self, model_name: str, poll_interval: float = 60.0) -> None:
+        self.model_name = model_name
+        self.poll_interval = poll_interval
+
+    def __call__(self, questions: Dict[str, str]) -> Dict[str, BatchAnswer]:
+        """Submit the questions by custom id and wait for the answers."""
+        with tempfile.NamedTemporaryFile(mode='w', suffix=".jsonl", delete=False) as file:
+            for custom_id, question in questions.items():
+                file.write(json.dumps(self._request_line(custom_id, question)) + "\n")
+        try:
+            job_id = self._submit(file.name)
+        finally:
+            os.remove(file.name)
+        log.info(f"Submitted batch job {job_id} with {len(questions)} requests to {self.model_name}.")
+
+        state = None
+        failures = 0
+        while state not in self.FINISHED_STATES:
+            if state is not None or failures:
+                # back off exponentially while polling fails
+                sleep(min(self.poll_interval * 2 ** min(failures, 16),
+                          max(self.poll_interval, self.MAX_POLL_INTERVAL)))
+            try:
+                current_state = self._state(job_id)
+            except Exception as e:
+                # keep polling on connection problems
+                if classify_error(e) is None:
+                    raise
+                failures += 1
+                log.warning(f"Polling batch job {job_id} failed ({failures} times): {e}")
+                continue
+            failures = 0
+            if current_state != state:
+                log.info(f"Batch job {job_id}: {current_state}")
+            state = current_state
+
+        answers = {custom_id: answer for custom_id, answer in self._answers(job_id)
+                   if custom_id in questions}
+        log.info(f"Batch job {job_id} {state}, {len(answers)} of {len(questions)} requests answered.")
+        return answers
+
+    @abstractmethod
+    def _request_line(self, custom_id: str, question: str) -> Dict:
+        """One request of the JSON lines file."""
+        ...
+
+    @abstractmethod
+    def _submit(self, path: str) -> str:
+        """Upload the file, submit the job and return its id."""
+        ...
+
+    @abstractmethod
+    def _state(self, job_id: str) -> str:
+        """Current state of the job."""
+        ...
+
+    @abstractmethod
+    def _answers(self, job_id: str) -> Iterator[Tuple[str, BatchAnswer]]:
+        """Answers of the successful items by custom id."""
+        ...
+
+def _chat_completion_answers(lines: str) -> Iterator[Tuple[str, BatchAnswer]]:
+    # output lines of OpenAI and Mistral wrap a chat completion
+    for line in lines.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        if record.get("error") or response.get("status_code", 200) != 200 or not body.get("choices"):
+            log.warning(f"Batch item {record.get('custom_id')} failed: {record.get('error') or body}")
+            continue
+        usage = body.get("usage")
+        yield record["custom_id"], (
+            body["choices"][0]["message"]["content"],
+            (usage.get("prompt_tokens"), usage.get("completion_tokens")) if usage else None)
+
+@register
+class OpenAIBatchJob(BatchJob):
+    client: OpenAI
+
+    FINISHED_STATES = ("completed", "failed", "expired", "cancelled")
+    ENDPOINT = "/v1/chat/completions"
+
+    def __init__(self, client: OpenAI, model_name: str, poll_interval: float = 60.0) -> None:
+        super().__init__(model_name, poll_interval)
+        self.client = client
+
+    def _request_line(self, custom_id: str, question: str) -> Dict:
+        # same request as OpenAIQueryHandler
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": self.ENDPOINT,
+            "body": {
+                "model": self.model_name,
+                "messages": [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": question}
+                ]
+            }
+        }
+
+    def _submit(self, path: str) -> str:
+        with open(path, mode='rb') as file:
+            input_file = self.client.files.create(file=file, purpose="batch")
+        return self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=self.ENDPOINT,
+            completion_window="24h").id
+
+    def _state(self, job_id: str) -> str:
+        return self.client.batches.retrieve(job_id).status
+
+    def _answers(self, job_id: str) -> Iterator[Tuple[str, BatchAnswer]]:
+        job = self.client.batches.retrieve(job_id)
+        # expired jobs keep the answers of the finished items
+        if job.output_file_id:
+            yield from _chat_completion_answers(self.client.files.content(job.output_file_id).text)
+
+@register
+class MistralBatchJob(BatchJob):
+    client: Mistral
+
+    FINISHED_STATES = ("SUCCESS", "FAILED", "TIMEOUT_EXCEEDED", "CANCELLED")
+    ENDPOINT = "/v1/chat/completions"
+
+    def __init__(self, client: Mistral, model_name: str, poll_interval: float = 60.0) -> None:
+        super().__init__(model_name, poll_interval)
+        self.client = client
+
+    def _request_line(self, custom_id: str, question: str) -> Dict:
+        # same request as MistralQueryHandler, the model is set per job
+        return {
+            "custom_id": custom_id,
+            "body": {
+                "messages": [{"role": "user", "content": question}]
+            }
+        }
+
+    def _submit(self, path: str) -> str:
+        with open(path, mode='rb') as file:
+            input_file = self.client.files.upload(
+                file={"file_name": os.path.basename(path), "content": file},
+                purpose="batch")
+        return self.client.batch.jobs.create(
+            input_files=[input_file.id],
+            model=self.model_name,
+            endpoint=self.ENDPOINT).id
+
+    def _state(self, job_id: str) -> str:
+        return self.client.batch.jobs.get(job_id=job_id).status
+
+    def _answers(self, job_id: str) -> Iterator[Tuple[str, BatchAnswer]]:
+        job = self.client.batch.jobs.get(job_id=job_id)
+        if job.output_file:
+            yield from _chat_completion_answers(
+                self.client.files.download(file_id=job.output_file).read().decode())
+
+@register
+class GeminiBatchJob(BatchJob):
+    client: genai.Client
+
+    FINISHED_STATES = ("JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED",
+                       "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED")
+
+    def __init__(self, client: genai.Client, model_name: str, poll_interval: float = 60.0) -> None:
+        super().__init__(model_name, poll_interval)
+        self.client = client
+
+    def _request_line(self, custom_id: str, question: str) -> Dict:
+        # same request as GeminiQueryHandler
+        return {
+            "key": custom_id,
+            "request": {
+                "contents": [{"role": "user", "parts": [{"text": question}]}],
+                "system_instruction": {"parts": [{"text": SYSTEM_PROMPT}]},
+                "generation_config": {"temperature": 0.0}
+            }
+        }
+
+    def _submit(self, path: str) -> str:
+        from google.genai import types
+        input_file = self.client.files.upload(
+            file=path,
+            config=types.UploadFileConfig(mime_type="jsonl"))
+        return self.client.batches.create(model=self.model_name, src=input_file.name).name
+
+    def _state(self, job_id: str) -> str:
+        return self.client.batches.get(name=job_id).state.name
+
+    def _answers(self, job_id: str) -> Iterator[Tuple[str, BatchAnswer]]:
+        job = self.client.batches.get(name=job_id)
+        if job.dest is None or not job.dest.file_name:
+            return
+        lines = self.client.files.download(file=job.dest.file_name).decode()
+        for line in lines.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            candidates = response.get("candidates") or []
+            if "error" in record or not candidates:
+                log.warning(f"Batch item {record.get('key')} failed: {record.get('error') or response}")
+                continue
+            usage = response.get("usageMetadata")
+            yield record["key"], (
+                "".join(part.get("text", "") for part in candidates[0]["content"].get("parts", [])),
+                (usage.get("promptTokenCount"), usage.get("candidatesTokenCount")) if usage else None)
+
+class BatchJobRequestManger(RequestManger):
+    """
+    Query the packages with asynchronous batch jobs of the provider.
+    Every chunk of job size packages is one job, at most max in flight
+    jobs run at once. Answers are parsed with the response parser of the
+    query handler, failed or unparsable items are resubmitted in a new job.
+    """
+    _batch_job: BatchJob
+
+    def __init__(self,
+                 *args,
+                 batch_job: BatchJob,
+                 job_size: int = 50_000,
+                 **kwargs) -> None:
+
+        super().__init__(*args, **kwargs)
+        self._batch_job = batch_job
+        # a chunk of the package list is one job
+        self._batch_size = max(1, job_size)
+
+    def _request_chunk(self,
+                       chunk: List[Tuple[int, List[str]]]) -> List[Tuple[int, str]]:
+        query_handler = self._query_handler
+        results: Dict[int, str] = {}
+        # package name and question by custom id
+        questions: Dict[str, Tuple[str, str]] = {}
+        for offset, row in chunk:
+            previous = self._previous_result(row)
+            if previous is not None:
+                results[offset] = previous
+                continue
+
+            pre_classified = self._pre_classify(row)
+            if pre_classified is not None:
+                results[offset] = pre_classified
+                continue
+
+            with self._metrics.timer("render"):
+                question = query_handler.generate_question_for_package(
+                    name=row[0], description=row[2], dependencies=row[3])
+            if self._response_cache is not None:
+                cached = self._response_cache.get(query_handler, question)
+                if cached is not None and cached[1] is not None:
+                    self._metrics.count("cache_hits", query_handler.model_id)
+                    results[offset] = self._model_decided(cached[1])
+                    continue
+
+            questions[str(offset)] = (row[0], question)
+
+        for round_idx in range(self.RETRY_COUNT):
+            if not questions:
+                break
+            if round_idx > 0:
+                self._metrics.count("retries", "batch_item", len(questions))
+                log.info(f"Resubmitting {len(questions)} failed requests.")
+
+            answers = self._batch_job({custom_id: question
+                                       for custom_id, (_, question) in questions.items()})
+            self._metrics.count("batch_jobs", query_handler.model_id)
+            self._metrics.count("provider_requests", query_handler.model_id, len(answers))
+
+            for custom_id, (response, usage) in answers.items():
+                package_name, question = questions[custom_id]
+                self._metrics.record_usage(query_handler.model_id, usage)
+
+                query_handler.response_parser.last_error = None
+                with self._metrics.timer("parse"):
+                    parsed_response = query_handler.parse_response(response, package_name)
+                parse_error = query_handler.response_parser.last_error
+
+                if self._response_cache is not None:
+                    # keep unparsable responses, they can be re-parsed later
+                    self._response_cache.put(
+                        query_handler, question, package_name, response,
+                        parsed_response if parse_error is None else None)
+
+                if parse_error is None:
+                    results[int(custom_id)] = self._model_decided(parsed_response)
+                    del questions[custom_id]
+                else:
+                    self._metrics.count("parse_failures", type(query_handler.response_parser).__name__)
+
+        for custom_id, (package_name, _) in questions.items():
+            log.error(f"No valid answer for package {package_name} after {self.RETRY_COUNT} batch jobs.")
+            results[int(custom_id)] = self._model_decided(
+                query_handler.response_parser.get_empty_response(package_name))
+
+        return [(offset, results[offset]) for offset, _ in chunk]
@@ -0,0 +1,252 @@
+#! /usr/bin/env python3
+"""
+Throughput benchmark of the request pipeline against local stand-in
+servers (mock_llm.MockLLMServer) for the remote query stubs. gpt4all runs
+in process without a wire protocol and is not covered.
+
+Example:
+    python3 benchmark.py --stubs ollama openai --rows 100000 --max_in_flight 16
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+
+from itertools import cycle, islice
+from time import time
+from typing import Dict
+
+import config
+import request
+from mock_llm import STREAM_CHUNK_SIZE, MockBehaviour, MockLLMServer
+from packages import PACKAGE_COLUMNS, read_packages
+
+log = logging.getLogger(__name__)
+
+BUNDLED_PACKAGE_LIST = "../csv/dnf-packages-with-desc-depend-prompt1v2.csv"
+BENCHMARK_BATCH_JOB_SIZE = 1_000
+BENCHMARK_ATTRIBUTES = ["package", "cryptographic_relevance", "justification"]
+# model and endpoint suffix of the stand-in per query stub
+BENCHMARK_MODELS = {
+    "ollama": ("deepseek-r1:latest", ""),
+    "openai": ("gpt-5", "/v1"),
+    "gemini": ("gemini-2.5-flash", ""),
+    "mistral": ("codestral-2508", "")
+}
+
+def synthetic_package_list(package_list: str, rows: int, file_out: str) -> None:
+    """Scale a package list to the given number of rows, names stay unique."""
+    packages = list(read_packages(package_list))
+    with open(file_out, mode='w', newline='') as file:
+        package_writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        package_writer.writerow(PACKAGE_COLUMNS)
+        for idx, row in enumerate(islice(cycle(packages), rows)):
+            round_idx = idx // len(packages)
+            package_writer.writerow([row[0] if round_idx == 0 else f"{row[0]}-{round_idx}"] + row[1:4])
+
+def _git_version() -> str | None:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_stub(query_stub: str,
+             package_list: str,
+             packages: int,
+             behaviour: MockBehaviour,
+             max_in_flight: int,
+             work_dir: str,
+             batch_job: bool = False,
+             stream: bool = False,
+             structured_output: bool = False,
+             prompt_token_budget: int | None = None,
+             compact_prompts: bool = False) -> Dict:
+    """Run request.execute for one query stub against a stand-in server."""
+    llm_model, path = BENCHMARK_MODELS[query_stub]
+    csv_file_out = os.path.join(work_dir, f"{query_stub}.csv")
+    metrics_file = os.path.join(work_dir, f"{query_stub}.metrics.json")
+    server = MockLLMServer(behaviour).start()
+
+    error = None
+    start_time = time()
+    try:
+        request.execute(
+            query_stub=query_stub,
+            llm_model=llm_model,
+            prompt_template_file=config.QUERY_TEMPLATE_FILE.format(
+                os="fedora",
+                llm_model=llm_model,
+                query_template_path=config.QUERY_TEMPLATE_PATH,
+                template_alternative="-prompt1v2"),
+            csv_file_out=csv_file_out,
+            attributes=BENCHMARK_ATTRIBUTES,
+            base_package_list=package_list,
+            api_key="benchmark",
+            host=server.url,
+            max_in_flight=max_in_flight,
+            api_base_url=server.url + path,
+            metrics_file=metrics_file,
+            batch_job=batch_job,
+            batch_job_size=BENCHMARK_BATCH_JOB_SIZE,
+            batch_poll_interval=0.1,
+            stream=stream,
+            structured_output=structured_output,
+            compact_prompts=compact_prompts,
+            prompt_token_budget=prompt_token_budget)
+    except Exception as e:
+        # a failing run is a result as well
+        error = repr(e)
+    elapsed = time() - start_time
+    server.stop()
+
+    written = 0
+    parse_failures = 0
+    if os.path.exists(csv_file_out):
+        with open(csv_file_out, mode='r', newline='') as file:
+            result_reader = csv.reader(file)
+            next(result_reader, None)
+            for row in result_reader:
+                written += 1
+                parse_failures += not any(row[1:])
+
+    pipeline_metrics = None
+    if os.path.exists(metrics_file):
+        with open(metrics_file, mode='r') as file:
+            pipeline_metrics = json.load(file)
+
+    # latencies as seen by the client, time to result ends with the
+    # answer of a stopped stream
+    stages = pipeline_metrics["stages"] if pipeline_metrics else {}
+    counters = pipeline_metrics["counters"] if pipeline_metrics else {}
+    time_to_result = stages.get("time_to_result", {})
+    provider = stages.get("provider", {})
+    retries = counters.get("retries", {})
+    stats = server.stats
+    return {
+        "query_stub": query_stub,
+        "model": llm_model,
+        "packages": packages,
+        "written": written,
+        "max_in_flight": max_in_flight,
+        "batch_job": batch_job,
+        "stream": stream,
+        "structured_output": structured_output,
+        "compact_prompts": compact_prompts,
+        "elapsed": elapsed,
+        "packages_per_sec": written / elapsed if elapsed else None,
+        "latency_p50": time_to_result.get("p50"),
+        "latency_p99": time_to_result.get("p99"),
+        "provider_p50": provider.get("p50"),
+        "provider_p99": provider.get("p99"),
+        "requests": stats.requests,
+        "retries": sum(retries.values()),
+        "retries_by_cause": retries,
+        "server_errors": stats.errors,
+        "rate_limited": stats.rate_limited,
+        "malformed": stats.malformed,
+        "stopped_streams": stats.stopped,
+        "parse_failures": parse_failures,
+        "parse_failure_rate": parse_failures / written if written else None,
+        "prompt_tokens": stats.prompt_tokens,
+        "completion_tokens": stats.completion_tokens,
+        "pipeline_metrics": pipeline_metrics,
+        "error": error
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the request pipeline " \
+                                     "against local stand-in servers.")
+    parser.add_argument("--stubs", type=str, nargs="+", default=list(BENCHMARK_MODELS),
+                        choices=list(BENCHMARK_MODELS), help="Query stubs to benchmark.")
+    parser.add_argument("--base_package_list", type=str, default=BUNDLED_PACKAGE_LIST,
+                        help=f"Package list (default: {BUNDLED_PACKAGE_LIST}).")
+    parser.add_argument("--rows", type=int, default=None,
+                        help="Scale the package list to the given number of rows (optional).")
+    parser.add_argument("--max_in_flight", type=int, default=None,
+                        help="Concurrent requests (default: config.MAX_IN_FLIGHT per stub).")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Median latency of the stand-in in seconds (default: 0.05).")
+    parser.add_argument("--latency_sigma", type=float, default=0.5,
+                        help="Sigma of the log-normal latency (default: 0.5).")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+                        help="Share of requests answered with HTTP 503 (default: 0).")
+    parser.add_argument("--malformed_rate", type=float, default=0.0,
+                        help="Share of answers with broken JSON (default: 0).")
+    parser.add_argument("--rate_limited_rate", type=float, default=0.0,
+                        help="Share of requests answered with HTTP 429 (default: 0).")
+    parser.add_argument("--retry_after", type=float, default=1.0,
+                        help="Retry-After of rate limited requests in seconds (default: 1).")
+    parser.add_argument("--chunk_latency", type=float, default=0.0,
+                        help="Generation time of the stand-in per chunk of " \
+                             f"{STREAM_CHUNK_SIZE} characters in seconds (default: 0).")
+    parser.add_argument("--trailing_chunks", type=int, default=0,
+                        help="Chunks of chatter generated after the answer (default: 0).")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream the responses and stop them once the answer is complete.")
+    parser.add_argument("--structured_output", action="store_true",
+                        help="Constrain the answers to the schema of the attributes.")
+    parser.add_argument("--compact_prompts", action="store_true",
+                        help="Compact the prompts, see query_llm --compact_prompts.")
+    parser.add_argument("--prompt_token_budget", type=int, default=None,
+                        help="Token budget of the compacted prompts (optional).")
+    parser.add_argument("--batch_job", action="store_true",
+                        help="Use the batch jobs of the providers offering them, " \
+                             "other stubs are skipped.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0).")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Write the JSON report to a file instead of stdout.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    behaviour = MockBehaviour(
+        latency_median=args.latency,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+        rate_limited_rate=args.rate_limited_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+        chunk_latency=args.chunk_latency,
+        trailing_chunks=args.trailing_chunks)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        package_list = args.base_package_list
+        if args.rows:
+            package_list = os.path.join(work_dir, "packages.csv")
+            synthetic_package_list(args.base_package_list, args.rows, package_list)
+        packages = sum(1 for _ in read_packages(package_list))
+
+        results = [run_stub(
+            query_stub=query_stub,
+            package_list=package_list,
+            packages=packages,
+            behaviour=behaviour,
+            max_in_flight=args.max_in_flight or config.MAX_IN_FLIGHT.get(query_stub, 1),
+            work_dir=work_dir,
+            batch_job=args.batch_job,
+            stream=args.stream,
+            structured_output=args.structured_output,
+            compact_prompts=args.compact_prompts or args.prompt_token_budget is not None,
+            prompt_token_budget=args.prompt_token_budget) for query_stub in args.stubs
+            if not args.batch_job or query_stub in config.BATCH_JOB_STUBS]
+
+    report = {
+        "version": _git_version(),
+        "python": sys.version.split()[0],
+        "behaviour": vars(behaviour),
+        "results": results
+    }
+    if args.output:
+        with open(args.output, mode='w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
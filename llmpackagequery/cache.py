@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+
+from time import time
+from typing import Dict, Tuple
+
+from query import QueryHandlerCallable
+
+log = logging.getLogger(__name__)
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    package TEXT NOT NULL,
+    raw TEXT NOT NULL,
+    parsed TEXT,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    parser TEXT
+);
+CREATE INDEX IF NOT EXISTS responses_model ON responses (model);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+class ResponseCache:
+    """
+    Persistent response cache stored in a SQLite file.
+    Entries are addressed by the hash of the model id, the rendered prompt
+    and the schema the output is constrained to, so any change of the
+    package metadata, the template or the model results in a new entry.
+    Besides the raw response the parsed row is stored with the parser and
+    attributes it was parsed with, a parsed row of None marks a response
+    the parser could not handle. Rows of another parser or other
+    attributes are parsed again from the raw response.
+    """
+    _connection: sqlite3.Connection
+    _lock: threading.Lock
+    _max_age: float | None
+    _max_entries: int | None
+
+    def __init__(self,
+                 cache_file: str,
+                 max_age: float | None = None,
+                 max_entries: int | None = None) -> None:
+
+        self._lock = threading.Lock()
+        self._max_age = max_age
+        self._max_entries = max_entries
+
+        # connection is shared between the request threads, access is locked
+        self._connection = sqlite3.connect(cache_file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(CACHE_SCHEMA)
+        # caches written before the parser was recorded
+        columns = {column[1] for column in self._connection.execute("PRAGMA table_info(responses)")}
+        if "parser" not in columns:
+            self._connection.execute("ALTER TABLE responses ADD COLUMN parser TEXT")
+        self.evict()
+
+    @staticmethod
+    def key(model: str, prompt: str, schema: Dict | None = None) -> str:
+        """Content address of a request."""
+        request = f"{model}\0{prompt}"
+        if schema is not None:
+            request += "\0" + json.dumps(schema, sort_keys=True)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    @staticmethod
+    def parser_key(query_handler: QueryHandlerCallable) -> str:
+        """Parser, attributes and output mode a parsed row depends on."""
+        response_parser = query_handler.response_parser
+        return json.dumps([type(response_parser).__name__, response_parser.attributes_list,
+                           query_handler.response_schema is not None])
+
+    def get(self, query_handler: QueryHandlerCallable, prompt: str) -> Tuple[str, str | None] | None:
+        """
+        Return raw response and parsed row of the request of the handler or
+        None if not cached. A row of another parser is parsed again.
+        """
+        key = self.key(query_handler.model_id, prompt, query_handler.response_schema)
+        with self._lock:
+            entry = self._connection.execute(
+                "SELECT raw, parsed, parser, package FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if entry is not None:
+                self._connection.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?",
+                    (time(), key))
+                self._connection.commit()
+        if entry is None:
+            return None
+
+        raw, parsed, parser, package_name = entry
+        parser_key = self.parser_key(query_handler)
+        if parser != parser_key:
+            parsed = self._parse(query_handler, raw, package_name)
+            with self._lock:
+                self._connection.execute(
+                    "UPDATE responses SET parsed = ?, parser = ? WHERE key = ?",
+                    (parsed, parser_key, key))
+                self._connection.commit()
+        return raw, parsed
+
+    def put(self,
+            query_handler: QueryHandlerCallable,
+            prompt: str,
+            package_name: str,
+            raw: str,
+            parsed: str | None) -> None:
+        """Store a response of the handler, existing entries are replaced."""
+        now = time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, package, raw, parsed, created, accessed, parser) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.key(query_handler.model_id, prompt, query_handler.response_schema),
+                 query_handler.model_id, package_name, raw, parsed, now, now,
+                 self.parser_key(query_handler)))
+            self._connection.commit()
+
+    @staticmethod
+    def _parse(query_handler: QueryHandlerCallable, raw: str, package_name: str) -> str | None:
+        # parsed row of a raw response, None if the parser cannot handle it
+        query_handler.response_parser.last_error = None
+        parsed = query_handler.parse_response(raw, package_name)
+        if query_handler.response_parser.last_error is not None:
+            return None
+        return parsed
+
+    def evict(self) -> int:
+        """Remove entries older than max age and the least recently used
+        entries exceeding max entries. Returns the number of removed entries."""
+        removed = 0
+        with self._lock:
+            if self._max_age is not None:
+                removed += self._connection.execute(
+                    "DELETE FROM responses WHERE created < ?",
+                    (time() - self._max_age,)).rowcount
+            if self._max_entries is not None:
+                removed += self._connection.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY accessed DESC "
+                    "LIMIT -1 OFFSET ?)",
+                    (self._max_entries,)).rowcount
+            self._connection.commit()
+
+        if removed:
+            log.info(f"Evicted {removed} entries from the response cache.")
+        return removed
+
+    def reparse(self, query_handler: QueryHandlerCallable) -> Tuple[int, int]:
+        """
+        Parse all cached raw responses of the model of the handler again
+        with its parser and store the new rows. No request is sent to the
+        model. Returns the number of parsed entries and the number of failures.
+        """
+        model = query_handler.model_id
+        with self._lock:
+            entries = self._connection.execute(
+                "SELECT key, package, raw FROM responses WHERE model = ?",
+                (model,)).fetchall()
+
+        parser_key = self.parser_key(query_handler)
+        updates = []
+        failed = 0
+        for key, package_name, raw in entries:
+            parsed = self._parse(query_handler, raw, package_name)
+            if parsed is None:
+                failed += 1
+            updates.append((parsed, parser_key, key))
+
+        with self._lock:
+            self._connection.executemany(
+                "UPDATE responses SET parsed = ?, parser = ? WHERE key = ?", updates)
+            self._connection.commit()
+
+        log.info(f"Re-parsed {len(entries)} cached responses of {model}, {failed} failed.")
+        return len(entries), failed
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,206 @@
+import logging
+import sys
+import threading
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from cache import ResponseCache
+from compaction import compact_query_handler
+from incremental import PreviousRun
+from metrics import Metrics
+from ratelimit import RateLimit, RateLimiter
+from query import QueryHandlerCallable
+from request import RequestManger, RunSetup, create_query_handler
+from store import RunRecorder, template_name
+from rules import RULES_DECIDER, PreClassifier
+from writer import DECIDED_BY_ATTRIBUTE, format_results, split_results
+
+log = logging.getLogger(__name__)
+
+BOOLEAN_VALUES = ("True", "False")
+
+class CascadeRequestManger(RequestManger):
+    """
+    Ask every package to a cascade of model tiers, cheap models first.
+    A tier decides a package if all of its models return a boolean and
+    agree on the decision attribute; unparsable responses result in an
+    empty attribute and escalate as well. The last tier always decides.
+    The model id of the deciding tier is written to the decided_by column.
+    """
+    _tiers: List[List[QueryHandlerCallable]]
+    _decision_attribute: str
+    _decided: Counter
+    _lock: threading.Lock
+    _executor: ThreadPoolExecutor
+
+    def __init__(self,
+                 tiers: List[List[QueryHandlerCallable]],
+                 package_file_in: str,
+                 package_file_out: str,
+                 decision_attribute: str,
+                 query_restriction: int = sys.maxsize,
+                 max_in_flight: int = 1,
+                 response_cache: ResponseCache | None = None,
+                 resume: bool = False,
+                 previous_run: PreviousRun | None = None,
+                 pre_classifier: PreClassifier | None = None,
+                 metrics: Metrics | None = None,
+                 rate_limiter: RateLimiter | None = None,
+                 result_recorder: RunRecorder | None = None) -> None:
+
+        super().__init__(
+            query_handler=tiers[-1][0],
+            package_file_in=package_file_in,
+            package_file_out=package_file_out,
+            query_restriction=query_restriction,
+            max_in_flight=max_in_flight,
+            response_cache=response_cache,
+            resume=resume,
+            previous_run=previous_run,
+            pre_classifier=pre_classifier,
+            metrics=metrics,
+            rate_limiter=rate_limiter,
+            result_recorder=result_recorder)
+
+        self._tiers = tiers
+        self._decision_attribute = decision_attribute
+        self._decided = Counter()
+        self._lock = threading.Lock()
+
+    def write_attributes(self) -> List[str]:
+        return self._query_handler.response_parser.attributes_list + [DECIDED_BY_ATTRIBUTE]
+
+    def run(self):
+        # the models of a tier are asked concurrently
+        max_workers = self._max_in_flight * max(map(len, self._tiers))
+        with ThreadPoolExecutor(max_workers=max_workers) as self._executor:
+            super().run()
+
+        if self._pre_classifier is not None:
+            self._decided[RULES_DECIDER] = self._pre_classifier.decided
+        log.info(f"Packages decided per tier: {dict(self._decided)}")
+
+    def _request_row(self, row: List[str]) -> str:
+        # unchanged packages keep the result of the previous run
+        if self._previous_run is not None:
+            previous = self._previous_run.lookup(row)
+            if previous is not None:
+                return format_results(previous)
+
+        # obvious packages are decided before the first tier
+        pre_classified = self._pre_classify(row)
+        if pre_classified is not None:
+            return pre_classified
+
+        attributes = self._query_handler.response_parser.attributes_list
+        decision_index = attributes.index(self._decision_attribute)
+
+        for tier_idx, tier in enumerate(self._tiers):
+            futures = [
+                self._executor.submit(
+                    self.do_request,
+                    package_name=row[0],
+                    package_description=row[2],
+                    package_tree=row[3],
+                    query_handler=query_handler)
+                for query_handler in tier]
+            results = [split_results(future.result(), len(attributes)) for future in futures]
+            decisions = {values[decision_index] for values in results}
+
+            decided = len(decisions) == 1 and decisions <= set(BOOLEAN_VALUES)
+            if decided or tier_idx == len(self._tiers) - 1:
+                if not decided:
+                    log.warning(f"No certain decision for package {row[0]} in the last tier.")
+                decided_by = "+".join(query_handler.model_id for query_handler in tier)
+                with self._lock:
+                    self._decided[decided_by] += 1
+                return format_results(results[0] + [decided_by])
+
+            log.info(f"Escalating package {row[0]} from tier {tier_idx + 1}, answers: {sorted(decisions)}")
+
+def execute(
+        tiers: List[List[Tuple[str, str, str]]],
+        csv_file_out: str,
+        attributes: List[str],
+        base_package_list: str,
+        api_keys: Dict[str, str | None],
+        host: str,
+        decision_attribute: str,
+        query_restriction: int = sys.maxsize,
+        max_in_flight: int = 1,
+        cache_file: str | None = None,
+        cache_max_age: float | None = None,
+        cache_max_entries: int | None = None,
+        cache_reparse: bool = False,
+        resume: bool = False,
+        previous_package_list: str | None = None,
+        previous_results: str | None = None,
+        preclassify_rules: Dict[str, List[str]] | None = None,
+        metrics_file: str | None = None,
+        metrics_interval: float = 60.0,
+        metrics_port: int | None = None,
+        rate_limits: Dict[str, RateLimit] | None = None,
+        stream: bool = False,
+        structured_output: bool = False,
+        compact_prompts: bool = False,
+        prompt_token_budget: int | None = None,
+        result_store: str | None = None) -> None:
+    """
+    Query the tiers of models given as (query stub, model, prompt template
+    file) for every package, starting with the first tier.
+    """
+    query_handler_tiers = [
+        [create_query_handler(
+            query_stub=query_stub,
+            llm_model=llm_model,
+            prompt_template_file=prompt_template_file,
+            attributes=attributes,
+            api_key=api_keys.get(query_stub),
+            host=host,
+            stream=stream,
+            structured_output=structured_output) for query_stub, llm_model, prompt_template_file in tier]
+        for tier in tiers]
+
+    if compact_prompts:
+        # every model gets prompts fitting its own token budget
+        query_handler_tiers = [[compact_query_handler(query_handler, base_package_list, prompt_token_budget)
+                                for query_handler in tier] for tier in query_handler_tiers]
+
+    with RunSetup(
+            query_handlers=sum(query_handler_tiers, []),
+            csv_file_out=csv_file_out,
+            attributes=attributes,
+            result_attributes=attributes + [DECIDED_BY_ATTRIBUTE],
+            base_package_list=base_package_list,
+            # the cascade is recorded as one model
+            recorded_model="cascade:" + ",".join(query_handler.model_id
+                                                 for tier in query_handler_tiers for query_handler in tier),
+            template=template_name(tiers[0][0][2]),
+            query_restriction=query_restriction,
+            max_in_flight=max_in_flight,
+            cache_file=cache_file,
+            cache_max_age=cache_max_age,
+            cache_max_entries=cache_max_entries,
+            cache_reparse=cache_reparse,
+            resume=resume,
+            previous_package_list=previous_package_list,
+            previous_results=previous_results,
+            # decide obvious packages before the first tier
+            preclassify_rules=preclassify_rules,
+            decision_attribute=decision_attribute,
+            metrics_file=metrics_file,
+            metrics_interval=metrics_interval,
+            metrics_port=metrics_port,
+            rate_limits=rate_limits,
+            result_store=result_store) as run_setup:
+
+        request_manger = CascadeRequestManger(
+            **run_setup.manger_parameters,
+            tiers=query_handler_tiers,
+            decision_attribute=decision_attribute,
+            pre_classifier=run_setup.pre_classifier)
+
+        log.info(f"Starting requests to {len(tiers)} tiers ...")
+        request_manger.run()
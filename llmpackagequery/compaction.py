@@ -0,0 +1,252 @@
+import logging
+import os
+import re
+import threading
+
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import config
+from metrics import Metrics
+from packages import read_packages
+from query import BatchPromptGeneratorCallable, PromptGeneratorCallable, QueryHandlerCallable
+from ratelimit import CHARS_PER_TOKEN, estimate_length_tokens, estimate_tokens
+from rules import split_dependencies
+
+log = logging.getLogger(__name__)
+
+# end of a cut description or dependency list
+TRUNCATED_DESCRIPTION = " ..."
+TRUNCATED_DEPENDENCIES = ", ... ({count} more)"
+# name of one character counting the names in a rendered template
+NAME_PROBE = "x"
+
+@lru_cache(maxsize=8)
+def _dependency_statistics(package_list: str, modified: float) -> Tuple[Dict[str, int], int]:
+    frequencies = Counter()
+    packages = 0
+    for row in read_packages(package_list):
+        packages += 1
+        frequencies.update(set(split_dependencies(row[3])))
+    return dict(frequencies), packages
+
+def dependency_statistics(package_list: str) -> Tuple[Dict[str, int], int]:
+    """
+    Number of packages depending on every dependency and the number of
+    packages of a package list. Computed once per package list and run.
+    """
+    return _dependency_statistics(package_list, os.path.getmtime(package_list))
+
+class PromptCompactor:
+    """
+    Shorten the description and dependencies of a package before they are
+    rendered. Dependencies most packages of the input share (glibc, libgcc)
+    carry no information and are dropped, the remaining ones are ranked
+    crypto libraries first, then by rarity. If a token budget is given,
+    dependencies and finally the description are cut to fit the prompt.
+    """
+    _frequencies: Dict[str, int]
+    _ubiquitous_count: float
+    _token_budget: int | None
+    _priority: re.Pattern
+    _priority_dependencies: set
+    _lock: threading.Lock
+    compacted: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+
+    def __init__(self,
+                 frequencies: Dict[str, int],
+                 packages: int,
+                 token_budget: int | None = None,
+                 ubiquitous_share: float = config.UBIQUITOUS_DEPENDENCY_SHARE,
+                 priority_pattern: str = config.CRYPTO_DEPENDENCY_PATTERN,
+                 priority_dependencies: List[str] | None = None) -> None:
+
+        self._frequencies = frequencies
+        # without statistics no dependency is ubiquitous
+        self._ubiquitous_count = ubiquitous_share * packages if packages else float("inf")
+        self._token_budget = token_budget
+        self._priority = re.compile(priority_pattern)
+        self._priority_dependencies = set(priority_dependencies
+                                          or config.PRECLASSIFY_RULES.get("relevant_dependencies", []))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_package_list(cls, package_list: str | None, **options) -> "PromptCompactor":
+        """Compactor with the dependency statistics of a package list."""
+        frequencies, packages = {}, 0
+        if package_list and os.path.isfile(package_list):
+            frequencies, packages = dependency_statistics(package_list)
+        else:
+            log.warning(f"No dependency statistics for {package_list}, keeping ubiquitous dependencies.")
+        compactor = cls(frequencies=frequencies, packages=packages, **options)
+        log.info(f"Prompt compaction: {len(compactor.ubiquitous())} ubiquitous dependencies " \
+                 f"of {packages} packages, token budget {options.get('token_budget') or 'none'}")
+        return compactor
+
+    def ubiquitous(self) -> List[str]:
+        """Dependencies dropped from every prompt."""
+        return sorted(dependency for dependency, count in self._frequencies.items()
+                      if count > self._ubiquitous_count and not self._is_priority(dependency))
+
+    def _is_priority(self, dependency: str) -> bool:
+        # annotated dependencies, e.g. "openssl-libs (cryptographic)", count by name
+        name = dependency.split(" ", 1)[0]
+        return name in self._priority_dependencies or self._priority.search(name) is not None
+
+    def rank_dependencies(self, dependencies: str) -> List[str]:
+        """Informative dependencies of a package, most relevant first."""
+        ranked = []
+        for position, dependency in enumerate(split_dependencies(dependencies)):
+            priority = self._is_priority(dependency)
+            count = self._frequencies.get(dependency.split(" ", 1)[0], 0)
+            if count > self._ubiquitous_count and not priority:
+                continue
+            ranked.append((not priority, count, position, dependency))
+        return [dependency for *_, dependency in sorted(ranked)]
+
+    def compact(self, template_tokens: int,
+                description: str, dependencies: str) -> Tuple[str, str]:
+        """
+        Description and dependencies of a package fitting its prompt into the
+        budget, template_tokens are the tokens of the prompt without them.
+        """
+        ranked = self.rank_dependencies(dependencies)
+        if self._token_budget is not None:
+            # tokens left for the description and dependencies
+            available = self._token_budget - template_tokens
+            ranked, description = self._fit(ranked, description, available)
+        return description, ", ".join(ranked)
+
+    def _fit(self, ranked: List[str], description: str, available: int) -> Tuple[List[str], str]:
+        # the dependencies get the tokens the description leaves
+        # but at least half of them, the description is cut last
+        dependency_tokens = max(available - estimate_tokens(description), available // 2)
+        kept = []
+        used = 0
+        for dependency in ranked:
+            used += estimate_tokens(dependency + ", ")
+            if used > dependency_tokens:
+                break
+            kept.append(dependency)
+        if len(kept) < len(ranked):
+            kept[-1:] = [kept[-1] + TRUNCATED_DEPENDENCIES.format(count=len(ranked) - len(kept))] \
+                if kept else []
+
+        description_tokens = available - estimate_tokens(", ".join(kept))
+        if estimate_tokens(description) > description_tokens:
+            description = description[:max(0, description_tokens - 1) * CHARS_PER_TOKEN].rstrip() \
+                + TRUNCATED_DESCRIPTION
+        return kept, description
+
+    def record(self, prompt: str, removed_characters: int) -> None:
+        """Count the tokens of a compacted prompt and the tokens saved."""
+        tokens = estimate_tokens(prompt)
+        with self._lock:
+            self.compacted += 1
+            self.tokens_before += tokens + removed_characters // CHARS_PER_TOKEN
+            self.tokens_after += tokens
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    def log_summary(self) -> None:
+        if self.compacted:
+            log.info(f"Prompt compaction saved {self.tokens_saved:,} of {self.tokens_before:,} " \
+                     f"prompt tokens ({self.tokens_saved / self.tokens_before:.1%}) " \
+                     f"in {self.compacted} prompts.")
+
+class CompactingPromptGenerator(PromptGeneratorCallable):
+    """Prompt generator rendering the compacted package with another generator."""
+    _prompt_generator: PromptGeneratorCallable
+    # length of the prompt without name, description and dependencies
+    # and the number of times the name is rendered
+    _template_length: int
+    _name_count: int
+    compactor: PromptCompactor
+
+    def __init__(self, prompt_generator: PromptGeneratorCallable, compactor: PromptCompactor) -> None:
+        self._prompt_generator = prompt_generator
+        self.compactor = compactor
+        # the fields are substituted into the template, the prompt length
+        # grows with their length and the template is measured once
+        self._template_length = len(prompt_generator(name="", description="", dependencies=""))
+        self._name_count = len(prompt_generator(name=NAME_PROBE, description="", dependencies="")) \
+            - self._template_length
+
+    @property
+    def static_prefix(self) -> str:
+        # the template before the first placeholder is not compacted
+        return getattr(self._prompt_generator, "static_prefix", "")
+
+    def __call__(self, name: str, description: str, dependencies: str) -> str:
+        template_tokens = estimate_length_tokens(self._template_length + self._name_count * len(name))
+        compact_description, compact_dependencies = self.compactor.compact(
+            template_tokens, description, dependencies)
+        prompt = self._prompt_generator(
+            name=name, description=compact_description, dependencies=compact_dependencies)
+        self.compactor.record(prompt, len(description) + len(dependencies)
+                              - len(compact_description) - len(compact_dependencies))
+        return prompt
+
+class CompactingBatchPromptGenerator(BatchPromptGeneratorCallable):
+    """Batch prompt generator rendering the packages relieved of ubiquitous dependencies."""
+    _batch_prompt_generator: BatchPromptGeneratorCallable
+    compactor: PromptCompactor
+
+    def __init__(self, batch_prompt_generator: BatchPromptGeneratorCallable,
+                 compactor: PromptCompactor) -> None:
+        self._batch_prompt_generator = batch_prompt_generator
+        self.compactor = compactor
+
+    def __call__(self, packages: List[Tuple[str, str, str]]) -> str:
+        # the token budget applies to single prompts, batches are sized by the batch size
+        compacted = [(name, description, ", ".join(self.compactor.rank_dependencies(dependencies)))
+                     for name, description, dependencies in packages]
+        prompt = self._batch_prompt_generator(compacted)
+        self.compactor.record(prompt, sum(len(package[2]) - len(compact[2])
+                                          for package, compact in zip(packages, compacted)))
+        return prompt
+
+def compact_query_handlers(query_handlers: List[QueryHandlerCallable],
+                           package_list: str | None,
+                           token_budget: int | None = None) -> List[QueryHandlerCallable]:
+    """
+    Copies of query handlers rendering compacted prompts. The dependency
+    statistics are taken from the package list, the token budget defaults
+    to the one of the model in config.PROMPT_TOKEN_BUDGETS. Handlers sharing
+    a prompt generator and budget share the compacted prompts as well.
+    """
+    compacting_generators: Dict[Tuple[int, int | None], CompactingPromptGenerator] = {}
+    compacted = []
+    for query_handler in query_handlers:
+        llm_model = query_handler.model_id.split(".", 1)[-1]
+        budget = token_budget or config.PROMPT_TOKEN_BUDGETS.get(llm_model)
+        key = (id(query_handler.prompt_generator), budget)
+        if key not in compacting_generators:
+            compactor = PromptCompactor.from_package_list(package_list, token_budget=budget)
+            compacting_generators[key] = CompactingPromptGenerator(query_handler.prompt_generator, compactor)
+        compacted.append(query_handler.with_prompt(compacting_generators[key], query_handler.response_parser))
+    return compacted
+
+def compact_query_handler(query_handler: QueryHandlerCallable,
+                          package_list: str | None,
+                          token_budget: int | None = None) -> QueryHandlerCallable:
+    """Copy of a query handler rendering compacted prompts, see compact_query_handlers."""
+    return compact_query_handlers([query_handler], package_list, token_budget)[0]
+
+def report_compaction(query_handlers: List[QueryHandlerCallable], metrics: Metrics) -> None:
+    """Log and count the prompt tokens saved by the handlers with compacted prompts."""
+    logged = set()
+    for query_handler in query_handlers:
+        prompt_generator = query_handler.prompt_generator
+        if isinstance(prompt_generator, CompactingPromptGenerator):
+            # a shared compactor is logged once, its prompts were sent to every model
+            if id(prompt_generator.compactor) not in logged:
+                logged.add(id(prompt_generator.compactor))
+                prompt_generator.compactor.log_summary()
+            metrics.count("prompt_tokens_saved", query_handler.model_id,
+                          prompt_generator.compactor.tokens_saved)
@@ -7,7 +7,92 @@ CSV_BASE_PATH = "./csv"
 LOGS_BASE_PATH = "./logs"
 CSV_FILE = "{csv_base_path}/{os}_{llm_model}{timestamp_string}{template_alternative}.csv" # replaced during iteration
 QUERY_TEMPLATE_FILE = "{query_template_path}/{os}_{llm_model}{template_alternative}.tpl" # replaced during iteration
+BATCH_QUERY_TEMPLATE_FILE = "{query_template_path}/{os}_batch.tpl" # one template for all models, replaced during iteration
 ERROR_FILE_PATH = "{logs_base_path}/error-{os}_{llm_model}{timestamp_string}{template_alternative}.log" # replaced during iteration
+CACHE_FILE = None # e.g. "./cache/responses.sqlite"
+RESULT_STORE = None # e.g. "./results/results.sqlite", results of all runs besides the CSV files
+METRICS_FILE = "{csv_file}.metrics.json" # JSON summary of the run metrics
+METRICS_INTERVAL = 60 # seconds between two JSON summaries
+OLLAMA_KEEP_ALIVE = "30m" # time ollama keeps the model loaded after a request
+# Maximum number of concurrent requests per query stub
+# (gpt4all runs in process and is restricted to one request at a time)
+MAX_IN_FLIGHT = {
+    "ollama": 1,
+    "gpt4all": 1,
+    "openai": 8,
+    "gemini": 8,
+    "mistral": 4
+}
+
+# Requests and tokens per minute per query stub or model id (e.g.
+# "openai.gpt-5", takes precedence), None is unlimited. Adjust them to
+# the tier of the account, rate limit responses lower the request rate.
+RATE_LIMITS = {
+    "openai": (500, 500_000),
+    "gemini": (1_000, 1_000_000),
+    "mistral": (300, 500_000)
+}
+
+# Boolean attributes of the schema constraining the model output
+# (--structured_output), all other attributes are strings
+BOOLEAN_ATTRIBUTES = ["cryptographic_relevance", "is_security_relevant"]
+
+# Prompt compaction (--compact_prompts): prompt token budget per model,
+# models with a small context window keep room for the answer. Models
+# not listed are only relieved of ubiquitous dependencies, those found in
+# more than UBIQUITOUS_DEPENDENCY_SHARE of the packages of the input.
+PROMPT_TOKEN_BUDGETS = {
+    "Phi-3-mini-4k-instruct.Q4_0": 3_000,
+    "orca-mini-3b-gguf2-q4_0": 1_500,
+    "gpt4all-13b-snoozy-q4_0": 1_500,
+    "Meta-Llama-3-8B-Instruct.Q4_0": 6_000,
+    "Nous-Hermes-2-Mistral-7B-DPO.Q4_0": 6_000
+}
+UBIQUITOUS_DEPENDENCY_SHARE = 0.1
+# dependencies ranked first in a compacted prompt
+CRYPTO_DEPENDENCY_PATTERN = r"ssl|tls|crypt|gnutls|nss|sodium|ssh|gpg|krb5|sasl|p11|pkcs|nettle|mbedtls|wolfssl|botan|keyutils"
+
+# Classification service (--serve_classifier): seconds the packages of
+# concurrent requests are collected into one micro-batch and the upper
+# bound of the packages of a micro-batch
+SERVICE_BATCH_WINDOW = 0.05
+SERVICE_MAX_BATCH_SIZE = 64
+
+# Shards of the package list per worker of a sharded run (--devices),
+# smaller shards balance the workers better
+SHARDS_PER_WORKER = 8
+
+# Seconds a worker of a work queue (--work_queue) may hold leased
+# packages without renewing the lease
+WORK_QUEUE_LEASE_TIMEOUT = 300
+
+# Batch jobs of the providers offering them: requests per job and
+# seconds between two polls of a running job
+BATCH_JOB_STUBS = ["openai", "mistral", "gemini"]
+BATCH_JOB_SIZE = 50_000
+BATCH_POLL_INTERVAL = 60
+
+# Environment variables holding the api key per query stub,
+# used if no api key is given on the command line
+API_KEY_ENV = {
+    "openai": "OPENAI_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+    "mistral": "MISTRAL_API_KEY"
+}
+
+# Rules of the pre-classifier deciding obvious packages without a model
+# (replaced by --preclassify_rules)
+PRECLASSIFY_RULES = {
+    "relevant_dependencies": [
+        "openssl-libs", "gnutls", "libgcrypt", "nss",
+        "libsodium", "libxcrypt", "p11-kit"
+    ],
+    "irrelevant_name_patterns": [
+        r"-langpack(-.*)?$", r"^langpacks-",
+        r"-fonts?$", r"^google-noto-",
+        r"-docs?$", r"-javadoc$", r"-man-pages?$"
+    ]
+}
 
 
 # Load environment variables if they exist or use default values from above
@@ -18,4 +103,26 @@ LOGS_BASE_PATH = os.getenv('LOGS_BASE_PATH', LOGS_BASE_PATH)
 BASE_PACKAGE_LIST = os.getenv('BASE_PACKAGE_LIST', None)
 CSV_FILE = os.getenv('CSV_FILE', CSV_FILE)
 QUERY_TEMPLATE_FILE = os.getenv('QUERY_TEMPLATE_FILE', QUERY_TEMPLATE_FILE)
-ERROR_FILE_PATH = os.getenv('ERROR_FILE_PATH', ERROR_FILE_PATH)
\ No newline at end of file
+BATCH_QUERY_TEMPLATE_FILE = os.getenv('BATCH_QUERY_TEMPLATE_FILE', BATCH_QUERY_TEMPLATE_FILE)
+ERROR_FILE_PATH = os.getenv('ERROR_FILE_PATH', ERROR_FILE_PATH)
+CACHE_FILE = os.getenv('CACHE_FILE', CACHE_FILE)
+RESULT_STORE = os.getenv('RESULT_STORE', RESULT_STORE)
+METRICS_FILE = os.getenv('METRICS_FILE', METRICS_FILE)
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', METRICS_INTERVAL))
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', OLLAMA_KEEP_ALIVE)
+# e.g. MAX_IN_FLIGHT_OPENAI=16
+MAX_IN_FLIGHT = {stub: int(os.getenv(f'MAX_IN_FLIGHT_{stub.upper()}', count))
+                 for stub, count in MAX_IN_FLIGHT.items()}
+# e.g. BOOLEAN_ATTRIBUTES=cryptographic_relevance,uses_tls
+BOOLEAN_ATTRIBUTES = os.environ['BOOLEAN_ATTRIBUTES'].split(',') \
+    if 'BOOLEAN_ATTRIBUTES' in os.environ else BOOLEAN_ATTRIBUTES
+WORK_QUEUE_LEASE_TIMEOUT = float(os.getenv('WORK_QUEUE_LEASE_TIMEOUT', WORK_QUEUE_LEASE_TIMEOUT))
+UBIQUITOUS_DEPENDENCY_SHARE = float(os.getenv('UBIQUITOUS_DEPENDENCY_SHARE', UBIQUITOUS_DEPENDENCY_SHARE))
+SERVICE_BATCH_WINDOW = float(os.getenv('SERVICE_BATCH_WINDOW', SERVICE_BATCH_WINDOW))
+SERVICE_MAX_BATCH_SIZE = int(os.getenv('SERVICE_MAX_BATCH_SIZE', SERVICE_MAX_BATCH_SIZE))
+SHARDS_PER_WORKER = int(os.getenv('SHARDS_PER_WORKER', SHARDS_PER_WORKER))
+# e.g. RATE_LIMIT_OPENAI=500,200000
+RATE_LIMITS = {stub: tuple(float(value) or None for value in
+                           os.environ[f'RATE_LIMIT_{stub.upper()}'].split(','))
+                     if f'RATE_LIMIT_{stub.upper()}' in os.environ else limits
+               for stub, limits in RATE_LIMITS.items()}
@@ -0,0 +1,317 @@
+#! /usr/bin/env python3
+"""
+Evaluate results files against labeled packages and compare the runs
+with each other. The verdicts of all runs are aligned by package name
+into one int8 matrix (1 true, 0 false, -1 no verdict), metrics, bootstrap
+confidence intervals, error overlaps and agreement are computed on it for
+all runs at once.
+
+The labels are a CSV file with the package and the attribute, e.g. a
+results file checked by hand.
+
+Example:
+    python3 evaluate.py --labels labels.csv csv/fedora_gpt-5.csv csv/fedora_deepseek-r1:latest.csv
+    python3 evaluate.py csv/fedora_*.csv --output agreement.json
+"""
+import argparse
+import csv
+import json
+import logging
+import math
+import os
+import sys
+
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Dict, List, Sequence, TextIO, Tuple
+
+import numpy as np
+
+import config
+
+log = logging.getLogger(__name__)
+
+MISSING = -1
+VERDICT_CODES = {"true": 1, "1": 1, "yes": 1, "y": 1, "false": 0, "0": 0, "no": 0, "n": 0}
+METRICS = ("accuracy", "precision", "recall", "f1")
+
+BOOTSTRAP_SAMPLES = 1000
+CONFIDENCE = 0.95
+# bootstrap samples weighted at once, bounds the memory to chunk * packages
+BOOTSTRAP_CHUNK_SIZE = 50
+
+@dataclass
+class VerdictMatrix:
+    """Verdicts of runs aligned by package, labels aligned the same way."""
+    runs: List[str]
+    packages: np.ndarray
+    # (runs, packages)
+    verdicts: np.ndarray
+    # (packages,), MISSING for unlabeled packages
+    labels: np.ndarray | None = None
+
+def encode_verdicts(values: Sequence[str]) -> np.ndarray:
+    """Verdicts as int8, MISSING for errors and values that are no verdict."""
+    return np.fromiter((VERDICT_CODES.get(value.strip().lower(), MISSING) for value in values),
+                       dtype=np.int8, count=len(values))
+
+def verdict_column(packages: Sequence[str], values: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Package names and encoded verdicts of a run."""
+    return np.array(packages), encode_verdicts(values)
+
+def read_verdicts(results_file: str, attribute: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Package names and encoded verdicts of the attribute of a results file."""
+    with open(results_file, mode='r', newline='') as file:
+        result_reader = csv.reader(file)
+        header = next(result_reader, [])
+        if attribute not in header:
+            raise ValueError(f"{results_file} has no column {attribute}.")
+        package_index = header.index("package") if "package" in header else 0
+        attribute_index = header.index(attribute)
+        packages = []
+        values = []
+        for row in result_reader:
+            if len(row) > attribute_index:
+                packages.append(row[package_index])
+                values.append(row[attribute_index])
+    return verdict_column(packages, values)
+
+def align_verdicts(runs: Dict[str, Tuple[np.ndarray, np.ndarray]],
+                   labels: Tuple[np.ndarray, np.ndarray] | None = None) -> VerdictMatrix:
+    """
+    Align the (packages, verdicts) of every run and the labels by package
+    name. A package missing in a run has no verdict in it, of a package
+    listed twice the last verdict counts.
+    """
+    columns = list(runs.values()) + ([labels] if labels is not None else [])
+    packages, positions = np.unique(np.concatenate([names for names, _ in columns]), return_inverse=True)
+    aligned = np.full((len(columns), len(packages)), MISSING, dtype=np.int8)
+    start = 0
+    for row, (names, verdicts) in enumerate(columns):
+        aligned[row, positions[start:start + len(names)]] = verdicts
+        start += len(names)
+    if labels is None:
+        return VerdictMatrix(runs=list(runs), packages=packages, verdicts=aligned)
+    return VerdictMatrix(runs=list(runs), packages=packages, verdicts=aligned[:-1], labels=aligned[-1])
+
+def _cells(verdicts: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    # (4, runs, packages) true positive, false positive, false negative and
+    # true negative indicators, packages without verdict or label are in none
+    return np.stack([(verdicts == 1) & (labels == 1), (verdicts == 1) & (labels == 0),
+                     (verdicts == 0) & (labels == 1), (verdicts == 0) & (labels == 0)])
+
+def confusion_matrices(verdicts: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """(runs, 4) counts of true positives, false positives, false negatives and true negatives."""
+    return _cells(verdicts, labels).sum(axis=2).T
+
+def classification_metrics(confusion: np.ndarray) -> Dict[str, np.ndarray]:
+    """Metrics of confusion matrices (..., 4), NaN where a metric is undefined."""
+    tp, fp, fn, tn = (confusion[..., cell].astype(np.float64) for cell in range(4))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tp / (tp + fp)
+        recall = tp / (tp + fn)
+        return {
+            "accuracy": (tp + tn) / (tp + fp + fn + tn),
+            "precision": precision,
+            "recall": recall,
+            "f1": 2 * tp / (2 * tp + fp + fn)
+        }
+
+def bootstrap_intervals(verdicts: np.ndarray,
+                        labels: np.ndarray,
+                        samples: int = BOOTSTRAP_SAMPLES,
+                        confidence: float = CONFIDENCE,
+                        seed: int = 0,
+                        chunk_size: int = BOOTSTRAP_CHUNK_SIZE) -> Dict[str, np.ndarray]:
+    """
+    Percentile bootstrap intervals (runs, 2) of the metrics. The labeled
+    packages are resampled, every sample is a vector of package weights
+    and its confusion matrices are one matrix product for all runs.
+    """
+    labeled = labels != MISSING
+    cells = _cells(verdicts[:, labeled], labels[labeled]).astype(np.float32)
+    count = cells.shape[2]
+    rng = np.random.default_rng(seed)
+    confusion = np.empty((samples, verdicts.shape[0], 4))
+    for start in range(0, samples, chunk_size):
+        size = min(chunk_size, samples - start)
+        # times every package is drawn per sample, one bincount for the chunk
+        draws = rng.integers(0, count, size=(size, count)) + np.arange(size)[:, None] * count
+        weights = np.bincount(draws.ravel(), minlength=size * count).reshape(size, count).astype(np.float32)
+        # (4, runs, packages) x (packages, size) -> (size, runs, 4)
+        confusion[start:start + size] = np.transpose(cells @ weights.T, (2, 1, 0))
+    quantiles = [100 * (1 - confidence) / 2, 100 * (1 + confidence) / 2]
+    with np.errstate(invalid='ignore'):
+        return {metric: np.nanpercentile(values, quantiles, axis=0).T
+                for metric, values in classification_metrics(confusion).items()}
+
+def error_overlaps(verdicts: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """(runs, runs) labeled packages both runs got wrong, the errors of a run on the diagonal."""
+    errors = ((verdicts != labels) & (verdicts != MISSING) & (labels != MISSING)).astype(np.int32)
+    return errors @ errors.T
+
+def cohen_kappa(verdicts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(runs, runs) Cohen's kappa of every pair of runs and the packages both have a verdict for."""
+    answered = (verdicts != MISSING).astype(np.float64)
+    true = (verdicts == 1).astype(np.float64)
+    false = (verdicts == 0).astype(np.float64)
+    common = answered @ answered.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed = (true @ true.T + false @ false.T) / common
+        # true rates of both runs on the packages they share
+        true_rate = true @ answered.T / common
+        expected = true_rate * true_rate.T + (1 - true_rate) * (1 - true_rate.T)
+        return (observed - expected) / (1 - expected), common.astype(np.int64)
+
+def fleiss_kappa(verdicts: np.ndarray) -> Tuple[float, int]:
+    """Fleiss' kappa of all runs on the packages every run has a verdict for, and their number."""
+    complete = (verdicts != MISSING).all(axis=0)
+    raters, count = verdicts.shape[0], int(complete.sum())
+    if raters < 2 or not count:
+        return math.nan, count
+    true = (verdicts[:, complete] == 1).sum(axis=0).astype(np.float64)
+    false = raters - true
+    agreement = ((true * (true - 1) + false * (false - 1)) / (raters * (raters - 1))).mean()
+    true_share = true.sum() / (raters * count)
+    expected = true_share ** 2 + (1 - true_share) ** 2
+    if expected == 1:
+        return math.nan, count
+    return float((agreement - expected) / (1 - expected)), count
+
+def evaluate(matrix: VerdictMatrix,
+             bootstrap_samples: int = BOOTSTRAP_SAMPLES,
+             confidence: float = CONFIDENCE,
+             seed: int = 0) -> Dict:
+    """Report of the metrics per run, if labeled, and of the agreement of the runs."""
+    kappa, common = cohen_kappa(matrix.verdicts)
+    fleiss, complete = fleiss_kappa(matrix.verdicts)
+    report = {
+        "runs": matrix.runs,
+        "packages": len(matrix.packages),
+        "verdicts": (matrix.verdicts != MISSING).sum(axis=1).tolist(),
+        "cohen_kappa": kappa.tolist(),
+        "common_packages": common.tolist(),
+        "fleiss_kappa": fleiss,
+        "fleiss_packages": complete
+    }
+    if matrix.labels is None:
+        return report
+
+    labeled = matrix.labels != MISSING
+    confusion = confusion_matrices(matrix.verdicts, matrix.labels)
+    metrics = classification_metrics(confusion)
+    intervals = bootstrap_intervals(matrix.verdicts, matrix.labels, bootstrap_samples, confidence, seed) \
+        if bootstrap_samples and labeled.any() else {}
+    errors = (matrix.verdicts != matrix.labels) & (matrix.verdicts != MISSING) & labeled
+    wrong_runs = errors.sum(axis=0)
+    report.update({
+        "labeled": int(labeled.sum()),
+        "confidence": confidence,
+        "bootstrap_samples": bootstrap_samples,
+        "missing": ((matrix.verdicts == MISSING) & labeled).sum(axis=1).tolist(),
+        "confusion": confusion.tolist(),
+        "metrics": {metric: values.tolist() for metric, values in metrics.items()},
+        "intervals": {metric: values.tolist() for metric, values in intervals.items()},
+        "error_overlaps": error_overlaps(matrix.verdicts, matrix.labels).tolist(),
+        "unique_errors": (errors & (wrong_runs == 1)).sum(axis=1).tolist(),
+        "errors_of_all_runs": int((wrong_runs == len(matrix.runs)).sum())
+    })
+    return report
+
+def _number(value: float) -> str:
+    return "-" if value is None or math.isnan(value) else f"{value:.3f}"
+
+def print_report(report: Dict, file: TextIO = sys.stdout) -> None:
+    """Print the report as tables."""
+    runs = report["runs"]
+    width = max(len(f"{idx} {run}") for idx, run in enumerate(runs)) + 2
+    print(f"{len(runs)} runs, {report['packages']} packages", file=file)
+    if "metrics" in report:
+        intervals = f", {report['confidence']:.0%} intervals of {report['bootstrap_samples']} " \
+                    f"bootstrap samples" if report["intervals"] else ""
+        print(f"\n{report['labeled']} labeled packages{intervals}", file=file)
+        print("run".ljust(width) + "    tp    fp    fn    tn  missing  "
+              + "".join(metric.ljust(22) for metric in METRICS), file=file)
+        for idx, run in enumerate(runs):
+            cells = "".join(f"{cell:6d}" for cell in report["confusion"][idx])
+            metrics = ""
+            for metric in METRICS:
+                value = _number(report["metrics"][metric][idx])
+                if metric in report["intervals"]:
+                    low, high = report["intervals"][metric][idx]
+                    value += f" ({_number(low)}-{_number(high)})"
+                metrics += value.ljust(22)
+            print(f"{run.ljust(width)}{cells}{report['missing'][idx]:9d}  {metrics}", file=file)
+
+        print(f"\nErrors in common (diagonal: errors, unique: errors no other run made), " \
+              f"{report['errors_of_all_runs']} errors of all runs", file=file)
+        print("run".ljust(width) + "".join(f"{idx:>8d}" for idx in range(len(runs))) + "  unique", file=file)
+        for idx, run in enumerate(runs):
+            print(f"{idx} {run}".ljust(width) + "".join(f"{count:8d}" for count in report["error_overlaps"][idx])
+                  + f"{report['unique_errors'][idx]:8d}", file=file)
+
+    print(f"\nCohen's kappa (packages with verdicts: {', '.join(map(str, report['verdicts']))})", file=file)
+    print("run".ljust(width) + "".join(f"{idx:>8d}" for idx in range(len(runs))), file=file)
+    for idx, run in enumerate(runs):
+        print(f"{idx} {run}".ljust(width) + "".join(f"{_number(kappa):>8s}" for kappa in report["cohen_kappa"][idx]),
+              file=file)
+    print(f"\nFleiss' kappa: {_number(report['fleiss_kappa'])} " \
+          f"on {report['fleiss_packages']} packages with verdicts of all runs", file=file)
+
+def _json_value(value):
+    # NaN is no JSON value
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, list):
+        return [_json_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _json_value(item) for key, item in value.items()}
+    return value
+
+def write_report(report: Dict, report_file: str) -> None:
+    with open(report_file, mode='w') as file:
+        json.dump(_json_value(report), file, indent=2)
+
+def run_names(results_files: List[str]) -> List[str]:
+    """File names of the results files, the paths if file names repeat."""
+    names = [os.path.splitext(os.path.basename(results_file))[0] for results_file in results_files]
+    return names if len(set(names)) == len(names) else list(results_files)
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate results files against labels and each other.")
+    parser.add_argument("results_files", type=str, nargs="+", help="CSV results files to evaluate.")
+    parser.add_argument("--labels", type=str, default=None,
+                        help="CSV file with the package and the attribute as label (optional).")
+    parser.add_argument("--attribute", type=str, default=config.BOOLEAN_ATTRIBUTES[0],
+                        help="Boolean attribute to evaluate (default: %(default)s).")
+    parser.add_argument("--label_attribute", type=str, default=None,
+                        help="Column of the labels (default: the attribute).")
+    parser.add_argument("--bootstrap_samples", type=int, default=BOOTSTRAP_SAMPLES,
+                        help="Bootstrap samples of the intervals, 0 for none (default: %(default)s).")
+    parser.add_argument("--confidence", type=float, default=CONFIDENCE,
+                        help="Confidence level of the intervals (default: %(default)s).")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the bootstrap samples.")
+    parser.add_argument("--output", type=str, default=None, help="JSON file to write the report to (optional).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not 0 < args.confidence < 1:
+        sys.exit(f"Confidence {args.confidence} is not between 0 and 1.")
+    start = perf_counter()
+    try:
+        runs = {name: read_verdicts(results_file, args.attribute)
+                for name, results_file in zip(run_names(args.results_files), args.results_files)}
+        labels = read_verdicts(args.labels, args.label_attribute or args.attribute) if args.labels else None
+    except (OSError, ValueError) as e:
+        sys.exit(f"Cannot read results: {e}")
+    matrix = align_verdicts(runs, labels)
+    log.info(f"Read {len(runs)} runs of {len(matrix.packages)} packages in {perf_counter() - start:,.2f}s")
+
+    report = evaluate(matrix, args.bootstrap_samples, args.confidence, args.seed)
+    log.info(f"Evaluated in {perf_counter() - start:,.2f}s")
+    print_report(report)
+    if args.output:
+        write_report(report, args.output)
+
+if __name__ == "__main__":
+    main()
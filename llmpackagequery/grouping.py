@@ -0,0 +1,254 @@
+import logging
+import re
+import sys
+import zlib
+
+from itertools import islice
+from time import time
+from typing import Dict, Iterable, List, Tuple
+
+from packages import read_packages
+from request import RequestManger
+from rules import split_dependencies
+from writer import CHECKPOINT_FILE, CSVResultsWriter, DECIDED_BY_ATTRIBUTE, format_results, split_results
+
+log = logging.getLogger(__name__)
+
+# prefixes and suffixes of sub-packages built from the same source package
+SOURCE_PREFIXES = ("mingw32-", "mingw64-", "ucrt64-")
+SOURCE_SUFFIXES = ("-libs", "-devel", "-static", "-common", "-doc", "-docs",
+                   "-javadoc", "-tools", "-utils", "-data", "-headers")
+WORD = re.compile(r"[a-z0-9]{3,}")
+# annotation of dependencies known to be relevant in topological order
+RELEVANT_DEPENDENCY = "{dependency} (cryptographic)"
+PROPAGATED_DECIDER = "propagated:{representative}"
+
+def source_name(name: str) -> str:
+    """Name of the source package a sub-package is most likely built from."""
+    stripped = True
+    while stripped:
+        stripped = False
+        for prefix in SOURCE_PREFIXES:
+            if name.startswith(prefix):
+                name, stripped = name[len(prefix):], True
+        for suffix in SOURCE_SUFFIXES:
+            if name.endswith(suffix) and len(name) > len(suffix):
+                name, stripped = name[:-len(suffix)], True
+    return name
+
+def description_similarity(words_a: frozenset, words_b: frozenset) -> float:
+    """Jaccard similarity of two word sets."""
+    if not words_a and not words_b:
+        return 1.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+class PackageGraph:
+    """
+    Dependency graph of a package list. Package names are interned,
+    every package appears once however often it is referenced.
+    """
+    _dependencies: Dict[str, Tuple[str, ...]]
+
+    def __init__(self, rows: Iterable[List[str]]) -> None:
+        self._dependencies = {
+            sys.intern(row[0]): tuple(sys.intern(d) for d in split_dependencies(row[3]))
+            for row in rows}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._dependencies
+
+    def dependencies(self, name: str) -> Tuple[str, ...]:
+        """Dependencies of a package which are part of the list."""
+        return tuple(d for d in self._dependencies.get(name, ()) if d in self._dependencies)
+
+    def levels(self, names: List[str], representatives: Dict[str, str]) -> List[List[str]]:
+        """
+        Order the given packages in levels, the packages of a level only
+        depend on clusters of earlier levels. Dependencies within a cluster
+        and cycles are ignored.
+        """
+        level: Dict[str, int] = {}
+        for root in names:
+            # iterative depth first search, packages on the stack break cycles
+            stack = [(root, False)]
+            on_stack = set()
+            while stack:
+                name, expanded = stack.pop()
+                if name in level:
+                    continue
+                dependencies = [representatives.get(d, d) for d in self.dependencies(name)
+                                if representatives.get(d, d) != representatives.get(name, name)]
+                if expanded:
+                    on_stack.discard(name)
+                    level[name] = 1 + max((level.get(d, -1) for d in dependencies), default=-1)
+                    continue
+                on_stack.add(name)
+                stack.append((name, True))
+                stack.extend((d, False) for d in dependencies if d not in level and d not in on_stack)
+
+        levels: List[List[str]] = [[] for _ in range(1 + max((level[n] for n in names), default=-1))]
+        for name in names:
+            levels[level[name]].append(name)
+        return levels
+
+def cluster_packages(rows: List[List[str]], similarity: float) -> Dict[str, str]:
+    """
+    Cluster sub-packages of the same source package with similar
+    descriptions. Returns the representative of every package, the
+    package named like the source is preferred as representative.
+    """
+    groups: Dict[str, List[List[str]]] = {}
+    for row in rows:
+        groups.setdefault(source_name(row[0]), []).append(row)
+
+    representatives: Dict[str, str] = {}
+    for source, members in groups.items():
+        members.sort(key=lambda row: (row[0] != source, len(row[0]), row[0]))
+        clusters: List[Tuple[str, frozenset]] = []
+        for row in members:
+            words = frozenset(WORD.findall(row[2].lower()))
+            for representative, representative_words in clusters:
+                if description_similarity(words, representative_words) >= similarity:
+                    representatives[row[0]] = representative
+                    break
+            else:
+                clusters.append((row[0], words))
+                representatives[row[0]] = row[0]
+
+    return representatives
+
+def verify_sampled(name: str, rate: float) -> bool:
+    """Deterministically select a share of the packages for verification."""
+    return zlib.crc32(name.encode()) / 0xFFFFFFFF < rate
+
+class GroupingRequestManger(RequestManger):
+    """
+    Query one representative per cluster of near-duplicate sub-packages
+    and propagate its result to the other members. A sample of the members
+    can be queried as well to verify the propagation. In topological order
+    packages are queried after the clusters they depend on, dependencies
+    already known as relevant are marked in the prompt.
+    The package list is read completely and the results are written in
+    input order at the end, runs cannot be resumed.
+    """
+    _decision_attribute: str
+    _similarity: float
+    _verify_rate: float
+    _topological: bool
+    # rows as read from the package list by name
+    _rows_by_name: Dict[str, List[str]]
+
+    def __init__(self,
+                 *args,
+                 decision_attribute: str,
+                 similarity: float = 0.5,
+                 verify_rate: float = 0.0,
+                 topological: bool = False,
+                 **kwargs) -> None:
+
+        super().__init__(*args, **kwargs)
+        self._decision_attribute = decision_attribute
+        self._similarity = similarity
+        self._verify_rate = verify_rate
+        self._topological = topological
+        self._rows_by_name = {}
+
+    def write_attributes(self) -> List[str]:
+        return self._query_handler.response_parser.attributes_list + [DECIDED_BY_ATTRIBUTE]
+
+    def _model_decided(self, results: str) -> str:
+        # results of the model are always marked with the model id
+        attributes = self._query_handler.response_parser.attributes_list
+        return format_results(split_results(results, len(attributes)) + [self._query_handler.model_id])
+
+    def _with_evidence(self, row: List[str], relevant: set) -> List[str]:
+        # mark dependencies which are already known as relevant
+        dependencies = [RELEVANT_DEPENDENCY.format(dependency=d) if d in relevant else d
+                        for d in split_dependencies(row[3])]
+        return row[:3] + [", ".join(dependencies)] + row[4:]
+
+    def _original_row(self, row: List[str]) -> List[str]:
+        # evidence only changes the prompt, other decisions use the listed row
+        return self._rows_by_name.get(row[0], row)
+
+    def _previous_result(self, row: List[str]) -> str | None:
+        return super()._previous_result(self._original_row(row))
+
+    def _pre_classify(self, row: List[str]) -> str | None:
+        return super()._pre_classify(self._original_row(row))
+
+    def run(self):
+        write_attributes = self.write_attributes()
+        attributes = self._query_handler.response_parser.attributes_list
+        decision_index = attributes.index(self._decision_attribute)
+
+        # clustering needs the whole package list
+        rows = list(islice(read_packages(self._package_file_in), self._query_restriction))
+        rows_by_name = self._rows_by_name = {row[0]: row for row in rows}
+
+        graph = PackageGraph(rows)
+        representatives = cluster_packages(rows, self._similarity)
+        members: Dict[str, List[str]] = {}
+        for name, representative in representatives.items():
+            members.setdefault(representative, []).append(name)
+
+        queried = [row[0] for row in rows
+                   if representatives[row[0]] == row[0] or verify_sampled(row[0], self._verify_rate)]
+        log.info(f"Querying {len(queried)} of {len(rows)} packages in " \
+                 f"{len(members)} clusters.")
+
+        levels = graph.levels(queried, representatives) if self._topological else [queried]
+        results: Dict[str, List[str]] = {}
+        relevant = set()
+        start_time = time()
+        idx = -1
+        for level_idx, level in enumerate(levels):
+            if self._topological:
+                log.info(f"Querying level {level_idx} with {len(level)} packages.")
+            level_rows = [self._with_evidence(rows_by_name[name], relevant)
+                          if self._topological else rows_by_name[name] for name in level]
+
+            for offset, result in self._ordered_results(enumerate(level_rows)):
+                idx += 1
+                name = level[offset]
+                results[name] = split_results(result, len(write_attributes))
+
+                # propagate the result of a representative to the members
+                # of its cluster which are not decided by the rules
+                if representatives[name] == name:
+                    for member in members[name]:
+                        if member in results:
+                            continue
+                        pre_classified = self._pre_classify(rows_by_name[member])
+                        if pre_classified is not None:
+                            results[member] = split_results(pre_classified, len(write_attributes))
+                        else:
+                            results[member] = [member] + results[name][1:-1] + \
+                                [PROPAGATED_DECIDER.format(representative=name)]
+                for member in members.get(name, [name]):
+                    if results[member][decision_index] == "True":
+                        relevant.add(member)
+
+                self._log_progress(idx, start_time)
+
+        # compare the verified members with their representative
+        verified = [name for name in queried if representatives[name] != name]
+        disagreements = [name for name in verified
+                         if results[name][decision_index] !=
+                            results[representatives[name]][decision_index]]
+        if verified:
+            log.info(f"Verified {len(verified)} propagated packages, " \
+                     f"{len(disagreements)} disagree with their representative: {disagreements}")
+
+        with open(self._package_file_out, mode='w', newline='') as file_write:
+            with CSVResultsWriter(
+                    file_dst=file_write,
+                    package_header=write_attributes,
+                    checkpoint_file=CHECKPOINT_FILE.format(csv_file=self._package_file_out),
+                    recorder=self._result_recorder) as writer:
+                for offset, row in enumerate(rows):
+                    with self._metrics.timer("write"):
+                        writer.write_results(format_results(results[row[0]]), input_offset=offset + 1)
+
+        log.info(f"Propagated results to {len(rows) - len(queried)} packages.")
+        self._log_summary()
@@ -0,0 +1,57 @@
+import csv
+import logging
+import threading
+
+from typing import Dict, List, Tuple
+
+from packages import read_packages
+
+log = logging.getLogger(__name__)
+
+# columns of the package list compared between two runs:
+# name, version, description, dependencies
+PackageMetadata = Tuple[str, str, str, str]
+
+def package_metadata(row: List[str]) -> PackageMetadata:
+    """Metadata of a package list row which is sent to the model."""
+    return (row[0], row[1], row[2], row[3])
+
+class PreviousRun:
+    """
+    Results of a previous run together with the package list it was
+    created from. Results of packages whose metadata did not change are
+    carried forward instead of querying the model again.
+    """
+    _metadata: Dict[str, PackageMetadata]
+    _results: Dict[str, List[str]]
+    _lock: threading.Lock
+    carried: int = 0
+
+    def __init__(self,
+                 package_list: str,
+                 results_file: str,
+                 attributes: List[str]) -> None:
+
+        self._lock = threading.Lock()
+        self._metadata = {row[0]: package_metadata(row) for row in read_packages(package_list)}
+
+        with open(results_file, mode='r', newline='') as file:
+            result_reader = csv.reader(file, delimiter=',', quotechar='"')
+            header = next(result_reader, None)
+            if header != list(attributes):
+                raise ValueError(f"Header of {results_file} does not match the attributes {attributes}.")
+            # rows without any answer failed in the previous run, query them again
+            self._results = {row[0]: row for row in result_reader
+                             if row and any(row[1:])}
+
+        log.info(f"Loaded {len(self._results)} previous results of {len(self._metadata)} packages.")
+
+    def lookup(self, row: List[str]) -> List[str] | None:
+        """Return the previous result row if the package did not change."""
+        previous = self._results.get(row[0])
+        if previous is None or self._metadata.get(row[0]) != package_metadata(row):
+            return None
+
+        with self._lock:
+            self.carried += 1
+        return previous
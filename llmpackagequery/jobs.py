@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+"""
+Run many queries, e.g. all operating systems, models and templates of an
+evaluation, in one process from a job file. Jobs of the same model share
+its client or loaded model, SDKs and models are loaded once per run.
+The driver never waits for input and suits cron, CI and job schedulers.
+
+Job file (JSON), defaults apply to every job, further keys of a job are
+passed to request.execute:
+    {
+        "defaults": {"base_package_list": "../csv/packages.csv", "max_in_flight": 8},
+        "jobs": [
+            {"os": "Fedora", "model": "openai.gpt-5"},
+            {"os": "Ubuntu", "model": "openai.gpt-5", "template_alternative": "short"},
+            {"os": "Fedora", "model": "ollama.deepseek-r1:latest", "csv_file_out": "./csv/fedora.csv"}
+        ]
+    }
+
+Example:
+    python3 jobs.py evaluation.json
+"""
+import time
+# start of the run, the startup time until the first job is reported
+startup_time = time.perf_counter()
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+from typing import Any, Dict, List, Tuple
+
+import config
+import request
+import writer
+from query import QueryHandlerCallable
+
+log = logging.getLogger(__name__)
+
+# job keys not passed to request.execute
+JOB_KEYS = ("os", "model", "template_alternative", "api_key", "host", "api_base_url",
+            "stream", "structured_output", "prompt_template_file", "csv_file_out", "attributes")
+
+class JobRunner:
+    """
+    Run the jobs of a job file one after the other. The first handler
+    of a model and endpoint is kept, the handlers of later jobs borrow
+    its client or loaded model.
+    """
+    _handlers: Dict[Tuple, QueryHandlerCallable]
+    _timestamp_string: str
+
+    def __init__(self) -> None:
+        self._handlers = {}
+        self._timestamp_string = time.strftime("%Y%m%d_%H%M%S")
+
+    def _query_handler(self, job: Dict[str, Any], query_stub: str, llm_model: str, api_key: str | None,
+                       prompt_template_file: str, attributes: List[str]) -> QueryHandlerCallable:
+        client_key = (query_stub, llm_model, job.get("host"), job.get("api_base_url"), api_key)
+        query_handler = request.create_query_handler(
+            query_stub=query_stub,
+            llm_model=llm_model,
+            prompt_template_file=prompt_template_file,
+            attributes=attributes,
+            api_key=api_key,
+            host=job.get("host", config.OLLAMA_HOST),
+            api_base_url=job.get("api_base_url"),
+            stream=job.get("stream", False),
+            structured_output=job.get("structured_output", False),
+            shared_with=self._handlers.get(client_key))
+        self._handlers.setdefault(client_key, query_handler)
+        return query_handler
+
+    def run_job(self, job: Dict[str, Any]) -> None:
+        """Run a single job, job keys as described in the job file."""
+        query_stub, llm_model = job["model"].split('.', 1)
+        os_to_prompt = job["os"].lower()
+        tpl_alt = f"-{job['template_alternative']}" if job.get("template_alternative") else ""
+        prompt_template_file = job.get("prompt_template_file") or config.QUERY_TEMPLATE_FILE.format(
+            os=os_to_prompt,
+            llm_model=llm_model,
+            query_template_path=config.QUERY_TEMPLATE_PATH,
+            template_alternative=tpl_alt)
+        csv_file_out = job.get("csv_file_out") or config.CSV_FILE.format(
+            os=os_to_prompt,
+            csv_base_path=config.CSV_BASE_PATH,
+            timestamp_string=self._timestamp_string,
+            llm_model=llm_model,
+            template_alternative=tpl_alt)
+        attributes = job.get("attributes", writer.DEFAULT_PACKAGE_HEADER)
+        api_key = job.get("api_key") or os.getenv(config.API_KEY_ENV.get(query_stub, ""))
+        if not os.path.exists(prompt_template_file):
+            raise FileNotFoundError(f"Prompt template file {prompt_template_file} does not exist.")
+
+        start = time.perf_counter()
+        query_handler = self._query_handler(job, query_stub, llm_model, api_key,
+                                            prompt_template_file, attributes)
+        log.info(f"Job {job['os']} {job['model']}{tpl_alt}: query handler ready in " \
+                 f"{time.perf_counter() - start:,.2f}s, writing to {csv_file_out}")
+
+        execute_parameters = {
+            "max_in_flight": config.MAX_IN_FLIGHT.get(query_stub, 1),
+            "rate_limits": dict(config.RATE_LIMITS),
+            **{key: value for key, value in job.items() if key not in JOB_KEYS}
+        }
+        request.execute(
+            query_stub=query_stub,
+            llm_model=llm_model,
+            prompt_template_file=prompt_template_file,
+            csv_file_out=csv_file_out,
+            attributes=attributes,
+            api_key=api_key,
+            host=job.get("host", config.OLLAMA_HOST),
+            api_base_url=job.get("api_base_url"),
+            stream=job.get("stream", False),
+            structured_output=job.get("structured_output", False),
+            query_handler=query_handler,
+            **execute_parameters)
+        log.info(f"Job {job['os']} {job['model']}{tpl_alt} done in {time.perf_counter() - start:,.2f}s")
+
+    def run(self, jobs: List[Dict[str, Any]]) -> int:
+        """Run all jobs, a failed job is logged and the next one started. Returns the failures."""
+        failures = 0
+        for idx, job in enumerate(jobs):
+            log.info(f"Starting job {idx + 1}/{len(jobs)}")
+            try:
+                self.run_job(job)
+            except Exception as e:
+                failures += 1
+                log.error(f"Job {idx + 1} ({job.get('os')} {job.get('model')}) failed: {e}")
+        return failures
+
+def read_jobs(job_file: str) -> List[Dict[str, Any]]:
+    """Read the jobs of a job file with its defaults applied."""
+    with open(job_file, mode='r') as file:
+        job_spec = json.load(file)
+    defaults = job_spec.get("defaults", {})
+    jobs = [{**defaults, **job} for job in job_spec.get("jobs", [])]
+    for job in jobs:
+        if "os" not in job or "model" not in job:
+            raise ValueError(f"Job {job} needs an os and a model.")
+    return jobs
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the query jobs of a job file.")
+    parser.add_argument("job_file", type=str,
+                        help="JSON file with the jobs, see the module documentation.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        jobs = read_jobs(args.job_file)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Cannot read job file {args.job_file}: {e}")
+    log.info(f"Startup: {time.perf_counter() - startup_time:,.2f}s, {len(jobs)} jobs")
+
+    failures = JobRunner().run(jobs)
+    log.info(f"Finished {len(jobs) - failures}/{len(jobs)} jobs in " \
+             f"{time.perf_counter() - startup_time:,.2f}s")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
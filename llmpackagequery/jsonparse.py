@@ -0,0 +1,273 @@
+import json
+import re
+
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+# words of the model outputs standing for a JSON literal
+LITERALS = {
+    "true": True, "false": False, "null": None, "none": None
+}
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+# characters relevant to find the objects of a text
+OBJECT_TOKENS = re.compile(r'[{}"\'\\]')
+# whitespace, comments and "..." placeholders between the tokens
+SKIPPED = re.compile(r'(?:\s+|//[^\n]*|/\*.*?(?:\*/|$)|\.\.\.)*', re.DOTALL)
+# string content up to the closing quote or the end of the text
+STRINGS = {
+    '"': re.compile(r'"((?:[^"\\]|\\.)*)(?:"|\\?$)', re.DOTALL),
+    "'": re.compile(r"'((?:[^'\\]|\\.)*)(?:'|\\?$)", re.DOTALL)
+}
+# unquoted word up to the next delimiter or comment
+WORD = re.compile(r'(?:[^,:}\]\r\n/]|/(?!/))*')
+ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|.)', re.DOTALL)
+# reasoning of a model before the answer
+THINK_START = "<think>"
+THINK_END = "</think>"
+
+_decoder = json.JSONDecoder()
+
+def _value_start(text: str, pos: int) -> bool:
+    # a single quote starts a string only in place of a key or value,
+    # unlike an apostrophe within an unquoted word
+    pos -= 1
+    while pos >= 0 and text[pos].isspace():
+        pos -= 1
+    return pos < 0 or text[pos] in "{[,:"
+
+class _ObjectScan:
+    """
+    Incremental scan for top level {...} objects, braces in double or
+    single quoted strings are ignored. The state is kept between calls
+    so that a growing text is scanned once.
+    """
+    # escaped position, nesting depth, start of the open object and
+    # quote of the open string
+    skip: int
+    depth: int
+    start: int
+    quote: str | None
+
+    def __init__(self) -> None:
+        self.skip = 0
+        self.depth = 0
+        self.start = 0
+        self.quote = None
+
+    def scan(self, text: str, pos: int = 0) -> Iterator[Tuple[int, int]]:
+        """Yield the start and end of every object closed from pos on."""
+        for match in OBJECT_TOKENS.finditer(text, pos):
+            pos = match.start()
+            if pos < self.skip:
+                # escaped character
+                continue
+            char = match.group()
+            if self.quote:
+                if char == "\\":
+                    self.skip = pos + 2
+                elif char == self.quote:
+                    self.quote = None
+            elif char in STRINGS and self.depth and (char == '"' or _value_start(text, pos)):
+                self.quote = char
+            elif char == "{":
+                if self.depth == 0:
+                    self.start = pos
+                self.depth += 1
+            elif char == "}" and self.depth:
+                self.depth -= 1
+                if self.depth == 0:
+                    yield self.start, pos + 1
+
+def find_objects(text: str, closed_only: bool = True) -> List[str]:
+    """
+    Collect all top level {...} objects of a text in one pass, braces in
+    strings are ignored. Unless closed_only is set, an object left open
+    at the end of the text is returned as well.
+    """
+    scan = _ObjectScan()
+    objects = [text[start:end] for start, end in scan.scan(text)]
+    if scan.depth and not closed_only:
+        objects.append(text[scan.start:])
+    return objects
+
+def _unescape(match: re.Match) -> str:
+    escape = match.group(1)
+    if len(escape) == 5:
+        return chr(int(escape[1:], 16))
+    return ESCAPES.get(escape, escape)
+
+class _TolerantScanner:
+    """
+    Single pass recursive descent over JSON as written by models: single
+    quoted strings, bare True/False/None, unquoted words, trailing commas,
+    // and /* */ comments, "..." placeholders and unclosed strings,
+    objects and arrays are accepted.
+    """
+    _text: str
+    _pos: int
+
+    def __init__(self, text: str) -> None:
+        self._text = text
+        self._pos = 0
+
+    def _skip(self) -> None:
+        self._pos = SKIPPED.match(self._text, self._pos).end()
+
+    def value(self) -> Any:
+        self._skip()
+        if self._pos >= len(self._text):
+            return None
+        char = self._text[self._pos]
+        if char == "{":
+            return self._object()
+        if char == "[":
+            return self._array()
+        if char in STRINGS:
+            return self._string(char)
+        return self._word()
+
+    def _object(self) -> Dict[str, Any]:
+        data = {}
+        self._pos += 1
+        while True:
+            self._skip()
+            if self._pos >= len(self._text):
+                return data
+            char = self._text[self._pos]
+            if char == "}":
+                self._pos += 1
+                return data
+            if char == ",":
+                self._pos += 1
+                continue
+            key = self._string(char) if char in STRINGS else self._word()
+            self._skip()
+            if self._text.startswith(":", self._pos):
+                self._pos += 1
+                data[str(key)] = self.value()
+            else:
+                data[str(key)] = None
+
+    def _array(self) -> List[Any]:
+        items = []
+        self._pos += 1
+        while True:
+            self._skip()
+            if self._pos >= len(self._text):
+                return items
+            char = self._text[self._pos]
+            if char == "]":
+                self._pos += 1
+                return items
+            if char == ",":
+                self._pos += 1
+                continue
+            if char == "}":
+                # array closed by the enclosing object
+                return items
+            items.append(self.value())
+
+    def _string(self, quote: str) -> str:
+        match = STRINGS[quote].match(self._text, self._pos)
+        self._pos = match.end()
+        content = match.group(1)
+        return ESCAPE.sub(_unescape, content) if "\\" in content else content
+
+    def _word(self) -> Any:
+        # literals, numbers and unquoted strings
+        match = WORD.match(self._text, self._pos)
+        if match.end() == self._pos:
+            # a stray delimiter
+            self._pos += 1
+            return None
+        self._pos = match.end()
+        word = match.group().strip()
+        if word.lower() in LITERALS:
+            return LITERALS[word.lower()]
+        try:
+            return int(word)
+        except ValueError:
+            pass
+        try:
+            return float(word)
+        except ValueError:
+            return word
+
+def loads_tolerant(text: str) -> Any:
+    """Parse JSON as written by models, see _TolerantScanner."""
+    return _TolerantScanner(text).value()
+
+class ObjectDetector:
+    """
+    Detect the first complete object of a streamed response. The text is
+    fed in chunks as it is generated, feed returns True as soon as a top
+    level object accepted by the predicate is closed. A <think> block at
+    the start of the response is skipped, the reasoning of a model may
+    contain objects.
+    """
+    _accept: Callable[[Dict[str, Any]], bool]
+    _text: str
+    # scan position and state of the scan
+    _pos: int
+    _scan: _ObjectScan
+    _reasoning: bool | None
+    done: bool
+
+    def __init__(self, accept: Callable[[Dict[str, Any]], bool]) -> None:
+        self._accept = accept
+        self._text = ""
+        self._pos = 0
+        self._scan = _ObjectScan()
+        self._reasoning = None
+        self.done = False
+
+    def feed(self, chunk: str) -> bool:
+        """Add the next chunk, returns True once an accepted object is complete."""
+        if self.done or not chunk:
+            return self.done
+        self._text += chunk
+
+        if self._reasoning is None:
+            # wait until the start of the response is known
+            head = self._text.lstrip()
+            if len(head) < len(THINK_START) and THINK_START.startswith(head):
+                return False
+            self._reasoning = head.startswith(THINK_START)
+        if self._reasoning:
+            end = self._text.find(THINK_END, self._pos)
+            if end < 0:
+                # the end tag may be split over two chunks
+                self._pos = max(self._pos, len(self._text) - len(THINK_END))
+                return False
+            self._pos = end + len(THINK_END)
+            self._reasoning = False
+
+        for start, end in self._scan.scan(self._text, self._pos):
+            if any(self._accept(data) for data in load_objects(self._text[start:end])):
+                self.done = True
+                return True
+        self._pos = len(self._text)
+        return False
+
+def load_objects(text: str) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the JSON objects of a text in order. Well-formed objects are
+    decoded strictly in place, from the first malformed object on the
+    objects are found by find_objects and parsed by the tolerant scanner,
+    including an object left open at the end of the text.
+    """
+    pos = text.find("{")
+    while pos >= 0:
+        try:
+            data, end = _decoder.raw_decode(text, pos)
+        except ValueError:
+            break
+        if isinstance(data, dict):
+            yield data
+        pos = text.find("{", end)
+    else:
+        return
+
+    for json_str in find_objects(text[pos:], closed_only=False):
+        data = loads_tolerant(json_str)
+        if isinstance(data, dict):
+            yield data
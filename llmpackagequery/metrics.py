@@ -0,0 +1,250 @@
+import json
+import logging
+import os
+import random
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, time
+from typing import Dict, Iterator, Tuple
+
+log = logging.getLogger(__name__)
+
+# stages of a package request
+STAGES = ("startup", "render", "provider", "time_to_result", "parse", "write", "service")
+# upper bounds of the timing histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRICS_PREFIX = "llmpackagequery"
+# durations kept per stage to estimate its quantiles
+RESERVOIR_SIZE = 4096
+
+class _Timing:
+    """
+    Histogram of the durations of one stage and a uniform sample of them
+    (reservoir sampling) to estimate quantiles in bounded memory.
+    """
+    count: int
+    total: float
+    maximum: float
+    buckets: list
+    samples: list
+    _random: random.Random
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.samples = []
+        self._random = random.Random(0)
+
+    def quantile(self, q: float) -> float | None:
+        """Estimated q quantile of the durations, None without any."""
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        if len(self.samples) < RESERVOIR_SIZE:
+            self.samples.append(seconds)
+        else:
+            idx = self._random.randrange(self.count)
+            if idx < RESERVOIR_SIZE:
+                self.samples[idx] = seconds
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[idx] += 1
+                return
+        self.buckets[-1] += 1
+
+class Metrics:
+    """
+    Run-time metrics of the request pipeline: durations per stage,
+    counters with a label (e.g. retries by cause, parse failures by
+    parser), requests in flight and token usage per model.
+    """
+    _lock: threading.Lock
+    _timings: Dict[str, _Timing]
+    _counters: Dict[Tuple[str, str], int]
+    _tokens: Dict[Tuple[str, str], int]
+    _in_flight: int
+    _started: float
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._timings = defaultdict(_Timing)
+        self._counters = defaultdict(int)
+        self._tokens = defaultdict(int)
+        self._in_flight = 0
+        self._started = time()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._timings[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """Measure the duration of a stage."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start)
+
+    @contextmanager
+    def in_flight(self) -> Iterator[None]:
+        """Count a provider request while it is executed."""
+        with self._lock:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    @property
+    def requests_in_flight(self) -> int:
+        return self._in_flight
+
+    def count(self, name: str, label: str = "", value: int = 1) -> None:
+        with self._lock:
+            self._counters[(name, label)] += value
+
+    def record_usage(self, model: str, usage: Tuple[int, int] | None) -> None:
+        """Record the prompt and completion tokens of a response."""
+        if usage is None:
+            return
+        with self._lock:
+            self._tokens[(model, "prompt")] += usage[0] or 0
+            self._tokens[(model, "completion")] += usage[1] or 0
+
+    def summary(self) -> Dict:
+        """Current state of all metrics."""
+        with self._lock:
+            counters: Dict[str, Dict[str, int]] = defaultdict(dict)
+            for (name, label), value in self._counters.items():
+                counters[name][label or "total"] = value
+            tokens: Dict[str, Dict[str, int]] = defaultdict(dict)
+            for (model, kind), value in self._tokens.items():
+                tokens[model][kind] = value
+            return {
+                "timestamp": time(),
+                "uptime": time() - self._started,
+                "in_flight": self._in_flight,
+                "stages": {stage: {
+                    "count": timing.count,
+                    "total": timing.total,
+                    "mean": timing.total / timing.count if timing.count else None,
+                    "max": timing.maximum,
+                    "p50": timing.quantile(0.5),
+                    "p99": timing.quantile(0.99),
+                    "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], timing.buckets))
+                } for stage, timing in self._timings.items()},
+                "counters": dict(counters),
+                "tokens": dict(tokens)
+            }
+
+    def prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines.append(f"# TYPE {METRICS_PREFIX}_stage_seconds histogram")
+            for stage, timing in self._timings.items():
+                cumulative = 0
+                for bound, count in zip([str(b) for b in BUCKETS] + ["+Inf"], timing.buckets):
+                    cumulative += count
+                    lines.append(f'{METRICS_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{METRICS_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {timing.total}')
+                lines.append(f'{METRICS_PREFIX}_stage_seconds_count{{stage="{stage}"}} {timing.count}')
+
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name}_total counter")
+                for (counter, label), value in self._counters.items():
+                    if counter == name:
+                        labels = f'{{label="{label}"}}' if label else ""
+                        lines.append(f"{METRICS_PREFIX}_{name}_total{labels} {value}")
+
+            lines.append(f"# TYPE {METRICS_PREFIX}_tokens_total counter")
+            for (model, kind), value in self._tokens.items():
+                lines.append(f'{METRICS_PREFIX}_tokens_total{{model="{model}",kind="{kind}"}} {value}')
+
+            lines.append(f"# TYPE {METRICS_PREFIX}_in_flight gauge")
+            lines.append(f"{METRICS_PREFIX}_in_flight {self._in_flight}")
+        return "\n".join(lines) + "\n"
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    server: "MetricsExporter"
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def do_GET(self):
+        data = self.server.metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class MetricsExporter(ThreadingHTTPServer):
+    """
+    Export the metrics periodically as JSON summary to a file and,
+    if a port is given, as Prometheus text endpoint.
+    """
+    daemon_threads = True
+    metrics: Metrics
+    _summary_file: str | None
+    _interval: float
+    _stopped: threading.Event
+    _workers: list
+
+    def __init__(self,
+                 metrics: Metrics,
+                 summary_file: str | None = None,
+                 interval: float = 60.0,
+                 port: int | None = None) -> None:
+
+        self.metrics = metrics
+        self._summary_file = summary_file
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._workers = []
+        self._port = port
+        if port is not None:
+            super().__init__(("", port), _PrometheusHandler)
+
+    def start(self) -> "MetricsExporter":
+        if self._summary_file:
+            self._workers.append(threading.Thread(target=self._write_periodically, daemon=True))
+        if self._port is not None:
+            log.info(f"Serving Prometheus metrics on port {self._port}")
+            self._workers.append(threading.Thread(target=self.serve_forever, daemon=True))
+        for thread in self._workers:
+            thread.start()
+        return self
+
+    def _write_periodically(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self.write_summary()
+
+    def write_summary(self) -> None:
+        """Atomically replace the JSON summary."""
+        if not self._summary_file:
+            return
+        tmp_file = self._summary_file + ".tmp"
+        with open(tmp_file, mode='w') as file:
+            json.dump(self.metrics.summary(), file, indent=2)
+        os.replace(tmp_file, self._summary_file)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._port is not None:
+            self.shutdown()
+            self.server_close()
+        self.write_summary()
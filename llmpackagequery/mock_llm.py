@@ -0,0 +1,478 @@
+import json
+import logging
+import random
+import re
+import threading
+import uuid
+
+from email.parser import BytesParser
+
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+log = logging.getLogger(__name__)
+
+# package names in single and batched prompts
+PROMPT_PACKAGE_NAME = re.compile(r'(?:Package name|Name|package):\s*"([^"]*)"')
+# paths of the file and batch job endpoints
+FILES_PATH = re.compile(r"^/v1/files/?$")
+FILE_CONTENT_PATH = re.compile(r"^/v1/files/([^/]+)/content$")
+OPENAI_BATCH_PATH = re.compile(r"^/v1/batches(?:/([^/]+))?$")
+MISTRAL_BATCH_PATH = re.compile(r"^/v1/batch/jobs(?:/([^/]+))?$")
+GEMINI_UPLOAD_PATH = re.compile(r"^/upload/v1beta/files$")
+GEMINI_BATCH_CREATE_PATH = re.compile(r"^/v1beta/models/([^/:]+):batchGenerateContent$")
+GEMINI_BATCH_PATH = re.compile(r"^/v1beta/(batches/[^/:]+)$")
+GEMINI_DOWNLOAD_PATH = re.compile(r"^(?:/download)?/v1beta/(files/[^/:]+):download$")
+CRYPTO_HINTS = ("ssl", "crypt", "gnutls", "nss", "sodium", "gpg", "tls", "ssh", "kerberos", "krb5")
+# characters per generated chunk and the chatter of a model after its answer
+STREAM_CHUNK_SIZE = 16
+TRAILING_TEXT = " Note that the assessment is based on the name and the dependencies of the package only."
+
+@dataclass
+class MockBehaviour:
+    """
+    Behaviour of the stand-in server. Latencies follow a log-normal
+    distribution with the given median (seconds) and sigma. Rate limited
+    requests are answered with HTTP 429 and a Retry-After header.
+    """
+    latency_median: float = 0.05
+    latency_sigma: float = 0.5
+    error_rate: float = 0.0
+    malformed_rate: float = 0.0
+    rate_limited_rate: float = 0.0
+    retry_after: float = 1.0
+    seed: int = 0
+    # generation time per chunk of STREAM_CHUNK_SIZE characters and the
+    # chunks of chatter generated after the answer
+    chunk_latency: float = 0.0
+    trailing_chunks: int = 0
+
+@dataclass
+class MockStats:
+    """Requests answered by the stand-in server."""
+    requests: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    malformed: int = 0
+    latencies: List[float] = field(default_factory=list)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # streams closed by the client before the end of the generation
+    stopped: int = 0
+
+def _generate(answer: str, trailing_chunks: int) -> List[str]:
+    # chunks of the answer and the chatter after it
+    text = answer
+    if trailing_chunks:
+        chatter = "\n\n" + TRAILING_TEXT.strip()
+        while len(chatter) < trailing_chunks * STREAM_CHUNK_SIZE:
+            chatter += TRAILING_TEXT
+        text += chatter[:trailing_chunks * STREAM_CHUNK_SIZE]
+    return [text[idx:idx + STREAM_CHUNK_SIZE] for idx in range(0, len(text), STREAM_CHUNK_SIZE)]
+
+def _answer(prompt: str, malformed: bool) -> str:
+    # answer every package of the prompt, a JSON array for batched prompts
+    names = PROMPT_PACKAGE_NAME.findall(prompt) or ["unknown"]
+    objects = [json.dumps({
+        "package": name,
+        "cryptographic_relevance": any(hint in name.lower() for hint in CRYPTO_HINTS),
+        "justification": "Stand-in answer derived from the package name."
+    }) for name in names]
+    answer = objects[0] if len(objects) == 1 else "[" + ",\n".join(objects) + "]"
+    if malformed:
+        # cut the answer in the middle of the JSON object
+        answer = answer[:len(answer) // 2]
+    return answer
+
+class _MockHandler(BaseHTTPRequestHandler):
+    server: "MockLLMServer"
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if match := FILE_CONTENT_PATH.match(path) or GEMINI_DOWNLOAD_PATH.match(path):
+            content = self.server.files.get(match.group(1))
+            if content is None:
+                self._send(404, {"error": {"code": 404, "message": f"Unknown file {match.group(1)}"}})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        elif (match := OPENAI_BATCH_PATH.match(path) or MISTRAL_BATCH_PATH.match(path)
+              or GEMINI_BATCH_PATH.match(path)) and match.group(1) in self.server.jobs:
+            self._send(200, self.server.poll_job(match.group(1)))
+        else:
+            self._send(404, {"error": {"code": 404, "message": f"Unknown path {self.path}"}})
+
+    def _batch_post(self, path: str, data: bytes) -> bool:
+        # file uploads and batch job creation, False for other paths
+        if FILES_PATH.match(path):
+            # multipart upload of OpenAI and Mistral
+            message = BytesParser().parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + data)
+            parts = {part.get_param("name", header="content-disposition"): part
+                     for part in message.get_payload()}
+            file_id = self.server.add_file(parts["file"].get_payload(decode=True))
+            self._send(200, {
+                "id": file_id, "object": "file", "bytes": len(self.server.files[file_id]),
+                "created_at": int(time()), "filename": parts["file"].get_filename(),
+                "purpose": "batch", "status": "processed",
+                "sample_type": "batch_request", "source": "upload"})
+        elif GEMINI_UPLOAD_PATH.match(path) and self.headers.get("X-Goog-Upload-Command") == "start":
+            # resumable upload of Gemini, the data follows at the upload url
+            upload_id = uuid.uuid4().hex
+            self.send_response(200)
+            self.send_header("X-Goog-Upload-URL", f"{self.server.url}/upload/v1beta/files?upload_id={upload_id}")
+            self.send_header("X-Goog-Upload-Status", "active")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif GEMINI_UPLOAD_PATH.match(path):
+            file_id = self.server.add_file(data, "gemini")
+            self._send(200, {"file": {"name": file_id, "mimeType": "jsonl", "sizeBytes": str(len(data)),
+                                      "state": "ACTIVE"}},
+                       {"X-Goog-Upload-Status": "final"})
+        elif OPENAI_BATCH_PATH.match(path) or MISTRAL_BATCH_PATH.match(path):
+            body = json.loads(data)
+            protocol = "openai" if OPENAI_BATCH_PATH.match(path) else "mistral"
+            input_files = [body["input_file_id"]] if protocol == "openai" else body["input_files"]
+            self._send(200, self.server.add_job(protocol, input_files, body.get("model")))
+        elif match := GEMINI_BATCH_CREATE_PATH.match(path):
+            input_file = json.loads(data)["batch"]["inputConfig"]["fileName"]
+            self._send(200, self.server.add_job("gemini", [input_file], match.group(1)))
+        else:
+            return False
+        return True
+
+    def do_POST(self):
+        start = time()
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self._batch_post(urlsplit(self.path).path, data):
+            return
+        body = json.loads(data or b"{}")
+
+        if self.path.startswith("/api/chat"):
+            prompt = body["messages"][-1]["content"]
+            render = self._ollama
+            # ollama streams unless told otherwise
+            stream = body.get("stream", True)
+            constrained = isinstance(body.get("format"), dict)
+        elif self.path.endswith("/chat/completions"):
+            prompt = body["messages"][-1]["content"]
+            render = self._openai
+            stream = body.get("stream", False)
+            constrained = (body.get("response_format") or {}).get("type") == "json_schema"
+        elif ":generateContent" in self.path or ":streamGenerateContent" in self.path:
+            prompt = " ".join(part.get("text", "")
+                              for content in body.get("contents", [])
+                              for part in content.get("parts", []))
+            render = self._gemini
+            stream = ":streamGenerateContent" in self.path
+            generation_config = body.get("generationConfig", {})
+            constrained = "responseJsonSchema" in generation_config or "responseSchema" in generation_config
+        else:
+            self._send(404, {"error": {"code": 404, "message": f"Unknown path {self.path}"}})
+            return
+
+        error, rate_limited, malformed, latency = self.server.draw()
+        sleep(latency)
+        if rate_limited:
+            self._send(429, {"error": {"code": 429, "message": "Stand-in rate limit exceeded.",
+                                       "status": "RESOURCE_EXHAUSTED"}},
+                       {"Retry-After": str(self.server.behaviour.retry_after)})
+        elif error:
+            self._send(503, {"error": {"code": 503, "message": "Stand-in overloaded.",
+                                       "status": "UNAVAILABLE"}})
+        else:
+            # output constrained to a schema is valid and ends with the object
+            chunks = _generate(_answer(prompt, malformed and not constrained),
+                               0 if constrained else self.server.behaviour.trailing_chunks)
+            prompt_tokens = len(prompt) // 4
+            if stream:
+                completion_tokens = self._stream(render, body, chunks, prompt_tokens)
+            else:
+                sleep(self.server.behaviour.chunk_latency * len(chunks))
+                answer = "".join(chunks)
+                completion_tokens = len(answer) // 4
+                self._send(200, render(body, answer, prompt_tokens, completion_tokens))
+            self.server.record(time() - start, prompt_tokens, completion_tokens)
+            return
+        self.server.record(time() - start, 0, 0)
+
+    def _stream(self, render, body: Dict, chunks: List[str], prompt_tokens: int) -> int:
+        # send the chunks as they are generated in the stream format of the
+        # provider, returns the completion tokens generated until the client
+        # closed the stream
+        protocol = render.__name__
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson" if protocol == "_ollama" else "text/event-stream")
+        self.end_headers()
+        generated = ""
+        try:
+            for chunk in chunks:
+                sleep(self.server.behaviour.chunk_latency)
+                generated += chunk
+                self._send_event(protocol, render(body, chunk, None, None, done=False))
+            completion_tokens = len(generated) // 4
+            self._send_event(protocol, render(body, "", prompt_tokens, completion_tokens))
+            if protocol == "_openai":
+                self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            with self.server._lock:
+                self.server.stats.stopped += 1
+        return len(generated) // 4
+
+    def _send_event(self, protocol: str, payload: Dict) -> None:
+        if protocol == "_ollama":
+            self.wfile.write(json.dumps(payload).encode() + b"\n")
+        else:
+            self.wfile.write(b"data: " + json.dumps(payload).encode() + b"\n\n")
+        self.wfile.flush()
+
+    def _send(self, status: int, payload: Dict, headers: Dict[str, str] | None = None) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # the renderers return a complete response or, unless done, one
+    # streamed chunk without usage
+
+    @staticmethod
+    def _ollama(body: Dict, answer: str, prompt_tokens: int | None, completion_tokens: int | None,
+                done: bool = True) -> Dict:
+        response = {
+            "model": body.get("model"),
+            "created_at": "2024-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": answer},
+            "done": done
+        }
+        if done:
+            response.update({
+                "done_reason": "stop",
+                "prompt_eval_count": prompt_tokens,
+                "eval_count": completion_tokens
+            })
+        return response
+
+    @staticmethod
+    def _openai(body: Dict, answer: str, prompt_tokens: int | None, completion_tokens: int | None,
+                done: bool = True) -> Dict:
+        # OpenAI and Mistral share the chat completion format
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        } if done else None
+        if body.get("stream"):
+            return {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time()),
+                "model": body.get("model"),
+                "choices": [{
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop" if done else None
+                }],
+                "usage": usage
+            }
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time()),
+            "model": body.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        }
+
+    @staticmethod
+    def _gemini(body: Dict, answer: str, prompt_tokens: int | None, completion_tokens: int | None,
+                done: bool = True) -> Dict:
+        response = {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": answer}]},
+                "index": 0
+            }]
+        }
+        if done:
+            response["candidates"][0]["finishReason"] = "STOP"
+            response["usageMetadata"] = {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": completion_tokens,
+                "totalTokenCount": prompt_tokens + completion_tokens
+            }
+        return response
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Ollama, OpenAI compatible (OpenAI, Mistral) and
+    Gemini endpoints used by the query handlers, including the file and
+    batch job endpoints. Answers are derived from the package names in the
+    prompt; latency, server errors and malformed answers are injected
+    according to the behaviour, server errors fail single batch items.
+    Batch jobs are processed when they are polled the second time.
+    Streamed answers end early if the client closes the connection.
+    Answers constrained to a JSON schema are always valid.
+    """
+    daemon_threads = True
+    behaviour: MockBehaviour
+    stats: MockStats
+    files: Dict[str, bytes]
+    jobs: Dict[str, Dict]
+    _random: random.Random
+    _lock: threading.Lock
+    _thread: threading.Thread | None = None
+
+    def __init__(self, behaviour: MockBehaviour, host: str = "127.0.0.1", port: int = 0) -> None:
+        super().__init__((host, port), _MockHandler)
+        self.behaviour = behaviour
+        self.stats = MockStats()
+        self.files = {}
+        self.jobs = {}
+        self._random = random.Random(behaviour.seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def draw(self):
+        """Draw error, rate limit, malformed answer and latency of a request."""
+        with self._lock:
+            rate_limited = self._random.random() < self.behaviour.rate_limited_rate
+            error = self._random.random() < self.behaviour.error_rate
+            malformed = self._random.random() < self.behaviour.malformed_rate
+            latency = self._random.lognormvariate(0, self.behaviour.latency_sigma) \
+                * self.behaviour.latency_median
+            self.stats.requests += 1
+            self.stats.rate_limited += rate_limited
+            self.stats.errors += error and not rate_limited
+            self.stats.malformed += malformed and not error and not rate_limited
+        return error, rate_limited, malformed, latency
+
+    def record(self, latency: float, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            self.stats.latencies.append(latency)
+            self.stats.prompt_tokens += prompt_tokens
+            self.stats.completion_tokens += completion_tokens
+
+    def add_file(self, content: bytes, protocol: str = "openai") -> str:
+        with self._lock:
+            file_id = f"files/{uuid.uuid4().hex}" if protocol == "gemini" else f"file-{uuid.uuid4().hex}"
+            self.files[file_id] = content
+        return file_id
+
+    def add_job(self, protocol: str, input_files: List[str], model: str | None) -> Dict:
+        with self._lock:
+            job_id = f"batches/{uuid.uuid4().hex}" if protocol == "gemini" else f"batch_{uuid.uuid4().hex}"
+            self.jobs[job_id] = {"protocol": protocol, "input_files": input_files,
+                                 "model": model, "polls": 0, "created_at": int(time())}
+        return self._render_job(job_id)
+
+    def poll_job(self, job_id: str) -> Dict:
+        with self._lock:
+            job = self.jobs[job_id]
+            job["polls"] += 1
+            process = job["polls"] == 2
+        if process:
+            self._process_job(job)
+        return self._render_job(job_id)
+
+    def _process_job(self, job: Dict) -> None:
+        # answer every request of the input files
+        output, errors = [], []
+        for file_id in job["input_files"]:
+            for line in self.files[file_id].decode().splitlines():
+                request = json.loads(line)
+                if job["protocol"] == "gemini":
+                    custom_id = request["key"]
+                    prompt = " ".join(part.get("text", "")
+                                      for content in request["request"]["contents"]
+                                      for part in content.get("parts", []))
+                else:
+                    custom_id = request["custom_id"]
+                    prompt = request["body"]["messages"][-1]["content"]
+
+                error, rate_limited, malformed, _ = self.draw()
+                if error or rate_limited:
+                    errors.append(self._batch_error(job["protocol"], custom_id))
+                    continue
+                answer = _answer(prompt, malformed)
+                prompt_tokens, completion_tokens = len(prompt) // 4, len(answer) // 4
+                self.record(0.0, prompt_tokens, completion_tokens)
+                if job["protocol"] == "gemini":
+                    output.append({"key": custom_id, "response": _MockHandler._gemini(
+                        {}, answer, prompt_tokens, completion_tokens)})
+                else:
+                    output.append({"id": uuid.uuid4().hex, "custom_id": custom_id, "error": None,
+                                   "response": {"status_code": 200, "body": _MockHandler._openai(
+                                       {"model": job["model"]}, answer, prompt_tokens, completion_tokens)}})
+
+        if job["protocol"] == "gemini":
+            # failed items are part of the responses file
+            output += errors
+            errors = []
+        job["output_file"] = self.add_file(
+            "".join(json.dumps(r) + "\n" for r in output).encode(), job["protocol"])
+        job["error_file"] = self.add_file(
+            "".join(json.dumps(r) + "\n" for r in errors).encode(), job["protocol"]) if errors else None
+        job["counts"] = (len(output) + len(errors), len(output), len(errors))
+
+    @staticmethod
+    def _batch_error(protocol: str, custom_id: str) -> Dict:
+        if protocol == "gemini":
+            return {"key": custom_id, "error": {"code": 503, "message": "Stand-in overloaded."}}
+        return {"id": uuid.uuid4().hex, "custom_id": custom_id, "response": None,
+                "error": {"code": "server_error", "message": "Stand-in overloaded."}}
+
+    def _render_job(self, job_id: str) -> Dict:
+        # the job in the format of its provider
+        with self._lock:
+            job = dict(self.jobs[job_id])
+        done = "output_file" in job
+        total, succeeded, failed = job.get("counts", (0, 0, 0))
+        if job["protocol"] == "openai":
+            return {"id": job_id, "object": "batch", "endpoint": "/v1/chat/completions",
+                    "input_file_id": job["input_files"][0], "completion_window": "24h",
+                    "status": "completed" if done else "in_progress",
+                    "created_at": job["created_at"],
+                    "output_file_id": job.get("output_file"), "error_file_id": job.get("error_file"),
+                    "request_counts": {"total": total, "completed": succeeded, "failed": failed}}
+        if job["protocol"] == "mistral":
+            return {"id": job_id, "object": "batch", "input_files": job["input_files"],
+                    "endpoint": "/v1/chat/completions", "model": job["model"], "errors": [],
+                    "status": "SUCCESS" if done else "RUNNING", "created_at": job["created_at"],
+                    "output_file": job.get("output_file"), "error_file": job.get("error_file"),
+                    "total_requests": total, "completed_requests": total,
+                    "succeeded_requests": succeeded, "failed_requests": failed}
+        metadata = {"@type": "type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatch",
+                    "model": f"models/{job['model']}",
+                    "state": "BATCH_STATE_SUCCEEDED" if done else "BATCH_STATE_RUNNING"}
+        if done:
+            metadata["output"] = {"responsesFile": job["output_file"]}
+        return {"name": job_id, "metadata": metadata}
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,168 @@
+import bz2
+import csv
+import gzip
+import json
+import logging
+import lzma
+import os
+import xml.etree.ElementTree as ET
+
+from typing import IO, Dict, Iterator, List, Set
+
+log = logging.getLogger(__name__)
+
+# Rows of all inputs have the layout of the CSV package list:
+# name, version, description, dependencies (comma separated package names)
+PACKAGE_COLUMNS = ["package_name", "package_version", "package_description", "dependencies"]
+
+REPOMD_FILE = "repodata/repomd.xml"
+NS_REPO = "{http://linux.duke.edu/metadata/repo}"
+NS_COMMON = "{http://linux.duke.edu/metadata/common}"
+NS_RPM = "{http://linux.duke.edu/metadata/rpm}"
+NS_FILELISTS = "{http://linux.duke.edu/metadata/filelists}"
+
+def read_packages(package_list: str) -> Iterator[List[str]]:
+    """
+    Stream the packages of a package list. Supported are the CSV package
+    list, JSON lines with the keys name, version, description and
+    dependencies, and rpm repository metadata given as repository
+    directory, repodata directory or primary.xml file.
+    """
+    if os.path.isdir(package_list) or ".xml" in os.path.basename(package_list):
+        return read_repodata(package_list)
+    if package_list.endswith(".jsonl"):
+        return read_jsonl(package_list)
+    return read_csv(package_list)
+
+def read_csv(package_list: str) -> Iterator[List[str]]:
+    """Stream the rows of a CSV package list."""
+    with open(package_list, mode='r') as file:
+        package_reader = csv.reader(file, delimiter=',', quotechar='"')
+        next(package_reader) # Skip the header
+        yield from package_reader
+
+def read_jsonl(package_list: str) -> Iterator[List[str]]:
+    """Stream the records of a JSON lines package list."""
+    with open(package_list, mode='r') as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                log.error(f"Skipping line {line_number} of {package_list}: {e}")
+                continue
+            yield record_row(record)
+
+def record_row(record: Dict) -> List[str]:
+    """
+    Row of a package record with the keys name, version, description and
+    dependencies (a string or a list), only the name is required.
+    """
+    dependencies = record.get("dependencies", "")
+    if isinstance(dependencies, list):
+        dependencies = ", ".join(dependencies)
+    return [record["name"],
+            record.get("version", ""),
+            record.get("description", ""),
+            dependencies]
+
+def _open_compressed(path: str) -> IO[bytes]:
+    # repository metadata is usually compressed
+    if path.endswith(".gz"):
+        return gzip.open(path, mode='rb')
+    if path.endswith(".xz"):
+        return lzma.open(path, mode='rb')
+    if path.endswith(".bz2"):
+        return bz2.open(path, mode='rb')
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(f"Reading {path} requires the zstandard package.")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, mode='rb'), closefd=True)
+    return open(path, mode='rb')
+
+def _iter_elements(path: str, tag: str) -> Iterator[ET.Element]:
+    # incremental parse, every element is dropped after it was handled
+    with _open_compressed(path) as file:
+        context = ET.iterparse(file, events=("start", "end"))
+        _, root = next(context)
+        for event, element in context:
+            if event == "end" and element.tag == tag:
+                yield element
+                root.clear()
+
+def _repodata_files(package_list: str) -> Dict[str, str]:
+    # locate primary and filelists metadata of a repository
+    if os.path.isfile(package_list):
+        return {"primary": package_list}
+
+    repo_dir = package_list
+    if os.path.basename(os.path.normpath(repo_dir)) == "repodata":
+        repo_dir = os.path.dirname(os.path.normpath(repo_dir))
+
+    files = {}
+    repomd = ET.parse(os.path.join(repo_dir, REPOMD_FILE))
+    for data in repomd.getroot().iter(f"{NS_REPO}data"):
+        location = data.find(f"{NS_REPO}location")
+        if data.get("type") in ("primary", "filelists") and location is not None:
+            files[data.get("type")] = os.path.join(repo_dir, location.get("href"))
+    if "primary" not in files:
+        raise ValueError(f"No primary metadata found in {repo_dir}.")
+    return files
+
+def read_repodata(package_list: str) -> Iterator[List[str]]:
+    """
+    Stream the packages of rpm repository metadata. Required capabilities
+    are resolved to package names with the provides of primary.xml and
+    the files of filelists.xml. Apart from this index, of which only the
+    required files are kept, memory does not grow with the repository.
+    """
+    files = _repodata_files(package_list)
+    primary = files["primary"]
+
+    # first pass: index the provides and collect the required files
+    providers: Dict[str, str] = {}
+    required_files: Set[str] = set()
+    for package in _iter_elements(primary, f"{NS_COMMON}package"):
+        name = package.findtext(f"{NS_COMMON}name")
+        fmt = package.find(f"{NS_COMMON}format")
+        if fmt is None:
+            continue
+        for entry in fmt.iterfind(f"{NS_RPM}provides/{NS_RPM}entry"):
+            providers.setdefault(entry.get("name"), name)
+        for path in fmt.iterfind(f"{NS_COMMON}file"):
+            providers.setdefault(path.text, name)
+        for entry in fmt.iterfind(f"{NS_RPM}requires/{NS_RPM}entry"):
+            if entry.get("name", "").startswith("/"):
+                required_files.add(entry.get("name"))
+
+    # second pass: resolve required files not listed in primary.xml
+    required_files.difference_update(providers)
+    if required_files and "filelists" in files:
+        for package in _iter_elements(files["filelists"], f"{NS_FILELISTS}package"):
+            for path in package.iterfind(f"{NS_FILELISTS}file"):
+                if path.text in required_files:
+                    providers.setdefault(path.text, package.get("name"))
+
+    # third pass: yield the packages
+    for package in _iter_elements(primary, f"{NS_COMMON}package"):
+        name = package.findtext(f"{NS_COMMON}name")
+        version = package.find(f"{NS_COMMON}version")
+        description = " ".join(filter(None, [
+            (package.findtext(f"{NS_COMMON}description") or "").strip(),
+            (package.findtext(f"{NS_COMMON}packager") or "").strip()]))
+
+        dependencies = set()
+        fmt = package.find(f"{NS_COMMON}format")
+        if fmt is not None:
+            for entry in fmt.iterfind(f"{NS_RPM}requires/{NS_RPM}entry"):
+                provider = providers.get(entry.get("name"))
+                if provider is not None and provider != name:
+                    dependencies.add(provider)
+
+        yield [name,
+               version.get("ver", "") if version is not None else "",
+               description,
+               ", ".join(sorted(dependencies))]
@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+"""
+Micro-benchmark of the response parsers over a corpus of model outputs,
+well-formed ones as returned by the providers and malformed ones as
+written by local models. Reports the parse time and the share of outputs
+parsed per kind of output.
+
+Example:
+    python3 parse_benchmark.py --repeat 2000
+"""
+import argparse
+import json
+import logging
+import sys
+
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import query
+
+BENCHMARK_ATTRIBUTES = ["package", "cryptographic_relevance", "justification"]
+JUSTIFICATION = "The package provides TLS {support} and links against openssl-libs for " \
+                "certificate handling."
+
+# kind of output and response, the package name is replaced per sample
+CORPUS: List[Tuple[str, str]] = [
+    ("strict", '{"package": "%s", "cryptographic_relevance": true, "justification": "' + JUSTIFICATION + '"}'),
+    ("strict_nested", '{"package": "%s", "cryptographic_relevance": false, "justification": "' + JUSTIFICATION
+     + '", "details": {"algorithms": ["AES", "RSA"], "libraries": {"openssl": "3.0"}}}'),
+    ("markdown", 'Here is the result:\n```json\n{\n  "package": "%s",\n  "cryptographic_relevance": true,\n'
+     '  "justification": "' + JUSTIFICATION + '"\n}\n```\n'),
+    ("think", '<think>\nThe package {name} looks like a library. Output {"package": ...}.\n</think>\n\n'
+     '{"package": "%s", "cryptographic_relevance": true, "justification": "' + JUSTIFICATION + '"}'),
+    ("bare_bool", '{"package": "%s", "cryptographic_relevance": True, "justification": "' + JUSTIFICATION + '"}'),
+    ("single_quotes", "{'package': '%s', 'cryptographic_relevance': 'yes', 'justification': 'TLS support'}"),
+    ("single_quoted_brace", "{'package': '%s', 'cryptographic_relevance': True, 'justification': 'has } brace'}"),
+    ("trailing_comma", '{"package": "%s", "cryptographic_relevance": false, "justification": "'
+     + JUSTIFICATION + '",}'),
+    ("comments", '{\n  "package": "%s", // the name\n  "cryptographic_relevance": true, /* verdict */\n'
+     '  "justification": "' + JUSTIFICATION + '"\n}'),
+    ("unclosed", '{"package": "%s", "cryptographic_relevance": true, "justification": "' + JUSTIFICATION),
+    ("prose", 'The package %s is not relevant for cryptography.'),
+]
+
+def corpus_samples(package_names: List[str]) -> List[Tuple[str, str, str]]:
+    """Samples (kind, package name, response) of the corpus."""
+    return [(kind, name, template.replace("%s", name).replace("{support}", "and SSH")
+             .replace("{name}", name))
+            for name in package_names for kind, template in CORPUS]
+
+def run(parser: query.ResponseParser,
+        samples: List[Tuple[str, str, str]],
+        repeat: int) -> Dict[str, Dict]:
+    """Parse every sample repeat times, returns timing and success per kind."""
+    results: Dict[str, Dict] = {}
+    for kind, package_name, response in samples:
+        parser.last_error = None
+        parser(response, package_name)
+        parsed = parser.last_error is None
+
+        start = perf_counter()
+        for _ in range(repeat):
+            parser(response, package_name)
+        elapsed = perf_counter() - start
+
+        result = results.setdefault(kind, {"samples": 0, "parsed": 0, "seconds": 0.0})
+        result["samples"] += 1
+        result["parsed"] += parsed
+        result["seconds"] += elapsed
+
+    for result in results.values():
+        result["us_per_parse"] = result.pop("seconds") / (result["samples"] * repeat) * 1e6
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the response parsers.")
+    parser.add_argument("--parsers", type=str, nargs="+",
+                        default=["GPT_5ResponseParser", "DEEPSEEK_R1_LATESTResponseParser"],
+                        help="Response parser classes to benchmark.")
+    parser.add_argument("--repeat", type=int, default=1_000,
+                        help="Parses per sample (default: 1000).")
+    parser.add_argument("--packages", type=str, nargs="+", default=["openssl", "bash", "gnutls-utils"],
+                        help="Package names of the samples.")
+    args = parser.parse_args()
+
+    # parse errors are expected for the malformed outputs
+    logging.basicConfig(level=logging.CRITICAL)
+    samples = corpus_samples(args.packages)
+    report = {name: run(query.get_class(name)(attributes=BENCHMARK_ATTRIBUTES), samples, args.repeat)
+              for name in args.parsers}
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
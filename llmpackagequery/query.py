@@ -1,24 +1,50 @@
+from __future__ import annotations
+
+import copy
+import inspect
+import json
 import re
 import logging
-import ast # instead of json
-from mistralai import Mistral
-
-from typing import Dict, List, Protocol, Set, Type
-from wsgiref import types
-from openai import OpenAI
-from ollama import Client as OllamaClient
-from gpt4all import GPT4All
+import threading
+import string
+
+from time import perf_counter
+from typing import TYPE_CHECKING, Collection, Dict, Iterator, List, Protocol, Set, Tuple, Type
 from enum import Enum
 
-from google import genai
-from google.genai import types
+from jsonparse import ObjectDetector, find_objects, load_objects, loads_tolerant
+from writer import ResultRecord
+
+if TYPE_CHECKING:
+    # the SDK of a provider is imported when its query handler is created
+    from google import genai
+    from google.genai import types
+    from gpt4all import GPT4All
+    from mistralai import Mistral
+    from ollama import Client as OllamaClient
+    from openai import OpenAI
 
 ################### Constants ###################
 NON_ALNUM = re.compile(r'[^0-9a-zA-Z]+')
-# match one json object in curly braces
-JSON_OBJECT_ONLY = re.compile(r'\{[^}]*\}', re.DOTALL)
 # match one json object in markdown code block
-JSON_INLINE_MARKDOWN = re.compile(r"```json((.*?\n)*)```", re.MULTILINE)
+JSON_INLINE_MARKDOWN = re.compile(r"```json(.*?)```", re.DOTALL)
+# reasoning of the model before the answer
+THINK_BLOCK = re.compile(r"<think>.*?</think>", re.DOTALL)
+# system message of the models which support one
+SYSTEM_PROMPT = "Act as a security expert."
+# chat template of gpt4all models without one in their configuration
+GPT4ALL_DEFAULT_PROMPT_TEMPLATE = "### Human:\n{0}\n\n### Assistant:\n"
+# generation parameters of the local models, prompt tokens are
+# evaluated in batches of PREFILL_BATCH tokens
+GPT4ALL_MAX_TOKENS = 1024
+PREFILL_BATCH = 128
+# name of the schema constraining the output of the models
+RESPONSE_SCHEMA_NAME = "package_classification"
+# one package in a batched prompt, filled for every package of the batch
+BATCH_PACKAGE_ITEM = """{number}. Package name: "{name}"
+Description: "{description}"
+Dependencies: "{dependencies}"
+"""
 
 class QueryStub (Enum):
     """Enum for query stubs."""
@@ -46,11 +72,35 @@ def get_class(raw: str) -> Type | None:
     """Get a class from the registry by its normalized name."""
     return class_registry.get(normalize(raw))
 
+def answer_format(attributes: List[str], boolean_attributes: Collection[str] = ()) -> str:
+    """
+    Example answer object of the attributes as shown in prompts, the first
+    attribute is the package name.
+    """
+    values = ['"<package name>"'] + ["true | false" if attribute in boolean_attributes else f'"<{attribute}>"'
+                                     for attribute in attributes[1:]]
+    lines = [f'    "{attribute}": {value}' for attribute, value in zip(attributes, values)]
+    return "  {\n" + ",\n".join(lines) + "\n  }"
+
+def attributes_schema(attributes: List[str], boolean_attributes: Collection[str] = ()) -> Dict:
+    """
+    JSON schema of an answer holding exactly the attributes, all of them
+    strings except the boolean attributes.
+    """
+    return {
+        "type": "object",
+        "properties": {attribute: {"type": "boolean" if attribute in boolean_attributes else "string"}
+                       for attribute in attributes},
+        "required": list(attributes),
+        "additionalProperties": False
+    }
+
 ################### Classes ###################
 class ResponseParser:
     attributes: Set[str]
     attributes_list: List[str]
-    last_error: str | None = None
+    # per thread parse state, requests may be executed concurrently
+    _state: threading.local
     ALIASES: Dict[str, str] = {
         "cryptography_relevance": "cryptographic_relevance",
         "explanation": "justification"
@@ -59,14 +109,48 @@ class ResponseParser:
     def __init__(self, attributes: List[str] = None) -> None:
         self.attributes_list = attributes
         self.attributes = set(attributes)
+        self._state = threading.local()
+
+    @property
+    def last_error(self) -> str | None:
+        """Error of the last parse executed by the current thread."""
+        return getattr(self._state, "last_error", None)
 
-    def get_empty_response(self, package_name: str) -> str:
+    @last_error.setter
+    def last_error(self, value: str | None) -> None:
+        self._state.last_error = value
+
+    def get_empty_response(self, package_name: str) -> ResultRecord:
         attributes_count = len(self.attributes_list)-1
-        return f'{package_name}' + ','*attributes_count
+        return ResultRecord([package_name] + [""]*attributes_count)
 
     def __call__(self, response: str, package_name: str) -> str:
         ...
 
+    def split_batch(self, response: str, package_names: List[str]) -> Dict[str, str]:
+        """
+        Split the JSON array answering a batched prompt into the objects
+        of the single packages. The objects are assigned by the package
+        name in the first attribute, or by position if the model did not
+        repeat the names. Missing packages are not part of the result.
+        """
+        objects = find_objects(response)
+        name_attribute = self.attributes_list[0].lower()
+
+        items: Dict[str, str] = {}
+        expected = set(package_names)
+        for obj in objects:
+            # names may contain quotes, take them from the parsed object
+            data = loads_tolerant(obj)
+            name = self._normalize_keys(data).get(name_attribute) if isinstance(data, dict) else None
+            if isinstance(name, str) and name.strip() in expected:
+                items.setdefault(name.strip(), obj)
+
+        if not items and len(objects) == len(package_names):
+            items = dict(zip(package_names, objects))
+
+        return items
+
     def __try_parse_bool_str(self, value):
         if isinstance(value, bool):
             return str(value)
@@ -78,98 +162,92 @@ class ResponseParser:
         else:
             return value
 
-    def __match_json(self, json_str_in: str) -> str | None:
-        # get json content from response
-        json_match = JSON_OBJECT_ONLY.search(json_str_in)
-        if json_match:
-            return json_match.group(0)
-        else:
-            return None
-
-    def json_to_csv(self, json_str_in: str, package_name: str) -> str:
-        error_csv_entry = f'{package_name}' + ','*(len(self.attributes)-1)
-
-        # get json content from response
-        json_str:str = self.__match_json(json_str_in)
-
-        if not json_str:
-            json_str_in += "\n}"  # try to fix unclosed json
-            json_str = self.__match_json(json_str_in)
-            # second try
-            if not json_str:
-                self.last_error = f"No JSON object found in response for package {package_name}: {json_str_in}"
-                log.error(self.last_error)
-                return error_csv_entry
-
-        # Replace a unnecessary white spaces and fix
-        # True/False without quotation marks
-        json_str = json_str.strip()
-        json_str = re.sub(r'[^"](T|t)rue,', ' "True",', json_str)
-        json_str = re.sub(r'[^"](F|f)alse,', ' "False",', json_str)
-
-        # replace wrong "//" comments
-        json_str = re \
-                    .sub(r'//[^\r\n]*', '', json_str) \
-                    .replace(", ...", "") \
-                    .replace(",...", "")
-
-        # replace wrong quoting
-        json_str = json_str \
-                    .replace('\\"', "") \
-                    .replace("\\", "")
-
-        # Step 1: Use ast.literal_eval to safely parse it as a Python dict
+    def _normalize_keys(self, data: Dict) -> Dict:
+        # replace whitespaces in keys and make them lowercase
+        data = {str(k).replace(" ", "").lower(): v for k, v in data.items()}
+        for k in list(data.keys()):
+            if k in self.ALIASES:
+                data.setdefault(self.ALIASES[k], data[k])
+        return data
+
+    def has_attributes(self, data: Dict) -> bool:
+        """Whether a loaded object holds all attributes."""
+        return self.attributes.issubset(self._normalize_keys(data))
+
+    def detector(self) -> ObjectDetector:
+        """Detector of the first object holding all attributes in a streamed response."""
+        return ObjectDetector(self.has_attributes)
+
+    def __load_attributes(self, json_str_in: str) -> Tuple[Dict | None, bool]:
+        # first object holding all attributes and whether any object was loaded
+        loaded = False
+        for data in load_objects(json_str_in):
+            loaded = True
+            data = self._normalize_keys(data)
+            if self.attributes.issubset(data):
+                return data, loaded
+        return None, loaded
+
+    def parse_structured(self, response: str, package_name: str) -> ResultRecord:
+        """
+        Parse a response constrained to the schema of the attributes. Valid
+        output is loaded as is, anything else, e.g. a response cut off at
+        the token limit, is parsed like a free text response.
+        """
         try:
-            # try to read json string
-            # use ast instead of json to allow single quoted strings
-            data = ast.literal_eval(json_str)
-        except (ValueError, SyntaxError):
-            self.last_error = f"Package {package_name}: could not parse json-string: {json_str}"
+            data = json.loads(response)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and self.attributes.issubset(data):
+            return self._record(data, package_name)
+        return self(response, package_name)
+
+    def json_to_csv(self, json_str_in: str, package_name: str) -> ResultRecord:
+        """
+        Parse the first JSON object of the response holding all attributes
+        into a record of the attribute values. Objects are decoded strictly,
+        falling back to a tolerant scanner for malformed objects.
+        """
+        if "{" not in json_str_in:
+            self.last_error = f"No JSON object found in response for package {package_name}: {json_str_in}"
             log.error(self.last_error)
-            return error_csv_entry
-
-        # replace whitespaces in keys and make them lowercase
-        data = {k.replace(" ", "").lower():v for k, v in data.items()}
-
-        # error checking
-        if not self.attributes.issubset(data):
-            for k in list(data.keys()):
-                if k in self.ALIASES:
-                    data[self.ALIASES[k]] = data[k]
-
-            if not self.attributes.issubset(data):
-                self.last_error = f"For package {package_name} one of the keys {self.attributes} is missing in JSON data: {json_str}"
-                log.error(self.last_error)
-                return error_csv_entry
-
-        for a in self.attributes:
-            if type(data[a]) == str:
+            return self.get_empty_response(package_name)
+
+        data, loaded = self.__load_attributes(json_str_in)
+        if data is None:
+            if loaded:
+                self.last_error = f"For package {package_name} one of the keys {self.attributes} is missing in JSON data: {json_str_in}"
+            else:
+                self.last_error = f"Package {package_name}: could not parse json-string: {json_str_in}"
+            log.error(self.last_error)
+            return self.get_empty_response(package_name)
+        return self._record(data, package_name)
+
+    def _record(self, data: Dict, package_name: str) -> ResultRecord:
+        # record of the attribute values of a loaded object
+        values = []
+        for a in self.attributes_list:
+            value = data[a]
+            if type(value) == str:
                 # fix quotation marks
-                data[a] = data[a].replace('"', "'")
-            if type(data[a]) == list:
-                # fix inner strings
-                data[a] = list(map(
-                    lambda x: str(x)
+                value = value.replace('"', "'")
+            if type(value) == list:
+                # fix inner strings and convert list to string
+                value = str([str(x)
                                 .replace("'", "")
                                 .lower()
                                 .replace('[', "")
-                                .replace(']', ""),
-                    data[a]))
-                # convert list to string
-                data[a] = str(data[a])
+                                .replace(']', "") for x in value])
 
             # try to find if boolean was intended and categorize in
             # True and False, return string if it cannot be understood
             # as boolean
-            data[a] = self.__try_parse_bool_str(data[a])
+            values.append(self.__try_parse_bool_str(value))
 
         # override package name fetched from LLM
         # assume first attribute as key (package)
-        data[self.attributes_list[0]] = package_name
-
-        # actually not correct - better to return list because of quotation
-        # use the attributes list to get the values in the right order
-        return ','.join([f'"{data[k]}"' for k in self.attributes_list])
+        values[0] = package_name
+        return ResultRecord(values)
 
 class NoResponseParser(ResponseParser):
     def __call__(self, response: str, package_name: str) -> str:
@@ -180,26 +258,15 @@ class NoResponseParser(ResponseParser):
 class DEEPSEEK_R1_LATESTResponseParser(ResponseParser):
 
     def __call__(self, response: str, package_name: str) -> str:
-        # print(f"{package_name} with response: {response}")
-        # get json content from response
-        json_str = None
+        # the reasoning may contain objects, only the answer is parsed
+        response = THINK_BLOCK.sub("", response)
+
         # try to find json in markdown code block
         json_match = JSON_INLINE_MARKDOWN.search(response)
         if json_match:
-            json_str = json_match.group(1)
-
-        # if not found try to find json in curly braces
-        if not json_str:
-            json_match = JSON_OBJECT_ONLY.search(response)
-            if json_match:
-                json_str = json_match.group(0)
-
-        if not json_str:
-            self.last_error = f"Response is None or empty for package {package_name}: {response}"
-            log.error(self.last_error)
-            return f'{package_name},,'
+            return self.json_to_csv(json_match.group(1), package_name)
 
-        return self.json_to_csv(json_str, package_name)
+        return self.json_to_csv(response, package_name)
 
 @register
 class META_LLAMA_3_8B_INSTRUCT_Q4_0ResponseParser(ResponseParser):
@@ -250,6 +317,18 @@ class CODESTRAL_2508ResponseParser(ResponseParser):
     def __call__(self, response: str, package_name: str) -> str:
         return self.json_to_csv(response, package_name)
 
+def chat_response_format(response_schema: Dict | None) -> Dict:
+    """
+    Arguments of the OpenAI compatible chat APIs (OpenAI, Mistral)
+    constraining the output to a strict JSON schema, none without schema.
+    """
+    if response_schema is None:
+        return {}
+    return {"response_format": {
+        "type": "json_schema",
+        "json_schema": {"name": RESPONSE_SCHEMA_NAME, "schema": response_schema, "strict": True}
+    }}
+
 class PromptGeneratorCallable(Protocol):
     def __call__(self, name: str, description: str, dependencies: str) -> str:
         ...
@@ -257,6 +336,8 @@ class PromptGeneratorCallable(Protocol):
 class TemplateBasedPromptGenerator(PromptGeneratorCallable):
     __full_template_path: str
     __template: str
+    # text of the template before the first placeholder, equal for all packages
+    static_prefix: str
 
     def __init__(self, full_template_path: str) -> None:
         self.__full_template_path: str = full_template_path
@@ -265,6 +346,13 @@ class TemplateBasedPromptGenerator(PromptGeneratorCallable):
         with open(self.__full_template_path, 'r') as file:
             self.__template = file.read()
 
+        prefix = []
+        for literal_text, field_name, _, _ in string.Formatter().parse(self.__template):
+            prefix.append(literal_text)
+            if field_name is not None:
+                break
+        self.static_prefix = "".join(prefix)
+
     def __call__(self, name: str, description: str, dependencies: str) -> str:
         # if name == "mingw32-openssl-static":
         #     print(f"Template {name}: {self.__template.format(name=name,description=description,dependencies=dependencies)}")
@@ -276,9 +364,61 @@ class TemplateBasedPromptGenerator(PromptGeneratorCallable):
                         dependencies=dependencies)
 
 
+class BatchPromptGeneratorCallable(Protocol):
+    def __call__(self, packages: List[Tuple[str, str, str]]) -> str:
+        ...
+
+class BatchTemplateBasedPromptGenerator(BatchPromptGeneratorCallable):
+    """
+    Prompt for several packages at once. The template contains the
+    placeholders {count} and {packages}, every package given as
+    (name, description, dependencies) is rendered with BATCH_PACKAGE_ITEM.
+    {answer_format} is the answer object of the queried attributes, so
+    one template serves all models and attributes.
+    """
+    __full_template_path: str
+    __template: str
+    __answer_format: str
+
+    def __init__(self,
+                 full_template_path: str,
+                 attributes: List[str],
+                 boolean_attributes: Collection[str] = ()) -> None:
+        self.__full_template_path: str = full_template_path
+        self.__answer_format = answer_format(attributes, boolean_attributes)
+
+        # read the query template
+        with open(self.__full_template_path, 'r') as file:
+            self.__template = file.read()
+
+    def __call__(self, packages: List[Tuple[str, str, str]]) -> str:
+        items = "\n".join(
+            BATCH_PACKAGE_ITEM.format(
+                number=number,
+                name=name,
+                description=description,
+                dependencies=dependencies)
+            for number, (name, description, dependencies) in enumerate(packages, 1))
+
+        return self.__template \
+                    .format(
+                        count=len(packages),
+                        packages=items,
+                        answer_format=self.__answer_format)
+
+
 class QueryHandlerCallable(Protocol):
     __prompt_generator: PromptGeneratorCallable
     response_parser: ResponseParser
+    # identifies the queried model, e.g. "openai.gpt-5"
+    model_id: str | None = None
+    # stream responses and stop the generation once the answer is complete
+    stream: bool = False
+    # JSON schema the output of the model is constrained to, None for free text
+    response_schema: Dict | None = None
+    # whether the backend can constrain the output to a schema
+    STRUCTURED_OUTPUT: bool = True
+    _usage_state: threading.local
 
     def __init__(self,
                  prompt_generator: PromptGeneratorCallable,
@@ -288,20 +428,95 @@ class QueryHandlerCallable(Protocol):
 
         self.__prompt_generator = prompt_generator
         self.response_parser = response_parser
+        self._usage_state = threading.local()
+
+    @classmethod
+    def create(cls,
+               model_name: str,
+               prompt_generator: PromptGeneratorCallable,
+               response_parser: ResponseParser,
+               **options) -> QueryHandlerCallable:
+        """
+        Create the handler with the client of its provider, the SDK of the
+        provider is imported here. Options are api_key, host, api_base_url,
+        keep_alive and device, each handler uses the ones it needs.
+        Should be overridden by any child class
+        """
+        raise TypeError(f"{cls.__name__} does not implement create.")
+
+    def with_prompt(self,
+                    prompt_generator: PromptGeneratorCallable,
+                    response_parser: ResponseParser) -> QueryHandlerCallable:
+        """
+        Copy of the handler for another prompt template or attributes,
+        sharing the client or loaded model of this handler.
+        """
+        handler = copy.copy(self)
+        handler.__prompt_generator = prompt_generator
+        handler.response_parser = response_parser
+        handler._usage_state = threading.local()
+        return handler
+
+    @property
+    def prompt_generator(self) -> PromptGeneratorCallable:
+        return self.__prompt_generator
+
+    @property
+    def last_usage(self) -> Tuple[int, int] | None:
+        """Prompt and completion tokens of the last response of the current thread."""
+        return getattr(self._usage_state, "last_usage", None)
+
+    @last_usage.setter
+    def last_usage(self, value: Tuple[int, int] | None) -> None:
+        self._usage_state.last_usage = value
+
+    @property
+    def last_time_to_result(self) -> float | None:
+        """Seconds until the answer of the last streamed response of the current thread was complete."""
+        return getattr(self._usage_state, "last_time_to_result", None)
+
+    @property
+    def last_stopped_early(self) -> bool:
+        """Whether the generation of the last response of the current thread was stopped early."""
+        return getattr(self._usage_state, "last_stopped_early", False)
 
     def __call__(self, question: str) -> str:
         """
         Ask a question and return the unfiltered response
         Should be overridden by any child class
         """
-        # reset last error
+        # reset last error, token usage and stream state
         self.response_parser.last_error = None
+        self.last_usage = None
+        self._usage_state.last_time_to_result = None
+        self._usage_state.last_stopped_early = False
+
+    def _collect(self, chunks: Iterator[str], start: float) -> str:
+        """
+        Collect the text chunks of a streamed response. The stream is closed
+        as soon as the response holds a complete object with all attributes,
+        which stops the generation of the remaining tokens.
+        """
+        detector = self.response_parser.detector()
+        response = []
+        try:
+            for chunk in chunks:
+                response.append(chunk)
+                if detector.feed(chunk):
+                    self._usage_state.last_stopped_early = True
+                    break
+        finally:
+            chunks.close()
+        self._usage_state.last_time_to_result = perf_counter() - start
+        return "".join(response)
 
     def parse_response(self, response: str, package_name: str) -> str:
         """
         Parse response and return the relevant information
         return csv as string
         """
+        if self.response_schema is not None:
+            return self.response_parser.parse_structured(response, package_name)
         return self.response_parser(response, package_name)
 
     def generate_question_for_package(self,
@@ -332,24 +547,65 @@ class OpenAIQueryHandler(QueryHandlerCallable):
         self.client = client
         self.__model = model_name
 
+    @classmethod
+    def create(cls,
+               model_name: str,
+               prompt_generator: PromptGeneratorCallable,
+               response_parser: ResponseParser,
+               api_key: str | None = None,
+               api_base_url: str | None = None,
+               **options) -> OpenAIQueryHandler:
+        from openai import OpenAI
+        # pass api key and use default host, the rate limiter retries
+        return cls(model_name=model_name,
+                   client=OpenAI(api_key=api_key, base_url=api_base_url, max_retries=0),
+                   prompt_generator=prompt_generator,
+                   response_parser=response_parser)
+
+    def _messages(self, prompt: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+
     # Ask a question about the CSV data
     def ask_openai(self, prompt: str) -> str:
         completion = self.client.chat.completions.create(
             model=self.__model,
             # temperature=0,
-            messages=[
-                {"role": "system", "content": "Act as a security expert."},
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
+            messages=self._messages(prompt),
+            **chat_response_format(self.response_schema)
         )
 
+        if completion.usage is not None:
+            self.last_usage = (completion.usage.prompt_tokens, completion.usage.completion_tokens)
         return completion.choices[0].message.content
 
+    def _stream_openai(self, prompt: str) -> Iterator[str]:
+        # text deltas of a streamed completion, the usage follows the last delta
+        stream = self.client.chat.completions.create(
+            model=self.__model,
+            messages=self._messages(prompt),
+            stream=True,
+            stream_options={"include_usage": True},
+            **chat_response_format(self.response_schema)
+        )
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    self.last_usage = (chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close()
+
     def __call__(self, question: str) -> str:
         super().__call__(question)
+        if self.stream:
+            return self._collect(self._stream_openai(question), perf_counter())
         return self.ask_openai(question)
 
 @register
@@ -367,17 +623,69 @@ class GeminiQueryHandler(QueryHandlerCallable):
         self.client = client
         self.__model = model_name
 
+    @classmethod
+    def create(cls,
+               model_name: str,
+               prompt_generator: PromptGeneratorCallable,
+               response_parser: ResponseParser,
+               api_key: str | None = None,
+               api_base_url: str | None = None,
+               **options) -> GeminiQueryHandler:
+        from google import genai
+        from google.genai import types
+        # pass api key and use default host, the rate limiter retries
+        return cls(model_name=model_name,
+                   client=genai.Client(api_key=api_key, http_options=types.HttpOptions(
+                       base_url=api_base_url, retry_options=types.HttpRetryOptions(attempts=1))),
+                   prompt_generator=prompt_generator,
+                   response_parser=response_parser)
+
+    def _config(self) -> types.GenerateContentConfig:
+        from google.genai import types
+        if self.response_schema is None:
+            return types.GenerateContentConfig(
+                system_instruction=SYSTEM_PROMPT,
+                temperature=0.0
+            )
+        return types.GenerateContentConfig(
+            system_instruction=SYSTEM_PROMPT,
+            temperature=0.0,
+            response_mime_type="application/json",
+            response_json_schema=self.response_schema
+        )
+
+    def _record_usage(self, response: types.GenerateContentResponse) -> None:
+        if response.usage_metadata is not None:
+            self.last_usage = (response.usage_metadata.prompt_token_count,
+                               response.usage_metadata.candidates_token_count)
+
+    def _stream_gemini(self, question: str) -> Iterator[str]:
+        # every streamed response holds the next part of the text
+        stream = self.client.models.generate_content_stream(
+            model=self.__model,
+            contents=question,
+            config=self._config()
+        )
+        try:
+            for response in stream:
+                self._record_usage(response)
+                if response.text:
+                    yield response.text
+        finally:
+            stream.close()
+
     def __call__(self, question: str) -> str:
         super().__call__(question)
+        if self.stream:
+            return self._collect(self._stream_gemini(question), perf_counter())
+
         response = self.client.models.generate_content(
             model=self.__model,
             contents=question,
-            config=types.GenerateContentConfig(
-                system_instruction='Act as a security expert.',
-                temperature=0.0
-            )
+            config=self._config()
         )
 
+        self._record_usage(response)
         return response.text
 
 @register
@@ -395,13 +703,46 @@ class MistralQueryHandler(QueryHandlerCallable):
         self.client = client
         self.__model = model_name
 
+    @classmethod
+    def create(cls,
+               model_name: str,
+               prompt_generator: PromptGeneratorCallable,
+               response_parser: ResponseParser,
+               api_key: str | None = None,
+               api_base_url: str | None = None,
+               **options) -> MistralQueryHandler:
+        from mistralai import Mistral
+        # pass api key and use default host, the rate limiter retries
+        return cls(model_name=model_name,
+                   client=Mistral(api_key=api_key, server_url=api_base_url, retry_config=None),
+                   prompt_generator=prompt_generator,
+                   response_parser=response_parser)
+
+    def _stream_mistral(self, question: str) -> Iterator[str]:
+        # completion events of a streamed chat, the last one holds the usage
+        with self.client.chat.stream(model=self.__model, messages=[{
+                "content": question,
+                "role": "user",
+            }], **chat_response_format(self.response_schema)) as stream:
+            for event in stream:
+                chunk = event.data
+                if chunk.usage is not None:
+                    self.last_usage = (chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                if chunk.choices and isinstance(chunk.choices[0].delta.content, str):
+                    yield chunk.choices[0].delta.content
+
     def __call__(self, question: str) -> str:
         super().__call__(question)
+        if self.stream:
+            return self._collect(self._stream_mistral(question), perf_counter())
+
         response = self.client.chat.complete(model=self.__model, messages=[{
                 "content": question,
                 "role": "user",
-            }], stream=False)
+            }], stream=False, **chat_response_format(self.response_schema))
 
+        if response.usage is not None:
+            self.last_usage = (response.usage.prompt_tokens, response.usage.completion_tokens)
         return response.choices[0].message.content
 
 @register
@@ -410,38 +751,187 @@ class OllamaQueryHandler(QueryHandlerCallable):
     __model: str
     __host: str
 
+    # how long the server keeps the model loaded after a request
+    __keep_alive: str | None
+
     def __init__(self,
                  model_name: str,
-                 client: str,
+                 client: OllamaClient,
                  prompt_generator: PromptGeneratorCallable,
-                 response_parser: ResponseParser) -> None:
+                 response_parser: ResponseParser,
+                 keep_alive: str | None = None) -> None:
 
         super().__init__(prompt_generator, response_parser)
         self.client = client
         self.__model = model_name
+        self.__keep_alive = keep_alive
+
+    @classmethod
+    def create(cls,
+               model_name: str,
+               prompt_generator: PromptGeneratorCallable,
+               response_parser: ResponseParser,
+               host: str | None = None,
+               api_base_url: str | None = None,
+               keep_alive: str | None = None,
+               **options) -> OllamaQueryHandler:
+        from ollama import Client as OllamaClient
+        return cls(model_name=model_name,
+                   client=OllamaClient(host=api_base_url or host),
+                   prompt_generator=prompt_generator,
+                   response_parser=response_parser,
+                   keep_alive=keep_alive)
+
+    def _chat(self, question: str, stream: bool):
+        # the static instructions of the template start every prompt, the
+        # server reuses their cached evaluation while the model stays loaded
+        return self.client.chat(model=self.__model, messages=[{
+                'role': 'user',
+                'content': question,
+            }], stream=stream, format=self.response_schema, keep_alive=self.__keep_alive)
+
+    def _stream_ollama(self, question: str) -> Iterator[str]:
+        # closing the generator closes the connection, the server stops generating
+        stream = self._chat(question, stream=True)
+        try:
+            for part in stream:
+                if part.eval_count is not None:
+                    self.last_usage = (part.prompt_eval_count, part.eval_count)
+                if part.message.content:
+                    yield part.message.content
+        finally:
+            stream.close()
 
     def __call__(self, question: str) -> str:
         super().__call__(question)
-        response = self.client.chat(model=self.__model, messages=[{
-                'role': 'user',
-                'content': question,
-                'stream': False,
-            }])
+        if self.stream:
+            return self._collect(self._stream_ollama(question), perf_counter())
 
+        response = self._chat(question, stream=False)
+        if response.eval_count is not None:
+            self.last_usage = (response.prompt_eval_count, response.eval_count)
         return response.message.content
 
+class GPT4ALLKVCache:
+    """Prefix evaluated into the KV cache of a local model, none after a reset."""
+    prefix: str | None = None
+    # tokens of system prompt and prefix
+    prefix_tokens: int = 0
+    # chat template of the remaining prompt and the response
+    suffix_template: str = "%1%2"
+
 @register
 class GPT4ALLQueryHandler(QueryHandlerCallable):
+    """
+    Query a local model, which stays loaded for the whole run. The system
+    prompt and the static prefix of the prompt template are evaluated once,
+    for every package the KV cache of the model is rewound to the end of
+    the prefix and only the remaining prompt is evaluated. In streaming
+    mode the generation stops once the answer is complete. The bindings
+    offer no constrained sampling, the output is parsed as free text.
+    """
+    # no grammar support in the gpt4all bindings
+    STRUCTURED_OUTPUT: bool = False
     _model: GPT4All
     _chat_session = None
+    # KV cache state of the model, shared by the copies of with_prompt
+    _kv_cache: GPT4ALLKVCache
+    # whether the bindings expose the KV cache the prefix reuse relies on
+    _reuses_prefix: bool
 
     def __init__(self, model: GPT4All,
                  prompt_generator: PromptGeneratorCallable,
                  response_parser: ResponseParser) -> None:
         super().__init__(prompt_generator, response_parser)
         self._model = model
+        self._kv_cache = GPT4ALLKVCache()
+        self._reuses_prefix = self._supports_prefix_reuse(model)
+
+    @staticmethod
+    def _supports_prefix_reuse(model: GPT4All) -> bool:
+        # the prefix reuse depends on internals of the gpt4all 2.x bindings
+        # (LLModel.prompt_model with a prompt template, context.n_past),
+        # other versions generate every prompt in a fresh chat session
+        llmodel = getattr(model, "model", None)
+        prompt_model = getattr(llmodel, "prompt_model", None)
+        if prompt_model is None or not hasattr(getattr(llmodel, "context", None), "n_past"):
+            log.warning("The gpt4all bindings do not expose the KV cache, the prompt prefix is not reused.")
+            return False
+        parameters = inspect.signature(prompt_model).parameters
+        if not {"prompt_template", "reset_context", "special"}.issubset(parameters):
+            log.warning("Unsupported gpt4all prompt_model signature, the prompt prefix is not reused.")
+            return False
+        return True
+
+    @classmethod
+    def create(cls,
+               model_name: str,
+               prompt_generator: PromptGeneratorCallable,
+               response_parser: ResponseParser,
+               device: str = "cuda",
+               **options) -> GPT4ALLQueryHandler:
+        from gpt4all import GPT4All
+        return cls(model=GPT4All(f"{model_name}.gguf", device=device),
+                   prompt_generator=prompt_generator,
+                   response_parser=response_parser)
+
+    def _evaluate_prefix(self, prefix: str) -> None:
+        # evaluate system prompt and prefix like the first turn of a chat session
+        llmodel = self._model.model
+        template = (self._model.config.get("promptTemplate") or GPT4ALL_DEFAULT_PROMPT_TEMPLATE) \
+            .format("%1", "%2")
+        if "%2" not in template:
+            template += "%2"
+        user_template, suffix_template = template.split("%1", 1)
+
+        llmodel.prompt_model(self._model.config.get("systemPrompt", ""), "%1%2",
+                             lambda token_id, response: True,
+                             n_predict=0, n_batch=PREFILL_BATCH, reset_context=True, special=True)
+        llmodel.prompt_model(prefix, user_template + "%1%2",
+                             lambda token_id, response: True,
+                             n_predict=0, n_batch=PREFILL_BATCH)
+        self._kv_cache.prefix = prefix
+        self._kv_cache.prefix_tokens = llmodel.context.n_past
+        self._kv_cache.suffix_template = "%1" + suffix_template
+        log.info(f"Evaluated static prompt prefix of {self._kv_cache.prefix_tokens} tokens.")
+
+    def _callback(self, response: List[str], start: float):
+        # collect the generated text, in streaming mode the generation
+        # stops once the answer is complete
+        if not self.stream:
+            return lambda token_id, text: response.append(text) or True
+
+        detector = self.response_parser.detector()
+        def callback(token_id, text):
+            response.append(text)
+            if detector.feed(text):
+                self._usage_state.last_time_to_result = perf_counter() - start
+                self._usage_state.last_stopped_early = True
+                return False
+            return True
+        return callback
 
     def __call__(self, question: str) -> str:
         super().__call__(question)
-        with self._model.chat_session():# "Act as a cyber security professional which answers using csv."):
-            return self._model.generate(question, max_tokens=1024, temp=0.0)
+        start = perf_counter()
+        response = []
+        prefix = getattr(self.prompt_generator, "static_prefix", "")
+        if not self._reuses_prefix or not prefix or not question.startswith(prefix):
+            # the chat session resets the KV cache, the prefix is evaluated again next time
+            self._kv_cache.prefix = None
+            with self._model.chat_session():# "Act as a cyber security professional which answers using csv."):
+                self._model.generate(question, max_tokens=GPT4ALL_MAX_TOKENS, temp=0.0,
+                                     n_batch=PREFILL_BATCH, callback=self._callback(response, start))
+                return "".join(response)
+
+        if self._kv_cache.prefix != prefix:
+            self._evaluate_prefix(prefix)
+
+        # continue after the prefix, the rest of the KV cache is overwritten
+        llmodel = self._model.model
+        llmodel.context.n_past = self._kv_cache.prefix_tokens
+        llmodel.prompt_model(question[len(prefix):], self._kv_cache.suffix_template,
+                             self._callback(response, start),
+                             n_predict=GPT4ALL_MAX_TOKENS, temp=0.0, top_k=40, top_p=0.4,
+                             repeat_penalty=1.18, repeat_last_n=64, n_batch=PREFILL_BATCH)
+        return "".join(response)
@@ -0,0 +1,17 @@
+You are analyzing {count} Fedora packages.
+
+Goal:
+Decide for each package if it is related to cryptography in any way.
+
+"Cryptographic relevance" means the package:
+- Implements, uses, or helps cryptographic functions such as encryption, decryption, hashing, signing, key exchange, authentication, certificate handling, or secure random number generation.
+
+If there is no clear sign of cryptographic use, return false.
+
+Output only a valid JSON array with exactly one object per package, in the order of the packages below. Explain the reasoning of every package in 2 short sentences, mention relevant clues from name, description, or dependencies.
+[
+{answer_format}
+]
+
+Packages:
+{packages}
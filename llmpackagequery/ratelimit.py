@@ -0,0 +1,334 @@
+import logging
+import random
+import re
+import threading
+
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep, time
+from typing import Dict, Tuple
+
+log = logging.getLogger(__name__)
+
+# HTTP status codes below 500 worth a retry, all server errors are retried
+TRANSIENT_STATUS = (408, 409, 425, 429)
+RATE_LIMITED_STATUS = 429
+# headers telling when to retry, in order of preference
+RETRY_AFTER_HEADERS = ("retry-after-ms", "retry-after",
+                       "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+# durations like "6m0s" or "20ms" of the x-ratelimit-reset-* headers
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+# characters per token to estimate the tokens of a prompt
+CHARS_PER_TOKEN = 4
+
+# requests and tokens per minute, None is unlimited
+RateLimit = Tuple[float | None, float | None]
+
+@dataclass
+class TransientError:
+    """Classification of an error which is worth a retry."""
+    cause: str
+    retry_after: float | None = None
+
+def _parse_duration(value: str) -> float | None:
+    # seconds, an HTTP date or a duration like "1m30s"
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if parts and "".join(number + unit for number, unit in parts) == value:
+        return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+def retry_after(headers) -> float | None:
+    """Seconds to wait according to the rate limit headers of a response."""
+    if headers is None:
+        return None
+    for header in RETRY_AFTER_HEADERS:
+        value = headers.get(header)
+        if value is None:
+            continue
+        seconds = _parse_duration(value)
+        if seconds is not None:
+            return seconds / 1000 if header == "retry-after-ms" else seconds
+    return None
+
+def classify_error(error: BaseException) -> TransientError | None:
+    """
+    Classify an error of a provider SDK, None if it is not transient.
+    The SDKs are not imported, their errors are recognized by the status
+    code (status_code of OpenAI, Mistral and Ollama, code of Gemini) and
+    connection errors by the exception chain.
+    """
+    status = getattr(error, "status_code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "code", None)
+    if isinstance(status, int) and status > 0:
+        if status not in TRANSIENT_STATUS and status < 500:
+            return None
+        response = getattr(error, "response", None) or getattr(error, "raw_response", None)
+        headers = getattr(error, "headers", None) or getattr(response, "headers", None)
+        return TransientError(
+            cause="rate_limited" if status == RATE_LIMITED_STATUS else f"status_{status}",
+            retry_after=retry_after(headers))
+
+    # SDKs wrap the errors of the HTTP client, it is loaded with the SDKs
+    import httpx
+    cause = error
+    while cause is not None:
+        if isinstance(cause, (httpx.TimeoutException, TimeoutError)):
+            return TransientError(cause="timeout")
+        if isinstance(cause, (httpx.TransportError, ConnectionError)):
+            return TransientError(cause="connection")
+        cause = cause.__cause__ or cause.__context__
+    return None
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a prompt."""
+    return estimate_length_tokens(len(text))
+
+def estimate_length_tokens(length: int) -> int:
+    """Rough token count of a prompt of the given length."""
+    return length // CHARS_PER_TOKEN + 1
+
+class TokenBucket:
+    """
+    Token bucket refilled with a rate per minute, holding at most one
+    minute of tokens. The bucket can go into debt if more was used than
+    acquired, later requests wait until it is paid back.
+    """
+    rate: float
+    _capacity: float
+    _tokens: float
+    _updated: float
+
+    def __init__(self, rate_per_min: float) -> None:
+        self.rate = rate_per_min
+        self._capacity = rate_per_min
+        self._tokens = rate_per_min
+        self._updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self.rate / 60)
+        self._updated = now
+
+    def take(self, amount: float) -> float:
+        """Take tokens, returns the seconds to wait before they are available."""
+        self._refill()
+        # a request larger than the bucket must not wait forever
+        amount = min(amount, self._capacity)
+        self._tokens -= amount
+        return 0.0 if self._tokens >= 0 else -self._tokens * 60 / self.rate
+
+    def adjust(self, amount: float) -> None:
+        """Correct a former take by the difference to the actual amount."""
+        self._refill()
+        self._tokens -= amount
+
+class CircuitBreaker:
+    """
+    Opens after consecutive transient failures and pauses all requests
+    for a cool down, which doubles while the failures continue. When the
+    cool down is over a single trial request is let through, its success
+    closes the breaker.
+    """
+    _threshold: int
+    _cooldown: float
+    _max_cooldown: float
+    _failures: int
+    _current_cooldown: float
+    _open_until: float
+    _trial: bool
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0, max_cooldown: float = 600.0) -> None:
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._max_cooldown = max_cooldown
+        self._failures = 0
+        self._current_cooldown = cooldown
+        self._open_until = 0.0
+        self._trial = False
+
+    @property
+    def open(self) -> bool:
+        return self._failures >= self._threshold
+
+    def wait_time(self) -> float:
+        """Seconds to wait before a request may be sent, 0 to send now."""
+        if not self.open:
+            return 0.0
+        remaining = self._open_until - monotonic()
+        if remaining > 0:
+            return remaining
+        if self._trial:
+            # wait for the result of the trial request
+            return min(1.0, self._cooldown)
+        self._trial = True
+        return 0.0
+
+    def succeeded(self) -> bool:
+        """Record a success, returns whether the breaker was closed by it."""
+        was_open = self.open
+        self._failures = 0
+        self._current_cooldown = self._cooldown
+        self._trial = False
+        return was_open
+
+    def failed(self) -> bool:
+        """Record a transient failure, returns whether the breaker (re)opened."""
+        if self.open:
+            if not self._trial:
+                # failure of a request sent before the breaker opened
+                return False
+            # the trial request failed
+            self._trial = False
+            self._current_cooldown = min(self._max_cooldown, self._current_cooldown * 2)
+        else:
+            self._failures += 1
+            if not self.open:
+                return False
+        self._open_until = monotonic() + self._current_cooldown
+        return True
+
+class _ModelLimit:
+    # state of one provider and model
+    requests: TokenBucket | None
+    tokens: TokenBucket | None
+    breaker: CircuitBreaker
+    max_requests_rate: float | None
+    blocked_until: float = 0.0
+
+    def __init__(self,
+                 requests_per_min: float | None,
+                 tokens_per_min: float | None,
+                 breaker: CircuitBreaker) -> None:
+        self.requests = TokenBucket(requests_per_min) if requests_per_min else None
+        self.tokens = TokenBucket(tokens_per_min) if tokens_per_min else None
+        self.max_requests_rate = requests_per_min
+        self.breaker = breaker
+
+class RateLimiter:
+    """
+    Throttling shared by all handlers of a run. Every provider and model
+    (model id, e.g. "openai.gpt-5") has a bucket of requests and of tokens
+    per minute and a circuit breaker. Rate limit responses pause the model
+    for the time given by the provider and lower the request rate, which
+    recovers slowly with successful requests. Other transient errors are
+    retried with jittered exponential backoff.
+    """
+    _limits: Dict[str, RateLimit]
+    _models: Dict[str, _ModelLimit]
+    _lock: threading.Lock
+    _breaker_threshold: int
+    _breaker_cooldown: float
+    _backoff_base: float
+    _backoff_max: float
+    _random: random.Random
+
+    # decrease of the request rate on rate limit responses
+    RATE_DECREASE: float = 0.7
+    # share of the configured rate regained per successful request
+    RATE_RECOVERY: float = 0.01
+
+    def __init__(self,
+                 limits: Dict[str, RateLimit] | None = None,
+                 breaker_threshold: int = 5,
+                 breaker_cooldown: float = 30.0,
+                 backoff_base: float = 1.0,
+                 backoff_max: float = 60.0) -> None:
+        """
+        limits maps a model id or query stub to (requests per minute,
+        tokens per minute), the model id takes precedence, None is unlimited.
+        """
+        self._limits = limits or {}
+        self._models = {}
+        self._lock = threading.Lock()
+        self._breaker_threshold = breaker_threshold
+        self._breaker_cooldown = breaker_cooldown
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._random = random.Random()
+
+    def _model(self, model_id: str) -> _ModelLimit:
+        # called with the lock held
+        model = self._models.get(model_id)
+        if model is None:
+            requests_per_min, tokens_per_min = self._limits.get(
+                model_id, self._limits.get(model_id.split(".", 1)[0], (None, None)))
+            model = self._models[model_id] = _ModelLimit(
+                requests_per_min, tokens_per_min,
+                CircuitBreaker(self._breaker_threshold, self._breaker_cooldown))
+        return model
+
+    def acquire(self, model_id: str, tokens: int) -> float:
+        """
+        Wait until a request with the estimated tokens may be sent,
+        returns the seconds waited.
+        """
+        waited = 0.0
+        reserved = False
+        while not reserved:
+            with self._lock:
+                model = self._model(model_id)
+                # paused by the provider or the circuit breaker
+                wait_time = model.blocked_until - monotonic()
+                if wait_time <= 0:
+                    wait_time = model.breaker.wait_time()
+                if wait_time <= 0:
+                    # the request is reserved, the buckets go into debt
+                    # and the request waits until they are refilled
+                    reserved = True
+                    wait_time = max(model.requests.take(1) if model.requests else 0.0,
+                                    model.tokens.take(tokens) if model.tokens else 0.0)
+            if wait_time > 0:
+                sleep(wait_time)
+                waited += wait_time
+        return waited
+
+    def succeeded(self, model_id: str, estimated_tokens: int, usage: Tuple[int, int] | None) -> None:
+        """Record a successful request with its actual token usage."""
+        with self._lock:
+            model = self._model(model_id)
+            if model.breaker.succeeded():
+                log.info(f"Circuit breaker of {model_id} closed.")
+            if model.tokens is not None and usage is not None:
+                model.tokens.adjust(sum(count or 0 for count in usage) - estimated_tokens)
+            if model.requests is not None and model.requests.rate < model.max_requests_rate:
+                model.requests.rate = min(model.max_requests_rate, model.requests.rate
+                                          + self.RATE_RECOVERY * model.max_requests_rate)
+
+    def failed(self, model_id: str, error: BaseException, attempt: int) -> TransientError | None:
+        """
+        Record a failed request. Returns None if the error is not transient,
+        otherwise the caller waits before the retry.
+        """
+        transient = classify_error(error)
+        if transient is None:
+            return None
+
+        with self._lock:
+            model = self._model(model_id)
+            if transient.retry_after is not None:
+                # pause all requests of the model as told by the provider
+                model.blocked_until = max(model.blocked_until, monotonic() + transient.retry_after)
+            if transient.cause == "rate_limited" and model.requests is not None:
+                model.requests.rate = max(1.0, model.requests.rate * self.RATE_DECREASE)
+                log.info(f"Rate limited by {model_id}, lowering to {model.requests.rate:,.1f} requests/min.")
+            if model.breaker.failed():
+                log.warning(f"Circuit breaker of {model_id} opened, pausing requests.")
+
+        if transient.retry_after is None:
+            # full jitter, the pause of the breaker is waited in acquire
+            sleep(self._random.uniform(0, min(self._backoff_max, self._backoff_base * 2 ** attempt)))
+        return transient
+
+    def breaker_open(self, model_id: str) -> bool:
+        with self._lock:
+            return self._model(model_id).breaker.open
@@ -1,20 +1,26 @@
 import sys
-import csv
 import logging
 
-from time import time, sleep
-from typing import List, Set
-
-from openai import OpenAI
-from writer import CSVResultsWriter
-from ollama import Client as OllamaClient
-from google import genai
-from google.genai import errors
-
-from gpt4all import GPT4All
-from query import QueryStub, QueryHandlerCallable, TemplateBasedPromptGenerator, get_class
-
-from mistralai import Mistral
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from time import monotonic, perf_counter, time
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+import config
+from cache import ResponseCache
+from compaction import CompactingBatchPromptGenerator, compact_query_handler, report_compaction
+from incremental import PreviousRun
+from metrics import Metrics, MetricsExporter
+from ratelimit import RateLimit, RateLimiter, estimate_tokens
+from packages import read_packages
+from rules import RULES_DECIDER, PreClassifier
+from store import ResultStore, RunRecorder, template_name
+from writer import CHECKPOINT_FILE, Checkpoint, CSVResultsWriter, prepare_resume
+from writer import DECIDED_BY_ATTRIBUTE, format_results, split_results
+from query import QueryStub, QueryHandlerCallable, TemplateBasedPromptGenerator, attributes_schema, get_class
+from query import PromptGeneratorCallable
+from query import BatchPromptGeneratorCallable, BatchTemplateBasedPromptGenerator
 
 log = logging.getLogger(__name__)
 
@@ -25,20 +31,53 @@ class RequestManger:
     _package_file_in: str
     _package_file_out: str
     _query_restriction: int
+    _max_in_flight: int
+    _response_cache: ResponseCache | None
+    _resume: bool
+    _previous_run: PreviousRun | None
+    _batch_size: int
+    _batch_prompt_generator: BatchPromptGeneratorCallable | None
+    _pre_classifier: PreClassifier | None
+    _metrics: Metrics
+    _rate_limiter: RateLimiter
+    _result_recorder: RunRecorder | None
+    _progress_time: float | None = None
 
     RETRY_COUNT:int = 3
+    # seconds a request waits for an open circuit breaker before it gives up
+    BREAKER_MAX_WAIT: float = 900.0
 
     def __init__(self,
                  query_handler: QueryHandlerCallable,
                  package_file_in: str,
                  package_file_out: str,
                  query_restriction: int = sys.maxsize,
-                 log_iterations: int = PACKAGE_LOG_ITERATIONS) -> None:
+                 log_iterations: int = PACKAGE_LOG_ITERATIONS,
+                 max_in_flight: int = 1,
+                 response_cache: ResponseCache | None = None,
+                 resume: bool = False,
+                 previous_run: PreviousRun | None = None,
+                 batch_size: int = 1,
+                 batch_prompt_generator: BatchPromptGeneratorCallable | None = None,
+                 pre_classifier: PreClassifier | None = None,
+                 metrics: Metrics | None = None,
+                 rate_limiter: RateLimiter | None = None,
+                 result_recorder: RunRecorder | None = None) -> None:
 
         self._query_handler = query_handler
         self._package_file_in = package_file_in
         self._package_file_out = package_file_out
         self._query_restriction = query_restriction
+        self._max_in_flight = max(1, max_in_flight)
+        self._response_cache = response_cache
+        self._resume = resume
+        self._previous_run = previous_run
+        self._batch_size = max(1, batch_size) if batch_prompt_generator else 1
+        self._batch_prompt_generator = batch_prompt_generator
+        self._pre_classifier = pre_classifier
+        self._metrics = metrics or Metrics()
+        self._rate_limiter = rate_limiter or RateLimiter()
+        self._result_recorder = result_recorder
 
         self.log_iterations = log_iterations
 
@@ -46,150 +85,735 @@ class RequestManger:
         # Read the package list from the CSV file
         # query the GPT API using the package names
         # and write the results to the CSV file
-        with open(self._package_file_in, mode='r') as file_read:
-            with open(self._package_file_out, mode='w', newline='') as file_write:
-                package_reader = csv.reader(file_read, delimiter=',', quotechar='"')
-                next(package_reader) # Skip the header
-
-                # get list to ensure the correct order of the attributes
-                write_attributes: Set[str] = self._query_handler.response_parser.attributes_list
-
-                with CSVResultsWriter(
-                        file_dst=file_write,
-                        package_header=write_attributes) as writer:
-                    # start the timer
-                    start_time = time()
-
-                    # iterate over the packages
-                    for idx, row in enumerate(package_reader):
-                        request_start_time = time()
-
-                        # execute query and write the results to the CSV file
-                        results = self.do_request(package_name=row[0], # Package Name
-                                            package_description=row[2], # Package Version
-                                            package_tree=row[3], # Package Description
-                                            query_handler=self._query_handler)
-                        writer.write_results(results)
-
-                        if self._query_restriction <= idx + 1:
-                            log.info(f"Stopping the package request at index {idx}.")
-                            self._log_progress(idx, start_time, request_start_time, force_log=True)
-                            break
-
-                        self._log_progress(idx, start_time, request_start_time)
+
+        # get list to ensure the correct order of the attributes
+        write_attributes: List[str] = self.write_attributes()
+
+        # continue an interrupted run at its last checkpoint
+        checkpoint = Checkpoint(input_offset=0, rows=0, file_size=0)
+        done_packages: Set[str] = set()
+        if self._resume:
+            checkpoint, done_packages = prepare_resume(
+                self._package_file_out, write_attributes)
+            log.info(f"Resuming {self._package_file_out} at input offset " \
+                     f"{checkpoint.input_offset} with {checkpoint.rows} rows written.")
+
+        # stream the packages, the input is never materialized
+        package_reader = read_packages(self._package_file_in)
+        with open(self._package_file_out, mode='a' if self._resume else 'w', newline='') as file_write:
+            with CSVResultsWriter(
+                    file_dst=file_write,
+                    package_header=write_attributes,
+                    checkpoint_file=CHECKPOINT_FILE.format(csv_file=self._package_file_out),
+                    checkpoint=checkpoint,
+                    recorder=self._result_recorder) as writer:
+                # start the timer
+                start_time = time()
+
+                # skip rows processed before the checkpoint and packages
+                # already written to the results
+                rows = islice(enumerate(package_reader), checkpoint.input_offset, None)
+                rows = ((offset, row) for offset, row in rows if row[0] not in done_packages)
+
+                # iterate over the packages, results are returned
+                # in the order of the input file
+                rows = islice(rows, self._query_restriction)
+                for idx, (offset, results) in enumerate(self._ordered_results(rows)):
+                    with self._metrics.timer("write"):
+                        writer.write_results(results, input_offset=offset + 1)
+
+                    if self._query_restriction <= idx + 1:
+                        log.info(f"Stopping the package request at index {idx}.")
+                        self._log_progress(idx, start_time, force_log=True)
+                        break
+
+                    self._log_progress(idx, start_time)
+
+        self._log_summary()
+
+    def _log_summary(self) -> None:
+        # report the packages which were not sent to the model
+        if self._previous_run is not None:
+            log.info(f"Carried forward {self._previous_run.carried} unchanged packages " \
+                     "from the previous run.")
+        if self._pre_classifier is not None:
+            log.info(f"Pre-classifier decided {self._pre_classifier.decided} packages, " \
+                     f"saved {self._pre_classifier.decided} model requests.")
+
+        summary = self._metrics.summary()
+        for stage, timing in summary["stages"].items():
+            log.info(f"Stage {stage}: {timing['count']} times, {timing['total']:,.2f}s total, " \
+                     f"{timing['mean']:,.3f}s mean, {timing['max']:,.3f}s max")
+        for name, counts in summary["counters"].items():
+            log.info(f"{name}: {counts}")
+        for model_id, tokens in summary["tokens"].items():
+            log.info(f"Tokens of {model_id}: {tokens}")
+
+    @property
+    def model_id(self) -> str:
+        return self._query_handler.model_id
+
+    def write_attributes(self) -> List[str]:
+        """Header of the results file."""
+        attributes = self._query_handler.response_parser.attributes_list
+        if self._pre_classifier is not None:
+            return attributes + [DECIDED_BY_ATTRIBUTE]
+        return attributes
+
+    def _previous_result(self, row: List[str]) -> str | None:
+        # result of an unchanged package in the previous run
+        if self._previous_run is None:
+            return None
+        previous = self._previous_run.lookup(row)
+        return None if previous is None else format_results(previous)
+
+    def _pre_classify(self, row: List[str]) -> str | None:
+        # result of a package decided without the model
+        if self._pre_classifier is None:
+            return None
+        decided = self._pre_classifier(row)
+        return None if decided is None else format_results(decided + [RULES_DECIDER])
+
+    def _model_decided(self, results: str) -> str:
+        # mark results of the model if the pre-classifier is used
+        if self._pre_classifier is None:
+            return results
+        attributes = self._query_handler.response_parser.attributes_list
+        return format_results(split_results(results, len(attributes)) + [self._query_handler.model_id])
+
+    def _request_row(self, row: List[str]) -> str:
+        # unchanged packages keep the result of the previous run
+        previous = self._previous_result(row)
+        if previous is not None:
+            return previous
+
+        pre_classified = self._pre_classify(row)
+        if pre_classified is not None:
+            return pre_classified
+
+        # execute query for one row of the package list
+        return self._model_decided(
+                self.do_request(package_name=row[0], # Package Name
+                                package_description=row[2], # Package Description
+                                package_tree=row[3], # Package Dependencies
+                                query_handler=self._query_handler))
+
+    def _request_chunk(self,
+                       chunk: List[Tuple[int, List[str]]]) -> List[Tuple[int, str]]:
+        # execute a chunk of rows, as one batched prompt if enabled
+        if len(chunk) == 1:
+            offset, row = chunk[0]
+            return [(offset, self._request_row(row))]
+
+        results = self._request_batch([row for _, row in chunk])
+        return [(offset, result) for (offset, _), result in zip(chunk, results)]
+
+    def _chunks(self,
+                rows: Iterable[Tuple[int, List[str]]]) -> Iterator[List[Tuple[int, List[str]]]]:
+        # group the rows into chunks of batch size
+        rows = iter(rows)
+        while chunk := list(islice(rows, self._batch_size)):
+            yield chunk
+
+    def _ordered_results(self,
+                         rows: Iterable[Tuple[int, List[str]]]) -> Iterator[Tuple[int, str]]:
+        """
+        Execute the requests for all (input offset, row) pairs and yield
+        the offset with the result in input order.
+        At most max_in_flight requests are executed concurrently, a small
+        window of finished requests is kept to preserve the order.
+        """
+        if self._max_in_flight == 1:
+            for chunk in self._chunks(rows):
+                yield from self._request_chunk(chunk)
+            return
+
+        window_size = 2 * self._max_in_flight
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self._max_in_flight) as executor:
+            try:
+                for chunk in self._chunks(rows):
+                    pending.append(executor.submit(self._request_chunk, chunk))
+                    if len(pending) >= window_size:
+                        yield from pending.popleft().result()
+
+                while pending:
+                    yield from pending.popleft().result()
+            finally:
+                # stop queued requests if the consumer stops early
+                for future in pending:
+                    future.cancel()
+
+    def classify(self, rows: List[List[str]]) -> Iterator[str]:
+        """
+        Yield the results of the rows in their order as they are available,
+        requested like the packages of a package list.
+        """
+        for _, result in self._ordered_results(enumerate(rows)):
+            yield result
 
     def _log_progress(self,
                       idx: int,
                       start_time: float,
-                      request_start_time: float,
                       force_log: bool = False) -> None:
-        # Log the progress
+        # Log the progress, the interval covers all packages since the last log
         if idx % self.log_iterations == 0 or force_log:
             time_current = time()
-            log.info(f"{self.log_iterations} requests: {time_current - request_start_time:,.2f}; " \
-                     f"overall: {time_current - start_time:,.2f}, Current index: {idx}")
+            interval = time_current - (self._progress_time or start_time)
+            self._progress_time = time_current
+            log.info(f"{self.log_iterations} requests: {interval:,.2f}; " \
+                     f"overall: {time_current - start_time:,.2f}, Current index: {idx}, " \
+                     f"in flight: {self._metrics.requests_in_flight}")
             log.info("-"*30)
 
     def do_request(self, package_name: str,
                package_description: str,
                package_tree: str,
-               query_handler: QueryHandlerCallable) -> str:
-
-        # create question
-        question = query_handler.generate_question_for_package(
-            name=package_name,
-            description=package_description,
-            dependencies=package_tree)
+               query_handler: QueryHandlerCallable,
+               question: str | None = None) -> str:
+
+        # create question unless it was already rendered
+        if question is None:
+            with self._metrics.timer("render"):
+                question = query_handler.generate_question_for_package(
+                    name=package_name,
+                    description=package_description,
+                    dependencies=package_tree)
+
+        # answer from the cache if the same prompt was already sent to the model
+        if self._response_cache is not None:
+            cached = self._response_cache.get(query_handler, question)
+            if cached is not None and cached[1] is not None:
+                self._metrics.count("cache_hits", query_handler.model_id)
+                return cached[1]
 
         # ask the question
         attempt = 0
         response = None
         parsed_response = None
         while attempt < self.RETRY_COUNT:
-            try:
-                attempt += 1
-                response = query_handler(question)
-            except errors.ServerError as e:
-                pause_time = 2 ** attempt
-                log.warning(f"Server error on attempt {attempt} for package {package_name}: {e}")
-                log.warning(f"Pausing for {pause_time} seconds before retrying...")
-                sleep(pause_time)
-                continue
+            attempt += 1
+            # a parse retry is a single request, transient errors were retried before
+            retry = self._ask(query_handler, question, f"package {package_name}",
+                              attempts=self.RETRY_COUNT if attempt == 1 else 1)
+            if retry is None:
+                break
+            response = retry
 
-            parsed_response = query_handler.parse_response(response, package_name)
+            with self._metrics.timer("parse"):
+                parsed_response = query_handler.parse_response(response, package_name)
+            parse_error = query_handler.response_parser.last_error
+
+            if self._response_cache is not None:
+                # keep unparsable responses, they can be re-parsed later
+                self._response_cache.put(
+                    query_handler, question, package_name, response,
+                    parsed_response if parse_error is None else None)
 
             # if parser did not set an error, we are done
-            if query_handler.response_parser.last_error is None:
+            if parse_error is None:
                 break
 
+            self._metrics.count("parse_failures", type(query_handler.response_parser).__name__)
+            if attempt < self.RETRY_COUNT:
+                self._metrics.count("retries", "parse_error")
             log.warning(f"Parse attempt {attempt} failed for package {package_name} executing retry...")
 
+        if response is None:
+            log.error(f"No response for package {package_name} after {self.RETRY_COUNT} attempts.")
         if parsed_response is None:
-            log.error(f"Could not parse response for package {package_name}: {response}")
+            if response is not None:
+                log.error(f"Could not parse response for package {package_name}: {response}")
             # create empty response for package name and for remaining attributes
             parsed_response = query_handler.response_parser.get_empty_response(package_name)
 
         # parse the response and return
         return parsed_response
 
-def execute(
+    def _ask(self, query_handler: QueryHandlerCallable, question: str, subject: str,
+             attempts: int | None = None) -> str | None:
+        """
+        Ask the model, transient errors of all providers are retried up to
+        attempts (default RETRY_COUNT) times. Failures while the circuit
+        breaker of the model is open do not use up the attempts, the request
+        waits for the breaker instead, at most BREAKER_MAX_WAIT seconds.
+        Returns None if all attempts failed.
+        """
+        attempts = attempts or self.RETRY_COUNT
+        attempt = 0
+        first_failure = None
+        while attempt < attempts:
+            attempt += 1
+            try:
+                return self._call_provider(query_handler, question, subject)
+            except Exception as e:
+                transient = self._rate_limiter.failed(query_handler.model_id, e, attempt)
+                if transient is None:
+                    raise
+                if first_failure is None:
+                    first_failure = monotonic()
+                log.warning(f"Transient error ({transient.cause}) on attempt {attempt} for {subject}: {e}")
+                if self._rate_limiter.breaker_open(query_handler.model_id):
+                    if monotonic() - first_failure < self.BREAKER_MAX_WAIT:
+                        attempt -= 1
+                    elif attempt >= attempts:
+                        log.error(f"Circuit breaker of {query_handler.model_id} open for more than " \
+                                  f"{self.BREAKER_MAX_WAIT:,.0f}s, giving up {subject}.")
+                if attempt < attempts:
+                    self._metrics.count("retries", transient.cause)
+        return None
+
+    def _call_provider(self,
+                       query_handler: QueryHandlerCallable,
+                       question: str,
+                       subject: str = "request") -> str:
+        # ask the model within its rate limits and record duration, time
+        # to result and token usage of the call
+        estimated_tokens = estimate_tokens(question)
+        self._metrics.observe("throttle", self._rate_limiter.acquire(query_handler.model_id, estimated_tokens))
+        start = perf_counter()
+        with self._metrics.in_flight(), self._metrics.timer("provider"):
+            response = query_handler(question)
+
+        # a streamed answer is complete before the response ends
+        time_to_result = query_handler.last_time_to_result or perf_counter() - start
+        self._metrics.observe("time_to_result", time_to_result)
+        if query_handler.last_stopped_early:
+            self._metrics.count("stopped_early", query_handler.model_id)
+        log.debug(f"Time to result of {subject}: {time_to_result:,.3f}s")
+
+        self._rate_limiter.succeeded(query_handler.model_id, estimated_tokens, query_handler.last_usage)
+        self._metrics.count("provider_requests", query_handler.model_id)
+        self._metrics.record_usage(query_handler.model_id, query_handler.last_usage)
+        return response
+
+    def _request_batch(self, rows: List[List[str]]) -> List[str]:
+        """
+        Execute one batched prompt for several rows of the package list.
+        Packages answered by a previous run or the cache are not part of
+        the prompt. Packages missing in the answer or failing to parse are
+        requested individually with do_request.
+        """
+        query_handler = self._query_handler
+        results: List[str | None] = [None] * len(rows)
+        questions: List[Tuple[int, str]] = []
+        for idx, row in enumerate(rows):
+            previous = self._previous_result(row)
+            if previous is not None:
+                results[idx] = previous
+                continue
+
+            pre_classified = self._pre_classify(row)
+            if pre_classified is not None:
+                results[idx] = pre_classified
+                continue
+
+            with self._metrics.timer("render"):
+                question = query_handler.generate_question_for_package(
+                    name=row[0], description=row[2], dependencies=row[3])
+            if self._response_cache is not None:
+                cached = self._response_cache.get(query_handler, question)
+                if cached is not None and cached[1] is not None:
+                    self._metrics.count("cache_hits", query_handler.model_id)
+                    results[idx] = self._model_decided(cached[1])
+                    continue
+
+            questions.append((idx, question))
+
+        if not questions:
+            return results
+
+        with self._metrics.timer("render"):
+            batch_question = self._batch_prompt_generator(
+                [(rows[idx][0], rows[idx][2], rows[idx][3]) for idx, _ in questions])
+        package_names = [rows[idx][0] for idx, _ in questions]
+
+        # ask the question, transient errors are retried
+        response = self._ask(query_handler, batch_question, f"batch of {len(questions)} packages")
+
+        items = {}
+        if response is not None:
+            with self._metrics.timer("parse"):
+                items = query_handler.response_parser.split_batch(response, package_names)
+
+        for (idx, question), package_name in zip(questions, package_names):
+            item = items.get(package_name)
+            if item is not None:
+                query_handler.response_parser.last_error = None
+                with self._metrics.timer("parse"):
+                    parsed_response = query_handler.parse_response(item, package_name)
+                if query_handler.response_parser.last_error is None:
+                    if self._response_cache is not None:
+                        # the object of the package answers its single prompt
+                        self._response_cache.put(
+                            query_handler, question, package_name, item, parsed_response)
+                    results[idx] = self._model_decided(parsed_response)
+                    continue
+
+            self._metrics.count("retries", "batch_item")
+            log.warning(f"Package {package_name} missing or invalid in batch response, executing single request...")
+            results[idx] = self._request_row(rows[idx])
+
+        return results
+
+def create_query_handler(
         query_stub: str,
         llm_model: str,
         prompt_template_file: str,
-        csv_file_out: str,
         attributes: List[str],
-        base_package_list: str,
         api_key: str,
         host: str,
-        query_restriction: int = sys.maxsize) -> None:
-
+        prompt_generator: PromptGeneratorCallable | None = None,
+        api_base_url: str | None = None,
+        keep_alive: str | None = config.OLLAMA_KEEP_ALIVE,
+        device: str = "cuda",
+        stream: bool = False,
+        structured_output: bool = False,
+        shared_with: QueryHandlerCallable | None = None) -> QueryHandlerCallable:
+    """
+    Create the query handler of a model. Handlers sharing a template
+    can share one prompt generator. api_base_url replaces the default
+    endpoint of the provider, e.g. to use a local stand-in server.
+    keep_alive is the time ollama keeps the model loaded between requests,
+    device the processing unit of gpt4all models. Streaming handlers stop
+    the generation once the answer is complete. With structured output the
+    backend constrains the answer to the schema of the attributes.
+    A handler of the same model given as shared_with lends its client or
+    loaded model instead of creating a new one.
+    """
     # translate string to class for parser
     response_parser_class = get_class(llm_model+"ResponseParser")
+    prompt_generator = prompt_generator or TemplateBasedPromptGenerator(
+        full_template_path=prompt_template_file)
+    response_parser = response_parser_class(attributes=attributes)
 
-    # set default parameters for the query handler
-    query_handler_parameters = {
-        "prompt_generator": TemplateBasedPromptGenerator(
-            full_template_path=prompt_template_file),
-        "response_parser": response_parser_class(attributes=attributes)
-    }
-
-    # set parameters for the respective query handler
-    if query_stub == QueryStub.OLLAMA.value:
-        # set ollama parameters
-        query_handler_parameters["client"] = \
-            OllamaClient(host=host)
-        query_handler_parameters["model_name"] = llm_model
-    elif query_stub == QueryStub.OPENAI.value:
-        # pass api key and use default host
-        query_handler_parameters["client"] = \
-            OpenAI(api_key=api_key)
-        query_handler_parameters["model_name"] = llm_model
-    elif query_stub == QueryStub.GPT4ALL.value:
-        # set gpt4all parameters
-        query_handler_parameters["model"] = \
-            GPT4All(f"{llm_model}.gguf", device="cuda")
-    elif query_stub == QueryStub.GEMINI.value:
-        # pass api key and use default host
-        query_handler_parameters["client"] = \
-            genai.Client(api_key=api_key)
-        query_handler_parameters["model_name"] = llm_model
-    elif query_stub == QueryStub.MISTRAL.value:
-        # pass api key and use default host
-        query_handler_parameters["client"] = \
-            Mistral(api_key=api_key)
-        query_handler_parameters["model_name"] = llm_model
-
-    # get class which handles the query
+    # get class which handles the query, the SDK of its provider is
+    # imported when the first handler is created
     query_handler_class = get_class(query_stub+"QueryHandler")
-    # instantiate the class with the given parameters
-    query_handler: QueryHandlerCallable = \
-        query_handler_class(**query_handler_parameters)
-
-    log.info("Starting requests ...")
-    request_manger = RequestManger(
-        query_handler=query_handler,
-        package_file_in=base_package_list,
-        package_file_out=csv_file_out,
-        query_restriction=query_restriction)
-
-    request_manger.run()
\ No newline at end of file
+    if shared_with is not None:
+        query_handler = shared_with.with_prompt(prompt_generator, response_parser)
+    else:
+        query_handler: QueryHandlerCallable = query_handler_class.create(
+            model_name=llm_model,
+            prompt_generator=prompt_generator,
+            response_parser=response_parser,
+            api_key=api_key,
+            host=host,
+            api_base_url=api_base_url,
+            keep_alive=keep_alive,
+            device=device)
+    query_handler.model_id = f"{query_stub}.{llm_model}"
+    query_handler.stream = stream
+    query_handler.response_schema = None
+    if structured_output:
+        if query_handler_class.STRUCTURED_OUTPUT:
+            query_handler.response_schema = attributes_schema(attributes, config.BOOLEAN_ATTRIBUTES)
+        else:
+            log.warning(f"{query_stub} cannot constrain the output to a schema, parsing free text.")
+
+    return query_handler
+
+class RunSetup:
+    """
+    Resources shared by the request managers of a run: response cache,
+    previous run, pre-classifier, result store, metrics with their exporter
+    and rate limiter. They are created from the parameters of execute (and
+    of the voting and cascade pipelines) and closed at the end of the run.
+    result_attributes is the header of the results file, the run is
+    recorded in the result store as recorded_model.
+    """
+    query_handlers: List[QueryHandlerCallable]
+    max_in_flight: int
+    response_cache: ResponseCache | None
+    pre_classifier: PreClassifier | None
+    previous_run: PreviousRun | None
+    result_recorder: RunRecorder | None
+    metrics: Metrics
+    rate_limiter: RateLimiter
+    _store: ResultStore | None
+    _metrics_exporter: MetricsExporter
+    _parameters: Dict
+
+    def __init__(self,
+                 query_handlers: List[QueryHandlerCallable],
+                 csv_file_out: str,
+                 attributes: List[str],
+                 result_attributes: List[str],
+                 base_package_list: str,
+                 recorded_model: str,
+                 template: str,
+                 query_restriction: int = sys.maxsize,
+                 max_in_flight: int = 1,
+                 cache_file: str | None = None,
+                 cache_max_age: float | None = None,
+                 cache_max_entries: int | None = None,
+                 cache_reparse: bool = False,
+                 resume: bool = False,
+                 previous_package_list: str | None = None,
+                 previous_results: str | None = None,
+                 preclassify_rules: Dict[str, List[str]] | None = None,
+                 decision_attribute: str | None = None,
+                 metrics_file: str | None = None,
+                 metrics_interval: float = 60.0,
+                 metrics_port: int | None = None,
+                 rate_limits: Dict[str, RateLimit] | None = None,
+                 result_store: str | None = None,
+                 verdict_attribute: str | None = None,
+                 startup: float | None = None) -> None:
+
+        self.query_handlers = query_handlers
+        self.max_in_flight = max_in_flight
+        if max_in_flight > 1 and any(query_handler.model_id.startswith(QueryStub.GPT4ALL.value + ".")
+                                     for query_handler in query_handlers):
+            # the local model cannot generate concurrently
+            log.warning(f"{QueryStub.GPT4ALL.value} does not support concurrent requests, " \
+                        f"ignoring max in flight {max_in_flight}.")
+            self.max_in_flight = 1
+
+        self.response_cache = None
+        if cache_file:
+            log.info(f"Using response cache {cache_file}")
+            self.response_cache = ResponseCache(
+                cache_file=cache_file,
+                max_age=cache_max_age,
+                max_entries=cache_max_entries)
+            if cache_reparse:
+                # apply the current parsers to all cached responses
+                for query_handler in query_handlers:
+                    self.response_cache.reparse(query_handler)
+
+        self.pre_classifier = None
+        if preclassify_rules is not None:
+            # decide obvious packages without the model
+            self.pre_classifier = PreClassifier(
+                rules=preclassify_rules,
+                attributes=attributes,
+                decision_attribute=decision_attribute)
+
+        self.previous_run = None
+        if previous_package_list and previous_results:
+            # incremental run, only query added or changed packages
+            log.info(f"Comparing with previous run {previous_results}")
+            self.previous_run = PreviousRun(
+                package_list=previous_package_list,
+                results_file=previous_results,
+                attributes=result_attributes)
+
+        self._store = None
+        self.result_recorder = None
+        if result_store:
+            log.info(f"Recording results in {result_store}")
+            self._store = ResultStore(result_store)
+            self.result_recorder = RunRecorder(
+                store=self._store,
+                model=recorded_model,
+                template=template,
+                package_list=base_package_list,
+                results_file=csv_file_out,
+                resume=resume,
+                verdict_attribute=verdict_attribute)
+
+        # durations, retries and token usage of the run
+        self.metrics = Metrics()
+        if startup is not None:
+            self.metrics.observe("startup", startup)
+        self._metrics_exporter = MetricsExporter(
+            metrics=self.metrics,
+            summary_file=metrics_file,
+            interval=metrics_interval,
+            port=metrics_port)
+        self.rate_limiter = RateLimiter(limits=rate_limits)
+
+        self._parameters = {
+            "package_file_in": base_package_list,
+            "package_file_out": csv_file_out,
+            "query_restriction": query_restriction,
+            "max_in_flight": self.max_in_flight,
+            "response_cache": self.response_cache,
+            "resume": resume,
+            "previous_run": self.previous_run,
+            "metrics": self.metrics,
+            "rate_limiter": self.rate_limiter,
+            "result_recorder": self.result_recorder
+        }
+
+    @property
+    def manger_parameters(self) -> Dict:
+        """Parameters of the request managers (RequestManger) set up by the run."""
+        return dict(self._parameters)
+
+    def __enter__(self):
+        self._metrics_exporter.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        report_compaction(self.query_handlers, self.metrics)
+        self._metrics_exporter.stop()
+        if self.response_cache is not None:
+            self.response_cache.close()
+        if self._store is not None:
+            self._store.close()
+
+def execute(
+        query_stub: str,
+        llm_model: str,
+        prompt_template_file: str,
+        csv_file_out: str,
+        attributes: List[str],
+        base_package_list: str,
+        api_key: str,
+        host: str,
+        query_restriction: int = sys.maxsize,
+        max_in_flight: int = 1,
+        cache_file: str | None = None,
+        cache_max_age: float | None = None,
+        cache_max_entries: int | None = None,
+        cache_reparse: bool = False,
+        resume: bool = False,
+        previous_package_list: str | None = None,
+        previous_results: str | None = None,
+        batch_size: int = 1,
+        batch_prompt_template_file: str | None = None,
+        preclassify_rules: Dict[str, List[str]] | None = None,
+        decision_attribute: str | None = None,
+        group_packages: bool = False,
+        group_similarity: float = 0.5,
+        group_verify_rate: float = 0.0,
+        group_topological: bool = False,
+        api_base_url: str | None = None,
+        metrics_file: str | None = None,
+        metrics_interval: float = 60.0,
+        metrics_port: int | None = None,
+        rate_limits: Dict[str, RateLimit] | None = None,
+        batch_job: bool = False,
+        batch_job_size: int = 50_000,
+        batch_poll_interval: float = 60.0,
+        query_handler: QueryHandlerCallable | None = None,
+        work_queue: str | None = None,
+        stream: bool = False,
+        structured_output: bool = False,
+        compact_prompts: bool = False,
+        prompt_token_budget: int | None = None,
+        result_store: str | None = None) -> None:
+    """
+    Query all packages of the package list. A query handler created
+    before, e.g. with a model already loaded, is used instead of a new one.
+    With the url of a work queue the packages are leased from its
+    coordinator, which writes the results, instead. Compacted prompts
+    leave out ubiquitous dependencies and fit the token budget of the model.
+    With a result store the results are recorded in it besides the CSV file.
+    """
+
+    if sum(map(bool, (group_packages, work_queue, batch_job))) > 1:
+        raise ValueError("Grouping, work queues and batch jobs cannot be combined.")
+
+    if query_stub == QueryStub.GPT4ALL.value and batch_size > 1:
+        # the answer of a local model is limited to GPT4ALL_MAX_TOKENS tokens
+        log.warning(f"{query_stub} does not support batched prompts, ignoring batch size {batch_size}.")
+        batch_size = 1
+
+    if structured_output and batch_size > 1 and batch_prompt_template_file:
+        # batched prompts are answered with an array of objects
+        log.warning("Structured output does not apply to batched prompts, ignoring it.")
+        structured_output = False
+
+    # time to create the client or load the model, none for a given handler
+    startup = None
+    if query_handler is None:
+        start = perf_counter()
+        query_handler = create_query_handler(
+            query_stub=query_stub,
+            llm_model=llm_model,
+            prompt_template_file=prompt_template_file,
+            attributes=attributes,
+            api_key=api_key,
+            host=host,
+            api_base_url=api_base_url,
+            stream=stream,
+            structured_output=structured_output)
+        startup = perf_counter() - start
+        log.info(f"Created query handler {query_handler.model_id} in {startup:,.2f}s")
+
+    if compact_prompts:
+        query_handler = compact_query_handler(query_handler, base_package_list, prompt_token_budget)
+
+    batch_prompt_generator = None
+    if batch_size > 1 and batch_prompt_template_file:
+        # several packages per prompt, single prompts are kept for retries
+        batch_prompt_generator = BatchTemplateBasedPromptGenerator(
+            full_template_path=batch_prompt_template_file,
+            attributes=attributes,
+            boolean_attributes=config.BOOLEAN_ATTRIBUTES)
+        if compact_prompts:
+            batch_prompt_generator = CompactingBatchPromptGenerator(
+                batch_prompt_generator, query_handler.prompt_generator.compactor)
+
+    request_manger_class = RequestManger
+    request_manger_parameters = {}
+    if group_packages:
+        # query one representative of every cluster of sub-packages
+        # (imported here, grouping builds on this module)
+        from grouping import GroupingRequestManger
+        request_manger_class = GroupingRequestManger
+        request_manger_parameters = {
+            "decision_attribute": decision_attribute,
+            "similarity": group_similarity,
+            "verify_rate": group_verify_rate,
+            "topological": group_topological
+        }
+    elif work_queue:
+        # packages leased from a coordinator
+        # (imported here, workqueue builds on this module)
+        from workqueue import WorkQueueRequestManger
+        request_manger_class = WorkQueueRequestManger
+        request_manger_parameters = {"coordinator_url": work_queue}
+    elif batch_job:
+        # asynchronous batch jobs of the provider
+        # (imported here, batchjob builds on this module)
+        from batchjob import BatchJobRequestManger
+        request_manger_class = BatchJobRequestManger
+        request_manger_parameters = {
+            "batch_job": get_class(query_stub + "BatchJob")(
+                client=query_handler.client,
+                model_name=llm_model,
+                poll_interval=batch_poll_interval),
+            "job_size": batch_job_size
+        }
+
+    with RunSetup(
+            query_handlers=[query_handler],
+            csv_file_out=csv_file_out,
+            attributes=attributes,
+            result_attributes=attributes + ([DECIDED_BY_ATTRIBUTE]
+                                            if preclassify_rules is not None or group_packages else []),
+            base_package_list=base_package_list,
+            recorded_model=query_handler.model_id,
+            template=template_name(prompt_template_file),
+            query_restriction=query_restriction,
+            max_in_flight=max_in_flight,
+            cache_file=cache_file,
+            cache_max_age=cache_max_age,
+            cache_max_entries=cache_max_entries,
+            cache_reparse=cache_reparse,
+            resume=resume,
+            previous_package_list=previous_package_list,
+            previous_results=previous_results,
+            preclassify_rules=preclassify_rules,
+            decision_attribute=decision_attribute,
+            metrics_file=metrics_file,
+            metrics_interval=metrics_interval,
+            metrics_port=metrics_port,
+            rate_limits=rate_limits,
+            # the coordinator of a work queue records the results
+            result_store=None if work_queue else result_store,
+            startup=startup) as run_setup:
+
+        log.info("Starting requests ...")
+        request_manger = request_manger_class(
+            **request_manger_parameters,
+            **run_setup.manger_parameters,
+            query_handler=query_handler,
+            batch_size=batch_size,
+            batch_prompt_generator=batch_prompt_generator,
+            pre_classifier=run_setup.pre_classifier)
+        request_manger.run()
\ No newline at end of file
@@ -0,0 +1,75 @@
+import logging
+import re
+import threading
+
+from typing import Dict, List
+
+log = logging.getLogger(__name__)
+
+# name of the pre-classifier in the decided_by column
+RULES_DECIDER = "rules"
+# attributes receiving the reason of a rule based decision
+REASON_ATTRIBUTES = ("justification", "explanation")
+
+def split_dependencies(dependencies: str) -> List[str]:
+    """Split the dependencies column of the package list."""
+    return [dependency.strip() for dependency in dependencies.split(",") if dependency.strip()]
+
+class PreClassifier:
+    """
+    Rule based classification of obvious packages before the model is
+    asked. Packages depending on one of the relevant dependencies are
+    relevant, packages matching one of the irrelevant name patterns are
+    not. Packages matching both or none of the rules are left to the model.
+    """
+    _relevant_dependencies: set
+    _irrelevant_names: re.Pattern
+    _attributes: List[str]
+    _decision_attribute: str
+    _lock: threading.Lock
+    decided: int = 0
+
+    def __init__(self,
+                 rules: Dict[str, List[str]],
+                 attributes: List[str],
+                 decision_attribute: str) -> None:
+
+        self._relevant_dependencies = set(rules.get("relevant_dependencies", []))
+        patterns = rules.get("irrelevant_name_patterns", [])
+        # an empty alternation would match every package
+        self._irrelevant_names = re.compile("|".join(f"(?:{p})" for p in patterns)) \
+            if patterns else re.compile(r"(?!)")
+        self._attributes = attributes
+        self._decision_attribute = decision_attribute
+        self._lock = threading.Lock()
+
+    def __call__(self, row: List[str]) -> List[str] | None:
+        """Return the result row for a package of the list or None if undecided."""
+        name = row[0]
+        crypto_dependencies = sorted(self._relevant_dependencies.intersection(
+            split_dependencies(row[3])))
+        irrelevant_name = self._irrelevant_names.search(name) is not None
+
+        if crypto_dependencies and not irrelevant_name:
+            decision = "True"
+            reason = f"Rule: depends on {', '.join(crypto_dependencies)}."
+        elif irrelevant_name and not crypto_dependencies:
+            decision = "False"
+            reason = "Rule: documentation, font or language package."
+        else:
+            return None
+
+        with self._lock:
+            self.decided += 1
+
+        result = []
+        for attr in self._attributes:
+            if attr == self._attributes[0]:
+                result.append(name)
+            elif attr == self._decision_attribute:
+                result.append(decision)
+            elif attr in REASON_ATTRIBUTES:
+                result.append(reason)
+            else:
+                result.append("")
+        return result
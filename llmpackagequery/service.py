@@ -0,0 +1,371 @@
+import json
+import logging
+import socket
+import statistics
+import threading
+
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from typing import Deque, Dict, List, Tuple
+
+import config
+from cache import ResponseCache
+from compaction import CompactingBatchPromptGenerator, compact_query_handler, report_compaction
+from metrics import Metrics
+from packages import record_row
+from query import BatchTemplateBasedPromptGenerator, QueryStub
+from ratelimit import RateLimit, RateLimiter
+from request import RequestManger, create_query_handler
+from rules import PreClassifier
+from writer import split_results
+
+log = logging.getLogger(__name__)
+
+# latencies kept for the quantiles of the stats
+LATENCY_WINDOW = 10_000
+# upper bound of the packages of one request
+MAX_REQUEST_PACKAGES = 10_000
+# responses kept without a cache file and batches between two evictions
+MEMORY_CACHE_MAX_ENTRIES = 100_000
+CACHE_EVICT_BATCHES = 100
+
+class MicroBatcher:
+    """
+    Coalesce the packages of concurrent requests into micro-batches. The
+    first package waiting opens a window, all packages arriving within
+    the window are requested together, each distinct package once. While
+    a batch is requested new packages wait for the next batch, under load
+    the batches grow up to max_batch_size.
+    """
+    _request_manger: RequestManger
+    _metrics: Metrics
+    _response_cache: ResponseCache | None
+    _window: float
+    _max_batch_size: int
+    _condition: threading.Condition
+    # packages waiting for a batch with their arrival and future
+    _pending: Deque[Tuple[List[str], float, Future]]
+    _latencies: Deque[float]
+    _stopped: bool = False
+    in_progress: int = 0
+    batches: int = 0
+    packages: int = 0
+    deduplicated: int = 0
+
+    def __init__(self,
+                 request_manger: RequestManger,
+                 metrics: Metrics,
+                 response_cache: ResponseCache | None = None,
+                 window: float = config.SERVICE_BATCH_WINDOW,
+                 max_batch_size: int = config.SERVICE_MAX_BATCH_SIZE) -> None:
+
+        self._request_manger = request_manger
+        self._metrics = metrics
+        self._response_cache = response_cache
+        self._window = window
+        self._max_batch_size = max(1, max_batch_size)
+        self._condition = threading.Condition()
+        self._pending = deque()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> "MicroBatcher":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def submit(self, rows: List[List[str]]) -> List[Future]:
+        """Queue the rows, the futures are resolved with their results."""
+        futures = [Future() for _ in rows]
+        now = monotonic()
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("The service is shutting down.")
+            self._pending.extend((row, now, future) for row, future in zip(rows, futures))
+            self._condition.notify_all()
+        return futures
+
+    def _next_batch(self) -> List[Tuple[List[str], float, Future]] | None:
+        with self._condition:
+            while not self._pending and not self._stopped:
+                self._condition.wait()
+            if self._stopped:
+                return None
+            # wait for further packages until the window of the first one closes
+            deadline = self._pending[0][1] + self._window
+            while len(self._pending) < self._max_batch_size and (remaining := deadline - monotonic()) > 0:
+                self._condition.wait(remaining)
+            batch = [self._pending.popleft() for _ in range(min(self._max_batch_size, len(self._pending)))]
+            self.in_progress = len(batch)
+            return batch
+
+    def _run(self) -> None:
+        while (batch := self._next_batch()) is not None:
+            # identical packages of several requests are asked once
+            unique: Dict[Tuple[str, ...], List[Tuple[float, Future]]] = {}
+            for row, arrival, future in batch:
+                unique.setdefault(tuple(row), []).append((arrival, future))
+            latencies = []
+            try:
+                results = self._request_manger.classify([list(row) for row in unique])
+                for waiting, result in zip(unique.values(), results):
+                    for arrival, future in waiting:
+                        future.set_result(result)
+                        latencies.append(monotonic() - arrival)
+            except Exception as e:
+                log.error(f"Micro-batch of {len(batch)} packages failed: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+            with self._condition:
+                self.in_progress = 0
+                self.batches += 1
+                self.packages += len(batch)
+                self.deduplicated += len(batch) - len(unique)
+                self._latencies.extend(latencies)
+            for latency in latencies:
+                self._metrics.observe("service", latency)
+            self._metrics.count("service_batches")
+            self._metrics.count("service_deduplicated", value=len(batch) - len(unique))
+            if self._response_cache is not None and self.batches % CACHE_EVICT_BATCHES == 0:
+                # the service runs for a long time, keep the cache bounded
+                self._response_cache.evict()
+
+        # answer the packages left at shutdown
+        with self._condition:
+            for _, _, future in self._pending:
+                future.set_exception(RuntimeError("The service is shutting down."))
+            self._pending.clear()
+
+    def stats(self) -> Dict:
+        with self._condition:
+            latencies = sorted(self._latencies)
+            queue_depth = len(self._pending)
+            in_progress = self.in_progress
+            batches, packages, deduplicated = self.batches, self.packages, self.deduplicated
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return {
+            "queue_depth": queue_depth,
+            "in_progress": in_progress,
+            "batches": batches,
+            "packages": packages,
+            "deduplicated": deduplicated,
+            "mean_batch_size": packages / batches if batches else None,
+            "latency_p50": quantiles[49] if quantiles else None,
+            "latency_p99": quantiles[98] if quantiles else None,
+            "latency_max": latencies[-1] if latencies else None
+        }
+
+class _ClassificationHandler(BaseHTTPRequestHandler):
+    server: "ClassificationServer"
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _send(self, status: int, payload: Dict) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send(200, self.server.stats())
+        elif self.path == "/metrics":
+            data = self.server.metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self._send(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            records = body["packages"] if "packages" in body else [body["package"]]
+            if len(records) > MAX_REQUEST_PACKAGES:
+                raise ValueError(f"More than {MAX_REQUEST_PACKAGES} packages.")
+            rows = [record_row(record) for record in records]
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            self._send(400, {"error": f"Invalid request, expected a package or packages " \
+                                      f"with name, description and dependencies: {e}"})
+            return
+
+        try:
+            results = [future.result() for future in self.server.batcher.submit(rows)]
+        except Exception as e:
+            self._send(503, {"error": str(e)})
+            return
+        header = self.server.header
+        self._send(200, {"model": self.server.model_id,
+                         "results": [dict(zip(header, split_results(result, len(header))))
+                                     for result in results]})
+
+class ClassificationServer(ThreadingHTTPServer):
+    """
+    Classification service over HTTP with JSON bodies: POST /classify
+    {"package": {...}} or {"packages": [{...}, ...]} with package records
+    as in a JSON lines package list (name, version, description and
+    dependencies) answers {"model", "results": [{attribute: value}, ...]}
+    in the order of the packages. GET /stats reports the queue depth,
+    batching and latencies, GET /metrics the metrics for Prometheus.
+    """
+    daemon_threads = True
+    batcher: MicroBatcher
+    metrics: Metrics
+    header: List[str]
+    model_id: str
+
+    def __init__(self,
+                 request_manger: RequestManger,
+                 metrics: Metrics,
+                 response_cache: ResponseCache | None = None,
+                 host: str = "",
+                 port: int = 0,
+                 window: float = config.SERVICE_BATCH_WINDOW,
+                 max_batch_size: int = config.SERVICE_MAX_BATCH_SIZE) -> None:
+        super().__init__((host, port), _ClassificationHandler)
+        self.batcher = MicroBatcher(request_manger, metrics, response_cache=response_cache,
+                                    window=window, max_batch_size=max_batch_size)
+        self.metrics = metrics
+        self.header = request_manger.write_attributes()
+        self.model_id = request_manger.model_id
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        if host in ("", "0.0.0.0"):
+            host = socket.gethostname()
+        return f"http://{host}:{port}"
+
+    def stats(self) -> Dict:
+        return {"model": self.model_id, **self.batcher.stats(), "metrics": self.metrics.summary()}
+
+    def start(self) -> "ClassificationServer":
+        """Serve in a background thread."""
+        self.batcher.start()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        self.batcher.stop()
+
+def serve(query_stub: str,
+          llm_model: str,
+          prompt_template_file: str,
+          attributes: List[str],
+          api_key: str,
+          host: str,
+          port: int,
+          max_in_flight: int = 1,
+          base_package_list: str | None = None,
+          cache_file: str | None = None,
+          cache_max_age: float | None = None,
+          cache_max_entries: int | None = None,
+          batch_size: int = 1,
+          batch_prompt_template_file: str | None = None,
+          preclassify_rules: Dict[str, List[str]] | None = None,
+          decision_attribute: str | None = None,
+          api_base_url: str | None = None,
+          rate_limits: Dict[str, RateLimit] | None = None,
+          stream: bool = False,
+          structured_output: bool = False,
+          compact_prompts: bool = False,
+          prompt_token_budget: int | None = None,
+          batch_window: float = config.SERVICE_BATCH_WINDOW,
+          max_batch_size: int = config.SERVICE_MAX_BATCH_SIZE) -> None:
+    """
+    Serve the classification of packages until interrupted. The query
+    handler, and a local model, is loaded once. The parameters are those
+    of request.execute, the package list only provides the dependency
+    statistics of compacted prompts.
+    """
+    if query_stub == QueryStub.GPT4ALL.value and max_in_flight > 1:
+        # the local model cannot generate concurrently
+        log.warning(f"{query_stub} does not support concurrent requests, ignoring max in flight {max_in_flight}.")
+        max_in_flight = 1
+    if structured_output and batch_size > 1 and batch_prompt_template_file:
+        log.warning("Structured output does not apply to batched prompts, ignoring it.")
+        structured_output = False
+
+    query_handler = create_query_handler(
+        query_stub=query_stub,
+        llm_model=llm_model,
+        prompt_template_file=prompt_template_file,
+        attributes=attributes,
+        api_key=api_key,
+        host=host,
+        api_base_url=api_base_url,
+        stream=stream,
+        structured_output=structured_output)
+    if compact_prompts:
+        query_handler = compact_query_handler(query_handler, base_package_list, prompt_token_budget)
+
+    # without a cache file repeated packages are answered from memory
+    log.info(f"Using response cache {cache_file or 'in memory'}")
+    response_cache = ResponseCache(
+        cache_file=cache_file or ":memory:",
+        max_age=cache_max_age,
+        max_entries=cache_max_entries or (None if cache_file else MEMORY_CACHE_MAX_ENTRIES))
+
+    pre_classifier = None
+    if preclassify_rules is not None:
+        pre_classifier = PreClassifier(
+            rules=preclassify_rules,
+            attributes=attributes,
+            decision_attribute=decision_attribute)
+
+    batch_prompt_generator = None
+    if batch_size > 1 and batch_prompt_template_file:
+        batch_prompt_generator = BatchTemplateBasedPromptGenerator(
+            full_template_path=batch_prompt_template_file,
+            attributes=attributes,
+            boolean_attributes=config.BOOLEAN_ATTRIBUTES)
+        if compact_prompts:
+            batch_prompt_generator = CompactingBatchPromptGenerator(
+                batch_prompt_generator, query_handler.prompt_generator.compactor)
+
+    metrics = Metrics()
+    request_manger = RequestManger(
+        query_handler=query_handler,
+        package_file_in=None,
+        package_file_out=None,
+        max_in_flight=max_in_flight,
+        response_cache=response_cache,
+        batch_size=batch_size,
+        batch_prompt_generator=batch_prompt_generator,
+        pre_classifier=pre_classifier,
+        metrics=metrics,
+        rate_limiter=RateLimiter(limits=rate_limits))
+
+    server = ClassificationServer(request_manger, metrics, response_cache=response_cache, port=port,
+                                  window=batch_window, max_batch_size=max_batch_size)
+    log.info(f"Serving the classification with {query_handler.model_id} at {server.url}")
+    server.batcher.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Stopping the classification service.")
+    finally:
+        server.server_close()
+        server.batcher.stop()
+        report_compaction([query_handler], metrics)
+        response_cache.close()
+        log.info(f"Classification service: {server.batcher.stats()}")
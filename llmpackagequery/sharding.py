@@ -0,0 +1,326 @@
+import csv
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import zlib
+
+from collections import deque
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Deque, Dict, Iterator, List
+
+import request
+from packages import PACKAGE_COLUMNS, read_packages
+from store import ResultStore, RunRecorder, template_name
+from writer import CHECKPOINT_FILE, CSVResultsWriter, format_results
+
+log = logging.getLogger(__name__)
+
+# directory of the shard package lists and results next to the results file
+SHARD_DIR = "{csv_file}.shards"
+SHARD_PACKAGES_FILE = "packages-{shard}.csv"
+SHARD_RESULTS_FILE = "results-{shard}.csv"
+SHARD_METRICS_FILE = "results-{shard}.metrics.json"
+# seconds between two checks of the worker processes
+WORKER_POLL_INTERVAL = 1.0
+
+def shard_of(package_name: str, shards: int) -> int:
+    """Shard of a package, equal in every process and run."""
+    return zlib.crc32(package_name.encode()) % shards
+
+def split_package_list(package_list: str,
+                       shard_dir: str,
+                       shards: int,
+                       query_restriction: int = sys.maxsize) -> List[int]:
+    """
+    Partition the package list by the hash of the package name into one
+    CSV package list per shard, returns the number of packages per shard.
+    """
+    counts = [0] * shards
+    files = [open(os.path.join(shard_dir, SHARD_PACKAGES_FILE.format(shard=shard)), mode='w', newline='')
+             for shard in range(shards)]
+    try:
+        package_writers = [csv.writer(file, quoting=csv.QUOTE_ALL) for file in files]
+        for package_writer in package_writers:
+            package_writer.writerow(PACKAGE_COLUMNS)
+        for row in islice(read_packages(package_list), query_restriction):
+            shard = shard_of(row[0], shards)
+            package_writers[shard].writerow(row[:4])
+            counts[shard] += 1
+    finally:
+        for file in files:
+            file.close()
+    return counts
+
+def _shard_results(shard_dir: str, shard: int) -> Iterator[List[str]]:
+    # rows of the results of a shard, the header is skipped
+    with open(os.path.join(shard_dir, SHARD_RESULTS_FILE.format(shard=shard)), mode='r', newline='') as file:
+        result_reader = csv.reader(file)
+        next(result_reader, None)
+        yield from result_reader
+
+def merge_results(package_list: str,
+                  shard_dir: str,
+                  shards: int,
+                  csv_file_out: str,
+                  query_restriction: int = sys.maxsize,
+                  recorder: RunRecorder | None = None) -> int:
+    """
+    Merge the results of the shards in the order of the package list,
+    returns the number of rows written. Each shard holds its packages in
+    input order, so the merge reads every shard file once.
+    """
+    with open(os.path.join(shard_dir, SHARD_RESULTS_FILE.format(shard=0)), mode='r', newline='') as file:
+        header = next(csv.reader(file))
+    readers = [_shard_results(shard_dir, shard) for shard in range(shards)]
+    # next unmatched result row per shard
+    pending: Dict[int, List[str] | None] = {}
+
+    written = 0
+    with open(csv_file_out, mode='w', newline='') as file_write:
+        with CSVResultsWriter(
+                file_dst=file_write,
+                package_header=header,
+                checkpoint_file=CHECKPOINT_FILE.format(csv_file=csv_file_out),
+                recorder=recorder) as writer:
+            for offset, row in enumerate(islice(read_packages(package_list), query_restriction)):
+                shard = shard_of(row[0], shards)
+                if shard not in pending:
+                    pending[shard] = next(readers[shard], None)
+                result = pending[shard]
+                if result is None or result[0] != row[0]:
+                    # the results of a package are missing if they could not be written
+                    log.error(f"No results for package {row[0]} in shard {shard}.")
+                    continue
+                del pending[shard]
+                writer.write_results(format_results(result), input_offset=offset + 1)
+                written += 1
+    return written
+
+def _run_worker(worker_idx: int,
+                device: str,
+                shard_dir: str,
+                execute_parameters: Dict,
+                tasks: multiprocessing.Queue,
+                results: multiprocessing.Queue) -> None:
+    # worker process, the model is loaded once and answers all its shards
+    if device.isdigit():
+        # a GPU given by index, the process only sees this GPU
+        os.environ["CUDA_VISIBLE_DEVICES"] = device
+        device = "cuda"
+
+    query_handler = request.create_query_handler(
+        query_stub=execute_parameters["query_stub"],
+        llm_model=execute_parameters["llm_model"],
+        prompt_template_file=execute_parameters["prompt_template_file"],
+        attributes=execute_parameters["attributes"],
+        api_key=execute_parameters["api_key"],
+        host=execute_parameters["host"],
+        api_base_url=execute_parameters.get("api_base_url"),
+        device=device,
+        stream=execute_parameters.get("stream", False),
+        structured_output=execute_parameters.get("structured_output", False))
+    results.put(("ready", worker_idx, None))
+
+    while (shard := tasks.get()) is not None:
+        csv_file_out = os.path.join(shard_dir, SHARD_RESULTS_FILE.format(shard=shard))
+        request.execute(
+            **execute_parameters,
+            base_package_list=os.path.join(shard_dir, SHARD_PACKAGES_FILE.format(shard=shard)),
+            csv_file_out=csv_file_out,
+            # a shard taken over from a dead worker continues at its checkpoint
+            resume=os.path.exists(csv_file_out),
+            metrics_file=os.path.join(shard_dir, SHARD_METRICS_FILE.format(shard=shard)),
+            query_handler=query_handler)
+        results.put(("done", worker_idx, shard))
+
+@dataclass
+class _Worker:
+    device: str
+    process: multiprocessing.Process
+    tasks: multiprocessing.Queue
+    # shards assigned by the partition and not started yet
+    shards: Deque[int] = field(default_factory=deque)
+    current: int | None = None
+    ready: bool = False
+    dead: bool = False
+
+class ShardedRun:
+    """
+    Query the packages with one worker process per device. The package
+    list is partitioned by the hash of the package name into several
+    shards per worker, each worker keeps its model loaded and queries one
+    shard after the other. A worker without shards left takes over the
+    last shard of the worker with the most shards left, the shard of a
+    dead worker is continued by another worker at its checkpoint. The
+    results are merged in the order of the package list at the end.
+    """
+    _devices: List[str]
+    _shards_per_worker: int
+    _execute_parameters: Dict
+    _package_file_in: str
+    _package_file_out: str
+    _query_restriction: int
+    _resume: bool
+    _result_store: str | None
+    _shard_dir: str
+
+    RETRY_COUNT: int = 3
+
+    def __init__(self,
+                 devices: List[str],
+                 shards_per_worker: int,
+                 execute_parameters: Dict) -> None:
+        """execute_parameters are the parameters of request.execute."""
+        self._devices = devices
+        self._shards_per_worker = max(1, shards_per_worker)
+        self._execute_parameters = dict(execute_parameters)
+        self._package_file_in = self._execute_parameters.pop("base_package_list")
+        self._package_file_out = self._execute_parameters.pop("csv_file_out")
+        self._query_restriction = self._execute_parameters.pop("query_restriction", sys.maxsize)
+        # the shards are resumed from the shard directory
+        self._resume = self._execute_parameters.pop("resume", False)
+        # every shard writes its own metrics, a port cannot be shared
+        self._execute_parameters.pop("metrics_file", None)
+        self._execute_parameters.pop("metrics_port", None)
+        # the merged results are recorded, not the shards
+        self._result_store = self._execute_parameters.pop("result_store", None)
+        self._shard_dir = SHARD_DIR.format(csv_file=self._package_file_out)
+
+    def run(self) -> None:
+        shards = len(self._devices) * self._shards_per_worker
+        if not self._resume and os.path.exists(self._shard_dir):
+            shutil.rmtree(self._shard_dir)
+        os.makedirs(self._shard_dir, exist_ok=True)
+
+        counts = split_package_list(self._package_file_in, self._shard_dir, shards, self._query_restriction)
+        log.info(f"Split {sum(counts)} packages into {shards} shards for {len(self._devices)} workers.")
+
+        self._run_workers(shards)
+
+        store = ResultStore(self._result_store) if self._result_store else None
+        recorder = None
+        if store is not None:
+            recorder = RunRecorder(
+                store=store,
+                model=f"{self._execute_parameters['query_stub']}.{self._execute_parameters['llm_model']}",
+                template=template_name(self._execute_parameters["prompt_template_file"]),
+                package_list=self._package_file_in,
+                results_file=self._package_file_out)
+        try:
+            written = merge_results(self._package_file_in, self._shard_dir, shards,
+                                    self._package_file_out, self._query_restriction, recorder)
+        finally:
+            if store is not None:
+                store.close()
+        log.info(f"Merged {written} results of {shards} shards into {self._package_file_out}.")
+        shutil.rmtree(self._shard_dir)
+
+    def _run_workers(self, shards: int) -> None:
+        # spawn, CUDA cannot be used in forked processes
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        workers: List[_Worker] = []
+        for worker_idx, device in enumerate(self._devices):
+            tasks = context.Queue()
+            process = context.Process(
+                target=_run_worker,
+                args=(worker_idx, device, self._shard_dir, self._execute_parameters, tasks, results),
+                name=f"shard-worker-{worker_idx}")
+            workers.append(_Worker(device=device, process=process, tasks=tasks))
+        # deterministic assignment of the shards to the workers
+        for shard in range(shards):
+            workers[shard % len(workers)].shards.append(shard)
+        for worker in workers:
+            worker.process.start()
+
+        # shards of dead workers and their number of attempts
+        orphaned: Deque[int] = deque()
+        attempts: Dict[int, int] = {}
+        done = 0
+        try:
+            while done < shards:
+                try:
+                    message, worker_idx, shard = results.get(timeout=WORKER_POLL_INTERVAL)
+                except queue.Empty:
+                    message = None
+
+                if message == "ready":
+                    workers[worker_idx].ready = True
+                    log.info(f"Worker {worker_idx} on device {workers[worker_idx].device} is ready.")
+                elif message == "done":
+                    workers[worker_idx].current = None
+                    done += 1
+                    log.info(f"Worker {worker_idx} finished shard {shard}, {done}/{shards} shards done.")
+
+                for worker_idx, worker in enumerate(workers):
+                    if not worker.dead and not worker.process.is_alive():
+                        self._worker_died(worker_idx, worker, orphaned, attempts)
+                if all(worker.dead for worker in workers):
+                    raise RuntimeError("All shard workers died.")
+
+                for worker_idx, worker in enumerate(workers):
+                    if worker.ready and worker.current is None and not worker.dead:
+                        self._assign(worker_idx, worker, workers, orphaned)
+        finally:
+            for worker in workers:
+                if worker.process.is_alive():
+                    if worker.current is None:
+                        worker.tasks.put(None)
+                    else:
+                        worker.process.terminate()
+            for worker in workers:
+                worker.process.join()
+
+    def _worker_died(self,
+                     worker_idx: int,
+                     worker: _Worker,
+                     orphaned: Deque[int],
+                     attempts: Dict[int, int]) -> None:
+        # the remaining shards of the worker are taken over by the others
+        worker.dead = True
+        log.error(f"Worker {worker_idx} on device {worker.device} died " \
+                  f"(exit code {worker.process.exitcode}).")
+        if worker.current is not None:
+            attempts[worker.current] = attempts.get(worker.current, 0) + 1
+            if attempts[worker.current] >= self.RETRY_COUNT:
+                raise RuntimeError(f"Shard {worker.current} failed {attempts[worker.current]} times.")
+            orphaned.append(worker.current)
+            worker.current = None
+
+    def _assign(self,
+                worker_idx: int,
+                worker: _Worker,
+                workers: List[_Worker],
+                orphaned: Deque[int]) -> None:
+        # shards of dead workers first, then the own shards, then take over
+        # the last shard of the worker with the most shards left. Idle
+        # workers are kept until the end, a worker may still die.
+        if orphaned:
+            shard = orphaned.popleft()
+            log.info(f"Worker {worker_idx} continues shard {shard} of a dead worker.")
+        elif worker.shards:
+            shard = worker.shards.popleft()
+        else:
+            behind = max(workers, key=lambda other: len(other.shards))
+            if not behind.shards:
+                return
+            shard = behind.shards.pop()
+            log.info(f"Worker {worker_idx} takes over shard {shard} of worker {workers.index(behind)}.")
+        worker.current = shard
+        worker.tasks.put(shard)
+
+def execute(devices: List[str],
+            shards_per_worker: int = 8,
+            **execute_parameters) -> None:
+    """
+    Query the packages as request.execute does, sharded over one worker
+    process per device. A device is a GPU index or a gpt4all device name.
+    """
+    ShardedRun(
+        devices=devices,
+        shards_per_worker=shards_per_worker,
+        execute_parameters=execute_parameters).run()
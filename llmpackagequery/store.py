@@ -0,0 +1,357 @@
+#! /usr/bin/env python3
+"""
+Result store keeping the results of all runs in one SQLite file, next
+to the CSV results file of every run. Runs are identified by model and
+prompt template, results by run and package.
+
+Example:
+    python3 store.py results.sqlite runs
+    python3 store.py results.sqlite latest --package openssl
+    python3 store.py results.sqlite disagreements --models openai.gpt-5 ollama.deepseek-r1:latest
+    python3 store.py results.sqlite export 3 fedora_gpt-5.csv
+    python3 store.py results.sqlite import csv/fedora_gpt-5.csv --model openai.gpt-5 --template fedora_gpt-5-prompt1v2
+    python3 store.py results.sqlite evaluate --runs 3 4 5 --labels labels.csv
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+from time import time
+from typing import Dict, List, Sequence, Tuple
+
+import config
+from writer import CSVResultsWriter, format_results
+
+log = logging.getLogger(__name__)
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT NOT NULL,
+    template TEXT NOT NULL,
+    package_list TEXT,
+    results_file TEXT,
+    attributes TEXT NOT NULL,
+    verdict_attribute TEXT,
+    started REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    package TEXT NOT NULL,
+    input_offset INTEGER,
+    verdict TEXT,
+    result TEXT NOT NULL,
+    written REAL NOT NULL,
+    PRIMARY KEY (run_id, package)
+);
+CREATE INDEX IF NOT EXISTS runs_model ON runs (model, template);
+CREATE INDEX IF NOT EXISTS runs_results_file ON runs (results_file);
+CREATE INDEX IF NOT EXISTS results_package ON results (package, written);
+"""
+
+def template_name(prompt_template_file: str) -> str:
+    """Name of a prompt template in the store, e.g. fedora_gpt-5-prompt1v2."""
+    return os.path.splitext(os.path.basename(prompt_template_file))[0]
+
+class ResultStore:
+    """
+    SQLite file holding the runs and their results. A result keeps the
+    values of all attributes, the verdict is the value of the verdict
+    attribute of the run, by default its first boolean attribute
+    (config.BOOLEAN_ATTRIBUTES).
+    """
+    _connection: sqlite3.Connection
+    _lock: threading.Lock
+    # attributes and verdict attribute per run
+    _attributes: Dict[int, Tuple[List[str], str | None]]
+
+    def __init__(self, store_file: str) -> None:
+        self._lock = threading.Lock()
+        self._attributes = {}
+        directory = os.path.dirname(store_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # the coordinator of a work queue writes from its server threads
+        self._connection = sqlite3.connect(store_file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(STORE_SCHEMA)
+
+    def start_run(self,
+                  model: str,
+                  template: str,
+                  attributes: List[str],
+                  package_list: str | None = None,
+                  results_file: str | None = None,
+                  resume: bool = False,
+                  verdict_attribute: str | None = None) -> int:
+        """
+        Create a run, a resumed run continues its unfinished run of the
+        results file. The verdict defaults to the first boolean attribute.
+        """
+        with self._lock:
+            if resume and results_file:
+                entry = self._connection.execute(
+                    "SELECT run_id FROM runs WHERE results_file = ? AND finished IS NULL "
+                    "ORDER BY run_id DESC LIMIT 1", (results_file,)).fetchone()
+                if entry is not None:
+                    return entry[0]
+            if verdict_attribute not in attributes:
+                verdict_attribute = next((a for a in attributes if a in config.BOOLEAN_ATTRIBUTES), None)
+            cursor = self._connection.execute(
+                "INSERT INTO runs (model, template, package_list, results_file, attributes, "
+                "verdict_attribute, started) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (model, template, package_list, results_file, json.dumps(attributes),
+                 verdict_attribute, time()))
+            self._connection.commit()
+            return cursor.lastrowid
+
+    def add_results(self, run_id: int, rows: Sequence[Tuple[int | None, Sequence[str]]]) -> None:
+        """Insert (input offset, values) rows of a run in one transaction."""
+        attributes, verdict_attribute = self._run_attributes(run_id)
+        verdict_index = attributes.index(verdict_attribute) if verdict_attribute else None
+        now = time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results (run_id, package, input_offset, verdict, result, written) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(run_id, values[0], offset,
+                  values[verdict_index] if verdict_index is not None and verdict_index < len(values) else None,
+                  json.dumps(dict(zip(attributes, values))), now)
+                 for offset, values in rows])
+            self._connection.commit()
+
+    def finish_run(self, run_id: int) -> None:
+        with self._lock:
+            self._connection.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (time(), run_id))
+            self._connection.commit()
+
+    def _run_attributes(self, run_id: int) -> Tuple[List[str], str | None]:
+        if run_id not in self._attributes:
+            with self._lock:
+                entry = self._connection.execute(
+                    "SELECT attributes, verdict_attribute FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+            if entry is None:
+                raise ValueError(f"Unknown run {run_id}.")
+            self._attributes[run_id] = (json.loads(entry[0]), entry[1])
+        return self._attributes[run_id]
+
+    def _query(self, sql: str, parameters: Sequence = ()) -> Tuple[List[str], List[Tuple]]:
+        with self._lock:
+            cursor = self._connection.execute(sql, parameters)
+            return [column[0] for column in cursor.description], cursor.fetchall()
+
+    def runs(self) -> Tuple[List[str], List[Tuple]]:
+        """Packages and verdicts per run."""
+        return self._query(
+            "SELECT runs.run_id, model, template, datetime(started, 'unixepoch') AS started, "
+            "round(finished - started, 1) AS seconds, count(package) AS packages, "
+            "sum(lower(verdict) = 'true') AS verdict_true, sum(lower(verdict) = 'false') AS verdict_false, "
+            "sum(package IS NOT NULL AND coalesce(verdict, '') = '') AS no_verdict, results_file "
+            "FROM runs LEFT JOIN results ON results.run_id = runs.run_id "
+            "GROUP BY runs.run_id ORDER BY runs.run_id")
+
+    def latest(self, package: str | None = None, model: str | None = None) -> Tuple[List[str], List[Tuple]]:
+        """Latest verdict per package, optionally of one package or model."""
+        return self._query(
+            "SELECT package, verdict, model, template, run_id, datetime(written, 'unixepoch') AS written "
+            "FROM (SELECT package, verdict, model, template, results.run_id, written, row_number() OVER "
+            "(PARTITION BY package ORDER BY written DESC, results.run_id DESC) AS position "
+            "FROM results JOIN runs ON runs.run_id = results.run_id "
+            "WHERE (?1 IS NULL OR package = ?1) AND (?2 IS NULL OR model = ?2)) "
+            "WHERE position = 1 ORDER BY package", (package, model))
+
+    def disagreements(self, models: List[str] | None = None) -> Tuple[List[str], List[Tuple]]:
+        """
+        Packages with different latest verdicts of the models, optionally
+        of the given models, with the verdicts as model=verdict pairs.
+        """
+        models = models or []
+        return self._query(
+            "WITH latest AS (SELECT package, model, lower(verdict) AS verdict, row_number() OVER "
+            "(PARTITION BY package, model ORDER BY written DESC, results.run_id DESC) AS position "
+            "FROM results JOIN runs ON runs.run_id = results.run_id "
+            "WHERE coalesce(verdict, '') != '' "
+            f"AND (? = 0 OR model IN ({', '.join('?' * len(models)) or 'NULL'}))) "
+            "SELECT package, group_concat(model || '=' || verdict, '; ') AS verdicts FROM latest "
+            "WHERE position = 1 GROUP BY package HAVING count(DISTINCT verdict) > 1 ORDER BY package",
+            [len(models)] + models)
+
+    def verdicts(self, run_id: int) -> Tuple[List[str], List[str]]:
+        """Package names and verdicts of a run."""
+        self._run_attributes(run_id)
+        _, rows = self._query("SELECT package, coalesce(verdict, '') FROM results WHERE run_id = ?", (run_id,))
+        return [package for package, _ in rows], [verdict for _, verdict in rows]
+
+    def export_csv(self, run_id: int, csv_file: str) -> int:
+        """Write the results of a run as CSV results file, returns the rows written."""
+        attributes, _ = self._run_attributes(run_id)
+        _, rows = self._query(
+            "SELECT result FROM results WHERE run_id = ? ORDER BY input_offset, package", (run_id,))
+        with open(csv_file, mode='w', newline='') as file_write:
+            with CSVResultsWriter(file_dst=file_write, package_header=attributes) as writer:
+                for (result,) in rows:
+                    values = json.loads(result)
+                    writer.write_results(format_results([values.get(a, "") for a in attributes]))
+        return len(rows)
+
+    def import_csv(self, csv_file: str, model: str, template: str) -> int:
+        """Add a CSV results file as finished run, returns the run id."""
+        with open(csv_file, mode='r', newline='') as file:
+            result_reader = csv.reader(file)
+            attributes = next(result_reader)
+            rows = [(offset, row) for offset, row in enumerate(result_reader) if row]
+        run_id = self.start_run(model=model, template=template, attributes=attributes,
+                                results_file=csv_file)
+        self.add_results(run_id, rows)
+        self.finish_run(run_id)
+        return run_id
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+class RunRecorder:
+    """
+    Records the rows of a results file as a run of the store. The rows
+    are inserted together whenever the results file is synced, the run
+    is started with the header of the file and finished once it is
+    written completely.
+    """
+    _store: ResultStore
+    _model: str
+    _template: str
+    _package_list: str | None
+    _results_file: str | None
+    _resume: bool
+    _verdict_attribute: str | None
+    _pending: List[Tuple[int | None, Sequence[str]]]
+    run_id: int | None = None
+
+    def __init__(self,
+                 store: ResultStore,
+                 model: str,
+                 template: str,
+                 package_list: str | None = None,
+                 results_file: str | None = None,
+                 resume: bool = False,
+                 verdict_attribute: str | None = None) -> None:
+        self._store = store
+        self._model = model
+        self._template = template
+        self._package_list = package_list
+        self._results_file = results_file
+        self._resume = resume
+        self._verdict_attribute = verdict_attribute
+        self._pending = []
+
+    def begin(self, header: List[str]) -> None:
+        self.run_id = self._store.start_run(
+            model=self._model,
+            template=self._template,
+            attributes=header,
+            package_list=self._package_list,
+            results_file=self._results_file,
+            resume=self._resume,
+            verdict_attribute=self._verdict_attribute)
+        log.info(f"Recording run {self.run_id} of {self._model} in the result store")
+
+    def add(self, values: Sequence[str], input_offset: int | None = None) -> None:
+        # the input offset counts the processed rows including this one
+        self._pending.append((None if input_offset is None else input_offset - 1, values))
+
+    def commit(self) -> None:
+        if self._pending and self.run_id is not None:
+            self._store.add_results(self.run_id, self._pending)
+            self._pending = []
+
+    def finish(self) -> None:
+        self.commit()
+        if self.run_id is not None:
+            self._store.finish_run(self.run_id)
+
+def _print_rows(columns: List[str], rows: List[Tuple]) -> None:
+    result_writer = csv.writer(sys.stdout)
+    result_writer.writerow(columns)
+    result_writer.writerows(rows)
+
+def _evaluate(store: ResultStore, args: argparse.Namespace) -> None:
+    # numpy is only needed to evaluate, not to record runs
+    import evaluate
+
+    _, runs = store.runs()
+    models = {run[0]: run[1] for run in runs}
+    run_ids = args.runs or [run[0] for run in runs if run[4] is not None]
+    verdicts = {}
+    for run_id in run_ids:
+        if run_id not in models:
+            raise ValueError(f"Unknown run {run_id}.")
+        packages, values = store.verdicts(run_id)
+        verdicts[f"{models[run_id]} (run {run_id})"] = evaluate.verdict_column(packages, values)
+    if not verdicts:
+        raise ValueError("No finished runs to evaluate.")
+    labels = evaluate.read_verdicts(args.labels, args.label_attribute) if args.labels else None
+    report = evaluate.evaluate(evaluate.align_verdicts(verdicts, labels), args.bootstrap_samples)
+    evaluate.print_report(report)
+    if args.output:
+        evaluate.write_report(report, args.output)
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the result store.")
+    parser.add_argument("store_file", type=str, help="SQLite file of the result store.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("runs", help="Packages and verdicts per run.")
+    latest = commands.add_parser("latest", help="Latest verdict per package.")
+    latest.add_argument("--package", type=str, default=None, help="Only this package.")
+    latest.add_argument("--model", type=str, default=None, help="Only results of this model, e.g. openai.gpt-5.")
+    disagreements = commands.add_parser("disagreements", help="Packages the models disagree on.")
+    disagreements.add_argument("--models", type=str, nargs="+", default=None,
+                               help="Compare only these models (default: all).")
+    export = commands.add_parser("export", help="Write a run as CSV results file.")
+    export.add_argument("run_id", type=int, help="Run to export.")
+    export.add_argument("csv_file", type=str, help="CSV file to write.")
+    import_ = commands.add_parser("import", help="Add a CSV results file as run.")
+    import_.add_argument("csv_file", type=str, help="CSV results file to add.")
+    import_.add_argument("--model", type=str, required=True, help="Model of the results, e.g. openai.gpt-5.")
+    import_.add_argument("--template", type=str, required=True, help="Prompt template of the results.")
+    evaluate = commands.add_parser("evaluate", help="Metrics and agreement of runs, see evaluate.py.")
+    evaluate.add_argument("--runs", type=int, nargs="+", default=None,
+                          help="Runs to evaluate (default: all finished runs).")
+    evaluate.add_argument("--labels", type=str, default=None,
+                          help="CSV file with the package and the verdict attribute as label (optional).")
+    evaluate.add_argument("--label_attribute", type=str, default=config.BOOLEAN_ATTRIBUTES[0],
+                          help="Column of the labels (default: %(default)s).")
+    evaluate.add_argument("--bootstrap_samples", type=int, default=1000,
+                          help="Bootstrap samples of the intervals, 0 for none (default: %(default)s).")
+    evaluate.add_argument("--output", type=str, default=None, help="JSON file to write the report to (optional).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command != "import" and not os.path.exists(args.store_file):
+        sys.exit(f"Result store {args.store_file} does not exist.")
+    store = ResultStore(args.store_file)
+    try:
+        if args.command == "runs":
+            _print_rows(*store.runs())
+        elif args.command == "latest":
+            _print_rows(*store.latest(package=args.package, model=args.model))
+        elif args.command == "disagreements":
+            _print_rows(*store.disagreements(models=args.models))
+        elif args.command == "export":
+            log.info(f"Exported {store.export_csv(args.run_id, args.csv_file)} results to {args.csv_file}")
+        elif args.command == "import":
+            log.info(f"Imported {args.csv_file} as run {store.import_csv(args.csv_file, args.model, args.template)}")
+        elif args.command == "evaluate":
+            _evaluate(store, args)
+    except ValueError as e:
+        sys.exit(str(e))
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the modules import each other as top level modules
+sys.path.insert(0, PACKAGE_DIR)
+
+@pytest.fixture(autouse=True)
+def package_dir(monkeypatch):
+    # templates and logs are found relative to the package directory
+    monkeypatch.chdir(PACKAGE_DIR)
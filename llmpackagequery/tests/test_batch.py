@@ -0,0 +1,29 @@
+import json
+
+import config
+from query import BatchTemplateBasedPromptGenerator, GPT_5ResponseParser
+from writer import DEFAULT_PACKAGE_HEADER, split_results
+
+BATCH_TEMPLATE = config.BATCH_QUERY_TEMPLATE_FILE.format(
+    os="fedora", query_template_path=config.QUERY_TEMPLATE_PATH)
+
+def test_batch_prompt_shows_the_attributes():
+    generator = BatchTemplateBasedPromptGenerator(BATCH_TEMPLATE, DEFAULT_PACKAGE_HEADER,
+                                                  config.BOOLEAN_ATTRIBUTES)
+    prompt = generator([("openssl", "TLS", "glibc"), ("bash", "shell", "glibc")])
+    assert '"package_name": "<package name>"' in prompt
+    assert '"is_security_relevant": true | false' in prompt
+    assert '"explanation": "<explanation>"' in prompt
+    assert '2. Package name: "bash"' in prompt
+
+def test_split_batch_by_names_with_quotes():
+    parser = GPT_5ResponseParser(DEFAULT_PACKAGE_HEADER)
+    names = ["perl-Lingua-EN-Words2Nums", "o'caml-\"quoted\""]
+    answer = json.dumps([
+        {"package_name": names[1], "is_security_relevant": False, "explanation": "A language."},
+        {"package_name": names[0], "is_security_relevant": False, "explanation": "Converts words."}])
+    items = parser.split_batch(answer, names)
+    assert set(items) == set(names)
+    for name in names:
+        assert split_results(parser(items[name], name), 3)[0] == name
+    assert "language" in items[names[1]]
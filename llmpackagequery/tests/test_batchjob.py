@@ -0,0 +1,63 @@
+import csv
+
+import pytest
+
+import batchjob
+from batchjob import BatchJob
+from benchmark import run_stub
+from mock_llm import MockBehaviour
+from packages import PACKAGE_COLUMNS
+
+class FlakyBatchJob(BatchJob):
+    """Fails to poll the given number of times, then finishes."""
+    FINISHED_STATES = ("done",)
+
+    def __init__(self, failures):
+        super().__init__("stand-in.model", poll_interval=1.0)
+        self.failures = failures
+
+    def _request_line(self, custom_id, question):
+        return {"custom_id": custom_id}
+
+    def _submit(self, path):
+        return "job"
+
+    def _state(self, job_id):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("stand-in unreachable")
+        return "done"
+
+    def _answers(self, job_id):
+        yield "1", ("answer", None)
+
+def test_batch_job_is_abstract():
+    with pytest.raises(TypeError):
+        BatchJob("stand-in.model")
+
+def test_failed_polls_back_off(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(batchjob, "sleep", sleeps.append)
+    job = FlakyBatchJob(failures=3)
+    job.MAX_POLL_INTERVAL = 5.0
+    assert job({"1": "question"}) == {"1": ("answer", None)}
+    assert sleeps == [2.0, 4.0, 5.0]
+
+@pytest.mark.parametrize("query_stub", ["openai", "mistral", "gemini"])
+def test_batch_jobs_against_stand_in(tmp_path, query_stub):
+    package_list = str(tmp_path / "packages.csv")
+    with open(package_list, mode='w', newline='') as file:
+        package_writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        package_writer.writerow(PACKAGE_COLUMNS)
+        for idx in range(20):
+            package_writer.writerow([f"openssl-{idx}" if idx % 2 else f"pkg-{idx}", "", "", ""])
+
+    # failed items are resubmitted in another job
+    result = run_stub(query_stub, package_list, 20, MockBehaviour(error_rate=0.2, seed=1),
+                      max_in_flight=1, work_dir=str(tmp_path), batch_job=True)
+    assert result["error"] is None
+    assert result["written"] == 20
+    assert result["parse_failures"] == 0
+    with open(tmp_path / f"{query_stub}.csv", mode='r', newline='') as file:
+        rows = list(csv.reader(file))[1:]
+    assert all(row[1] == str(row[0].startswith("openssl")) for row in rows)
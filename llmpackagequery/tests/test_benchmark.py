@@ -0,0 +1,26 @@
+import metrics
+from benchmark import BUNDLED_PACKAGE_LIST, run_stub, synthetic_package_list
+from mock_llm import MockBehaviour
+
+def test_timing_quantiles_are_sampled_in_bounded_memory(monkeypatch):
+    monkeypatch.setattr(metrics, "RESERVOIR_SIZE", 100)
+    timing = metrics._Timing()
+    for idx in range(1000):
+        timing.observe(idx / 1000)
+    assert len(timing.samples) == 100
+    assert 0.3 < timing.quantile(0.5) < 0.7
+    assert timing.quantile(0.99) > 0.8
+
+def test_report_uses_client_latencies_and_retry_counters(tmp_path):
+    package_list = str(tmp_path / "packages.csv")
+    synthetic_package_list(BUNDLED_PACKAGE_LIST, 40, package_list)
+    behaviour = MockBehaviour(latency_median=0.02, error_rate=0.2, malformed_rate=0.1, seed=3)
+    result = run_stub("ollama", package_list, 40, behaviour, max_in_flight=4, work_dir=str(tmp_path))
+
+    assert result["written"] == 40
+    retries = result["pipeline_metrics"]["counters"]["retries"]
+    assert result["retries_by_cause"] == retries
+    assert result["retries"] == sum(retries.values()) > 0
+    # client side latencies of the stand-in answering in about 20ms
+    assert result["latency_p50"] >= 0.01
+    assert result["latency_p99"] >= result["latency_p50"]
@@ -0,0 +1,52 @@
+import sqlite3
+
+from cache import ResponseCache
+from query import GPT_5ResponseParser, QueryHandlerCallable
+
+RAW = '{"package": "openssl", "cryptographic_relevance": true, "justification": "TLS", "uses_network": true}'
+
+class CachedQueryHandler(QueryHandlerCallable):
+    model_id = "stand-in.model"
+
+    def __init__(self, attributes, response_schema=None):
+        super().__init__(lambda name, description, dependencies: name, GPT_5ResponseParser(attributes))
+        self.response_schema = response_schema
+
+def test_rows_are_parsed_again_for_other_attributes(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    handler = CachedQueryHandler(["package", "cryptographic_relevance", "justification"])
+    cache.put(handler, "prompt", "openssl", RAW, handler.parse_response(RAW, "openssl"))
+    assert cache.get(handler, "prompt")[1].count('","') == 2
+
+    other = CachedQueryHandler(["package", "uses_network"])
+    raw, parsed = cache.get(other, "prompt")
+    assert raw == RAW
+    assert parsed == other.parse_response(RAW, "openssl")
+    # the entry now holds the row of the other attributes
+    assert cache.get(other, "prompt")[1] == parsed
+    cache.close()
+
+def test_schema_is_part_of_the_key(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    handler = CachedQueryHandler(["package", "cryptographic_relevance", "justification"])
+    cache.put(handler, "prompt", "openssl", RAW, handler.parse_response(RAW, "openssl"))
+    structured = CachedQueryHandler(handler.response_parser.attributes_list, {"type": "object"})
+    assert cache.get(structured, "prompt") is None
+    cache.close()
+
+def test_caches_without_parser_column_are_upgraded(tmp_path):
+    cache_file = str(tmp_path / "cache.sqlite")
+    connection = sqlite3.connect(cache_file)
+    connection.execute("CREATE TABLE responses (key TEXT PRIMARY KEY, model TEXT NOT NULL, "
+                       "package TEXT NOT NULL, raw TEXT NOT NULL, parsed TEXT, "
+                       "created REAL NOT NULL, accessed REAL NOT NULL)")
+    handler = CachedQueryHandler(["package", "cryptographic_relevance", "justification"])
+    connection.execute("INSERT INTO responses VALUES (?, ?, ?, ?, ?, 0, 0)",
+                       (ResponseCache.key(handler.model_id, "prompt"), handler.model_id,
+                        "openssl", RAW, "stale,row"))
+    connection.commit()
+    connection.close()
+
+    cache = ResponseCache(cache_file)
+    assert cache.get(handler, "prompt")[1] == handler.parse_response(RAW, "openssl")
+    cache.close()
@@ -0,0 +1,35 @@
+import json
+
+import cascade
+from mock_llm import MockBehaviour, MockLLMServer
+from store import ResultStore
+from test_voting import ATTRIBUTES, MODEL, read_results, reparsed_models, run_parameters
+
+def test_cascade_run(tmp_path):
+    server = MockLLMServer(MockBehaviour(latency_median=0.01, malformed_rate=0.2, seed=2)).start()
+    try:
+        cascade.execute(**run_parameters(tmp_path, server), tiers=[[MODEL], [MODEL]],
+                        decision_attribute="cryptographic_relevance")
+    finally:
+        server.stop()
+
+    rows = read_results(tmp_path)
+    assert rows[0] == ATTRIBUTES + ["decided_by"]
+    assert len(rows) == 21
+    with open(tmp_path / "metrics.json", mode='r') as file:
+        assert json.load(file)["stages"]["provider"]["count"] >= 20
+    store = ResultStore(str(tmp_path / "results.sqlite"))
+    _, runs = store.runs()
+    assert len(runs) == 1 and runs[0][1].startswith("cascade:")
+    store.close()
+
+def test_cascade_run_reparses_the_cache_of_every_tier(tmp_path, monkeypatch):
+    models = reparsed_models(monkeypatch)
+    server = MockLLMServer(MockBehaviour(latency_median=0.01, seed=2)).start()
+    try:
+        cascade.execute(**run_parameters(tmp_path, server), tiers=[[MODEL], [MODEL]],
+                        decision_attribute="cryptographic_relevance", cache_reparse=True,
+                        query_restriction=0)
+    finally:
+        server.stop()
+    assert models == ["ollama.deepseek-r1:latest"] * 2
@@ -0,0 +1,74 @@
+from compaction import (TRUNCATED_DEPENDENCIES, TRUNCATED_DESCRIPTION, CompactingPromptGenerator,
+                        PromptCompactor, compact_query_handlers)
+from ratelimit import estimate_tokens
+from test_request import ScriptedQueryHandler
+
+def compactor():
+    # glibc is used by all packages, zlib by less than half of them
+    return PromptCompactor(frequencies={"glibc": 10, "zlib": 3, "libfoo": 1}, packages=10,
+                           ubiquitous_share=0.5)
+
+def test_rank_drops_ubiquitous_dependencies():
+    assert compactor().rank_dependencies("glibc, zlib, libfoo, openssl-libs") == \
+        ["openssl-libs", "libfoo", "zlib"]
+
+def test_fit_keeps_what_fits():
+    ranked = ["openssl-libs", "zlib"]
+    assert compactor()._fit(ranked, "A library", 100) == (ranked, "A library")
+
+def test_fit_cuts_dependencies_before_the_description():
+    ranked = [f"libdependency{idx}" for idx in range(20)]
+    kept, description = compactor()._fit(ranked, "A library", 40)
+    assert 0 < len(kept) < len(ranked)
+    assert kept[-1].endswith(TRUNCATED_DEPENDENCIES.format(count=len(ranked) - len(kept)))
+    assert description == "A library"
+    assert estimate_tokens(description) + estimate_tokens(", ".join(kept)) <= 40 + 2
+
+def test_fit_cuts_the_description_last():
+    description = "word " * 200
+    kept, cut = compactor()._fit(["zlib"], description, 40)
+    assert kept == ["zlib"]
+    assert cut.endswith(TRUNCATED_DESCRIPTION)
+    assert estimate_tokens(cut) + estimate_tokens(", ".join(kept)) <= 40 + 2
+
+class CountingPromptGenerator:
+    """Template with the name twice, counts its renders."""
+    def __init__(self):
+        self.renders = 0
+
+    def __call__(self, name, description, dependencies):
+        self.renders += 1
+        return f"Classify {name}.\nDescription: {description}\nDependencies: {dependencies}\n" \
+               f"Answer for {name} only."
+
+def test_template_is_measured_once():
+    prompt_generator = CountingPromptGenerator()
+    compacting = CompactingPromptGenerator(
+        prompt_generator, PromptCompactor(frequencies={}, packages=0, token_budget=40))
+    assert prompt_generator.renders == 2
+    description = "word " * 200
+    dependencies = ", ".join(f"libdependency{idx}" for idx in range(20))
+    for name in ("a", "a-much-longer-package-name"):
+        prompt = compacting(name, description, dependencies)
+        # the budget holds as if the template was rendered for the package
+        template = CountingPromptGenerator()
+        expected = compacting.compactor.compact(estimate_tokens(template(name, "", "")),
+                                                description, dependencies)
+        assert prompt == template(name, *expected)
+        assert estimate_tokens(prompt) <= 40 + 2
+    # one render per package
+    assert prompt_generator.renders == 4
+
+def test_models_sharing_a_template_share_the_compacted_prompts():
+    prompt_generator = CountingPromptGenerator()
+    query_handlers = []
+    for model_id in ["a.model", "b.model", "c.model"]:
+        query_handler = ScriptedQueryHandler([""])
+        query_handler = query_handler.with_prompt(prompt_generator, query_handler.response_parser)
+        query_handler.model_id = model_id
+        query_handlers.append(query_handler)
+    query_handlers[2] = query_handlers[2].with_prompt(CountingPromptGenerator(),
+                                                      query_handlers[2].response_parser)
+    compacted = compact_query_handlers(query_handlers, None, token_budget=100)
+    assert compacted[0].prompt_generator is compacted[1].prompt_generator
+    assert compacted[2].prompt_generator is not compacted[0].prompt_generator
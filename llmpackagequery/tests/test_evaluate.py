@@ -0,0 +1,43 @@
+import math
+
+import numpy as np
+import pytest
+
+from evaluate import MISSING, cohen_kappa, fleiss_kappa
+
+def test_cohen_kappa_of_two_runs():
+    verdicts = np.array([[1, 1, 0, 0],
+                         [1, 0, 0, 0]], dtype=np.int8)
+    kappa, common = cohen_kappa(verdicts)
+    # observed agreement 3/4, expected 1/2
+    assert kappa[0, 1] == pytest.approx(0.5)
+    assert kappa[0, 1] == kappa[1, 0]
+    assert kappa[0, 0] == pytest.approx(1.0)
+    assert common.tolist() == [[4, 4], [4, 4]]
+
+def test_cohen_kappa_compares_common_packages():
+    verdicts = np.array([[1, 1, 0, 0],
+                         [1, MISSING, 0, 0]], dtype=np.int8)
+    kappa, common = cohen_kappa(verdicts)
+    assert common[0, 1] == 3
+    assert kappa[0, 1] == pytest.approx(1.0)
+
+def test_fleiss_kappa():
+    verdicts = np.array([[1, 1, 0, 0],
+                         [1, 0, 0, 0]], dtype=np.int8)
+    kappa, count = fleiss_kappa(verdicts)
+    # agreement 3/4, true share 3/8
+    assert kappa == pytest.approx((0.75 - 34 / 64) / (1 - 34 / 64))
+    assert count == 4
+
+def test_fleiss_kappa_uses_complete_packages():
+    verdicts = np.array([[1, MISSING, 0, 1],
+                         [1, 0, 0, MISSING],
+                         [1, 1, 0, 1]], dtype=np.int8)
+    kappa, count = fleiss_kappa(verdicts)
+    assert count == 2
+    assert kappa == pytest.approx(1.0)
+
+def test_fleiss_kappa_without_variation():
+    assert math.isnan(fleiss_kappa(np.array([[1, 1], [1, 1]], dtype=np.int8))[0])
+    assert math.isnan(fleiss_kappa(np.array([[1, 0]], dtype=np.int8))[0])
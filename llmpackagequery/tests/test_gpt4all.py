@@ -0,0 +1,113 @@
+import sys
+import types
+from contextlib import contextmanager
+
+import config
+from query import GPT4ALLQueryHandler, ResponseParser, get_class
+from request import create_query_handler
+
+PREFIX = "Classify the package.\n"
+
+class FakeContext:
+    n_past = 0
+
+class FakeLLModel:
+    """KV cache of characters, every answer shows the cache it was generated from."""
+    def __init__(self):
+        self.context = FakeContext()
+        self.cache = ""
+
+    def prompt_model(self, prompt, prompt_template, callback, n_predict=4096, top_k=40, top_p=0.9,
+                     temp=0.1, n_batch=8, repeat_penalty=1.2, repeat_last_n=10,
+                     reset_context=False, special=False):
+        self.cache = "" if reset_context else self.cache[:self.context.n_past]
+        self.cache += prompt_template.replace("%1", prompt).replace("%2", "")
+        self.context.n_past = len(self.cache)
+        if n_predict:
+            callback(0, "context=" + self.cache)
+
+class FakeGPT4All:
+    # model files and devices of the loaded models
+    loaded = []
+
+    def __init__(self, llmodel=None, device=None):
+        if isinstance(llmodel, str):
+            FakeGPT4All.loaded.append((llmodel, device))
+            llmodel = None
+        self.model = llmodel or FakeLLModel()
+        self.config = {"promptTemplate": "<user>{0}</user>{1}", "systemPrompt": "<system>"}
+
+    @contextmanager
+    def chat_session(self):
+        self.model.cache = "<system>"
+        self.model.context.n_past = len(self.model.cache)
+        yield
+
+    def generate(self, prompt, max_tokens=200, temp=0.7, n_batch=8, callback=None):
+        self.model.cache += prompt
+        callback(0, "context=" + self.model.cache)
+
+class PrefixPromptGenerator:
+    static_prefix = PREFIX
+
+    def __call__(self, name, description, dependencies):
+        return PREFIX + name
+
+def handler(model):
+    return GPT4ALLQueryHandler(model, PrefixPromptGenerator(), ResponseParser(["package"]))
+
+def test_prefix_is_reused():
+    query_handler = handler(FakeGPT4All())
+    assert query_handler(PREFIX + "a") == "context=<system><user>" + PREFIX + "a</user>"
+    assert query_handler(PREFIX + "b") == "context=<system><user>" + PREFIX + "b</user>"
+
+def test_prefix_is_evaluated_again_after_a_chat_session():
+    model = FakeGPT4All()
+    query_handler = handler(model)
+    query_handler(PREFIX + "a")
+    # e.g. a batched prompt, answered in a chat session which resets the cache
+    assert query_handler("Batch of packages") == "context=<system>Batch of packages"
+    assert query_handler(PREFIX + "b") == "context=<system><user>" + PREFIX + "b</user>"
+
+def test_copies_share_the_state_of_the_cache():
+    model = FakeGPT4All()
+    query_handler = handler(model)
+    other = query_handler.with_prompt(lambda name, description, dependencies: name,
+                                      query_handler.response_parser)
+    query_handler(PREFIX + "a")
+    other("unprefixed")
+    assert query_handler(PREFIX + "b") == "context=<system><user>" + PREFIX + "b</user>"
+
+def test_unknown_bindings_fall_back_to_generate():
+    class OtherLLModel(FakeLLModel):
+        def prompt_model(self, prompt, callback, n_predict=4096):
+            raise AssertionError("not called")
+
+    query_handler = handler(FakeGPT4All(OtherLLModel()))
+    assert query_handler(PREFIX + "a") == "context=<system>" + PREFIX + "a"
+
+def stub_gpt4all(monkeypatch):
+    """Replace the gpt4all bindings by FakeGPT4All."""
+    FakeGPT4All.loaded = []
+    monkeypatch.setitem(sys.modules, "gpt4all", types.SimpleNamespace(GPT4All=FakeGPT4All))
+
+def create_gpt4all_handler(model_name, device="cuda"):
+    return create_query_handler(
+        query_stub="gpt4all",
+        llm_model=model_name,
+        prompt_template_file=config.QUERY_TEMPLATE_FILE.format(
+            os="fedora", llm_model=model_name, query_template_path=config.QUERY_TEMPLATE_PATH,
+            template_alternative="-prompt1v2"),
+        attributes=["package", "cryptographic_relevance", "justification"],
+        api_key=None,
+        host=None,
+        device=device)
+
+def test_handler_is_created_through_the_registry(monkeypatch):
+    stub_gpt4all(monkeypatch)
+    assert get_class("gpt4allQueryHandler") is GPT4ALLQueryHandler
+    query_handler = create_gpt4all_handler("orca-mini-3b-gguf2-q4_0", device="cuda:1")
+    assert isinstance(query_handler, GPT4ALLQueryHandler)
+    assert query_handler.model_id == "gpt4all.orca-mini-3b-gguf2-q4_0"
+    assert FakeGPT4All.loaded == [("orca-mini-3b-gguf2-q4_0.gguf", "cuda:1")]
+    assert query_handler("Classify the package curl.").startswith("context=")
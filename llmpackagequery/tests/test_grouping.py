@@ -0,0 +1,65 @@
+import csv
+
+from grouping import GroupingRequestManger
+from incremental import PreviousRun
+from packages import PACKAGE_COLUMNS
+from rules import RULES_DECIDER, PreClassifier
+from test_request import ANSWER, ATTRIBUTES, ScriptedQueryHandler
+
+# curl depends on openssl-libs, it is queried in the second level
+PACKAGES = [["openssl-libs", "3.2.2", "A general purpose cryptography library", ""],
+            ["curl", "8.9.1", "A utility for getting files from remote servers", "glibc, openssl-libs"]]
+
+def write_csv(csv_file, header, rows):
+    with open(csv_file, mode='w', newline='') as file:
+        csv_writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        csv_writer.writerow(header)
+        csv_writer.writerows(rows)
+
+def grouping_manger(query_handler, tmp_path, **kwargs):
+    return GroupingRequestManger(
+        query_handler=query_handler,
+        package_file_in=str(tmp_path / "packages.csv"),
+        package_file_out=str(tmp_path / "results.csv"),
+        decision_attribute="cryptographic_relevance",
+        topological=True,
+        **kwargs)
+
+def test_topological_run_carries_forward_unchanged_packages(tmp_path):
+    write_csv(tmp_path / "packages.csv", PACKAGE_COLUMNS, PACKAGES)
+    write_csv(tmp_path / "previous.csv", ATTRIBUTES,
+              [["openssl-libs", "True", "crypto"], ["curl", "True", "TLS"]])
+    previous_run = PreviousRun(str(tmp_path / "packages.csv"), str(tmp_path / "previous.csv"), ATTRIBUTES)
+    query_handler = ScriptedQueryHandler([ANSWER])
+    grouping_manger(query_handler, tmp_path, previous_run=previous_run).run()
+
+    # the dependency marked as relevant does not change the package
+    assert query_handler.calls == 0
+    assert previous_run.carried == 2
+
+def test_topological_run_pre_classifies_listed_dependencies(tmp_path):
+    write_csv(tmp_path / "packages.csv", PACKAGE_COLUMNS, PACKAGES)
+    pre_classifier = PreClassifier({"relevant_dependencies": ["openssl-libs"]},
+                                   ATTRIBUTES, "cryptographic_relevance")
+    query_handler = ScriptedQueryHandler([ANSWER])
+    grouping_manger(query_handler, tmp_path, pre_classifier=pre_classifier).run()
+
+    # only openssl-libs is left to the model
+    assert query_handler.calls == 1
+    assert pre_classifier.decided == 1
+
+def test_members_decided_by_the_rules_are_not_propagated(tmp_path):
+    write_csv(tmp_path / "packages.csv", PACKAGE_COLUMNS,
+              [["foo", "1.0", "The foo library", ""],
+               ["foo-doc", "1.0", "The foo library", ""]])
+    pre_classifier = PreClassifier({"irrelevant_name_patterns": ["-doc$"]},
+                                   ATTRIBUTES, "cryptographic_relevance")
+    query_handler = ScriptedQueryHandler([ANSWER])
+    grouping_manger(query_handler, tmp_path, pre_classifier=pre_classifier).run()
+
+    # foo-doc keeps the decision of the rules instead of the answer for foo
+    with open(tmp_path / "results.csv", mode='r', newline='') as file:
+        rows = {row[0]: row for row in csv.reader(file)}
+    assert query_handler.calls == 1
+    assert rows["foo"][1] == "True" and rows["foo"][-1] == ScriptedQueryHandler.model_id
+    assert rows["foo-doc"][1] == "False" and rows["foo-doc"][-1] == RULES_DECIDER
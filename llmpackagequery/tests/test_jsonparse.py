@@ -0,0 +1,40 @@
+import pytest
+
+import parse_benchmark
+import query
+from jsonparse import ObjectDetector, find_objects, load_objects
+from writer import split_results
+
+SINGLE_QUOTED = "{'package_name': 'a', 'is_security_relevant': True, 'explanation': 'has } brace'}"
+
+def test_find_objects_ignores_braces_in_strings():
+    text = 'x {"a": "}"} y ' + SINGLE_QUOTED + " {'b': don't {c}}"
+    assert find_objects(text) == ['{"a": "}"}', SINGLE_QUOTED, "{'b': don't {c}}"]
+    assert find_objects('{"a": 1} {"b": "{', closed_only=False) == ['{"a": 1}', '{"b": "{']
+
+def test_load_objects_reads_single_quoted_strings():
+    assert list(load_objects('{"a": 1} ' + SINGLE_QUOTED)) == [
+        {"a": 1}, {"package_name": "a", "is_security_relevant": True, "explanation": "has } brace"}]
+
+def test_object_detector_over_chunks():
+    detector = ObjectDetector(lambda data: "package_name" in data)
+    text = '<think>{"package_name": "x"}</think>{"other": 1}' + SINGLE_QUOTED
+    chunks = [text[pos:pos + 7] for pos in range(0, len(text), 7)]
+    done = [detector.feed(chunk) for chunk in chunks]
+    # accepted once the single quoted object is closed, not within its string
+    assert done.index(True) == len(chunks) - 1
+
+@pytest.mark.parametrize("parser_class", ["GPT_5ResponseParser", "DEEPSEEK_R1_LATESTResponseParser"])
+@pytest.mark.parametrize("kind, name, response", parse_benchmark.corpus_samples(["openssl"]))
+def test_corpus(parser_class, kind, name, response):
+    parser = getattr(query, parser_class)(parse_benchmark.BENCHMARK_ATTRIBUTES)
+    parser.last_error = None
+    values = split_results(parser(response, name), 3)
+    if kind == "prose":
+        assert parser.last_error is not None
+        assert values == [name, "", ""]
+        return
+    assert parser.last_error is None
+    assert values[0] == name
+    assert values[1] == ("False" if kind in ("strict_nested", "trailing_comma") else "True")
+    assert values[2] in (parse_benchmark.JUSTIFICATION.format(support="and SSH"), "TLS support", "has } brace")
@@ -0,0 +1,65 @@
+import pytest
+
+from query import GPT_5ResponseParser, QueryHandlerCallable
+from ratelimit import RateLimiter
+from request import RequestManger
+
+ATTRIBUTES = ["package", "cryptographic_relevance", "justification"]
+ANSWER = '{"package": "a", "cryptographic_relevance": true, "justification": "TLS"}'
+
+class ScriptedQueryHandler(QueryHandlerCallable):
+    """Answers with the scripted responses, exceptions are raised, the last one repeats."""
+    model_id = "stand-in.model"
+
+    def __init__(self, responses):
+        super().__init__(lambda name, description, dependencies: f"Package {name}",
+                         GPT_5ResponseParser(ATTRIBUTES))
+        self.responses = list(responses)
+        self.calls = 0
+
+    def __call__(self, question):
+        super().__call__(question)
+        response = self.responses[min(self.calls, len(self.responses) - 1)]
+        self.calls += 1
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+def request_manger(query_handler, tmp_path, breaker_threshold=5):
+    return RequestManger(
+        query_handler=query_handler,
+        package_file_in=str(tmp_path / "packages.csv"),
+        package_file_out=str(tmp_path / "results.csv"),
+        rate_limiter=RateLimiter(breaker_threshold=breaker_threshold, breaker_cooldown=0.0,
+                                 backoff_base=0.0))
+
+def test_transient_errors_are_retried(tmp_path):
+    query_handler = ScriptedQueryHandler([ConnectionError(), ANSWER])
+    result = request_manger(query_handler, tmp_path).do_request("a", "", "", query_handler)
+    assert result.values[1] == "True"
+    assert query_handler.calls == 2
+
+def test_open_breaker_is_waited_for_a_bounded_time(tmp_path):
+    query_handler = ScriptedQueryHandler([ConnectionError()])
+    manager = request_manger(query_handler, tmp_path, breaker_threshold=1)
+    manager.BREAKER_MAX_WAIT = 0.05
+    assert manager._ask(query_handler, "question", "package a") is None
+    assert query_handler.calls >= manager.RETRY_COUNT
+
+def test_parse_retries_do_not_repeat_transport_retries(tmp_path):
+    # the first request succeeds after two transient errors, the parse
+    # retry fails transiently and is not retried again
+    query_handler = ScriptedQueryHandler([ConnectionError(), ConnectionError(), "no answer", ConnectionError()])
+    result = request_manger(query_handler, tmp_path).do_request("a", "", "", query_handler)
+    assert query_handler.calls == 4
+    assert result.values[1] == ""
+
+def test_unparsable_answers_are_requested_retry_count_times(tmp_path):
+    query_handler = ScriptedQueryHandler(["no answer"])
+    manager = request_manger(query_handler, tmp_path)
+    manager.do_request("a", "", "", query_handler)
+    assert query_handler.calls == manager.RETRY_COUNT
+
+def test_handlers_without_create_cannot_be_created():
+    with pytest.raises(TypeError, match="ScriptedQueryHandler"):
+        ScriptedQueryHandler.create("model", None, None)
@@ -0,0 +1,32 @@
+import json
+from urllib.request import Request, urlopen
+
+from metrics import Metrics
+from request import RequestManger
+from service import ClassificationServer
+from test_request import ANSWER, ATTRIBUTES, ScriptedQueryHandler
+
+def classify(server, payload):
+    host, port = server.server_address[:2]
+    request = Request(f"http://{host}:{port}/classify", data=json.dumps(payload).encode(),
+                      headers={"Content-Type": "application/json"})
+    with urlopen(request, timeout=10) as response:
+        return json.load(response)
+
+def test_service_classifies_packages_in_order():
+    query_handler = ScriptedQueryHandler([ANSWER])
+    request_manger = RequestManger(query_handler=query_handler, package_file_in=None,
+                                   package_file_out=None, max_in_flight=2)
+    server = ClassificationServer(request_manger, Metrics(), host="127.0.0.1", window=0.01).start()
+    try:
+        # the duplicate is asked once
+        body = classify(server, {"packages": [{"name": "a"}, {"name": "b"}, {"name": "a"}]})
+        stats = server.stats()
+    finally:
+        server.stop()
+
+    assert body["model"] == query_handler.model_id
+    assert [result["cryptographic_relevance"] for result in body["results"]] == ["True"] * 3
+    assert list(body["results"][0]) == ATTRIBUTES
+    assert query_handler.calls == 2
+    assert stats["deduplicated"] == 1
@@ -0,0 +1,102 @@
+import csv
+import os
+import queue
+import re
+import sys
+import types
+from contextlib import contextmanager
+
+import config
+from packages import PACKAGE_COLUMNS
+from sharding import SHARD_RESULTS_FILE, _run_worker, merge_results, shard_of, split_package_list
+
+ATTRIBUTES = ["package", "cryptographic_relevance", "justification"]
+PACKAGES = [f"package-{idx}" for idx in range(40)]
+
+def write_package_list(tmp_path):
+    package_list = str(tmp_path / "packages.csv")
+    with open(package_list, mode='w', newline='') as file:
+        package_writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        package_writer.writerow(PACKAGE_COLUMNS)
+        package_writer.writerows([name, "1.0", "", ""] for name in PACKAGES)
+    return package_list
+
+def test_shard_of_is_stable_and_in_range():
+    shards = [shard_of(name, 4) for name in PACKAGES]
+    assert shards == [shard_of(name, 4) for name in PACKAGES]
+    assert set(shards) == {0, 1, 2, 3}
+    assert all(shard_of(name, 1) == 0 for name in PACKAGES)
+
+def test_merge_restores_the_input_order(tmp_path):
+    package_list = write_package_list(tmp_path)
+    shard_dir = str(tmp_path / "shards")
+    os.mkdir(shard_dir)
+    counts = split_package_list(package_list, shard_dir, 3)
+    assert sum(counts) == len(PACKAGES)
+
+    # every shard answers its packages in input order, package-7 failed
+    for shard in range(3):
+        with open(os.path.join(shard_dir, SHARD_RESULTS_FILE.format(shard=shard)), mode='w', newline='') as file:
+            result_writer = csv.writer(file)
+            result_writer.writerow(ATTRIBUTES)
+            result_writer.writerows([name, "True", shard] for name in PACKAGES
+                                    if shard_of(name, 3) == shard and name != "package-7")
+
+    csv_file_out = str(tmp_path / "results.csv")
+    assert merge_results(package_list, shard_dir, 3, csv_file_out) == len(PACKAGES) - 1
+    with open(csv_file_out, mode='r', newline='') as file:
+        rows = list(csv.reader(file))
+    assert rows[0] == ATTRIBUTES
+    assert [row[0] for row in rows[1:]] == [name for name in PACKAGES if name != "package-7"]
+    assert all(row[2] == str(shard_of(row[0], 3)) for row in rows[1:])
+
+class AnsweringGPT4All:
+    """Local model answering every package as relevant, without KV cache access."""
+    loaded = []
+
+    def __init__(self, model_file, device):
+        AnsweringGPT4All.loaded.append((model_file, device))
+        self.config = {}
+
+    @contextmanager
+    def chat_session(self):
+        yield
+
+    def generate(self, prompt, max_tokens=200, temp=0.7, n_batch=8, callback=None):
+        name = re.search(r"package-\d+", prompt).group(0)
+        callback(0, f'{{"package": "{name}", "cryptographic_relevance": true, "justification": "x"}}')
+
+def test_worker_queries_its_shards_with_one_gpt4all_model(tmp_path, monkeypatch):
+    AnsweringGPT4All.loaded = []
+    monkeypatch.setitem(sys.modules, "gpt4all", types.SimpleNamespace(GPT4All=AnsweringGPT4All))
+    monkeypatch.setenv("CUDA_VISIBLE_DEVICES", "")
+    package_list = write_package_list(tmp_path)
+    shard_dir = str(tmp_path / "shards")
+    os.mkdir(shard_dir)
+    split_package_list(package_list, shard_dir, 2)
+
+    llm_model = "orca-mini-3b-gguf2-q4_0"
+    execute_parameters = dict(
+        query_stub="gpt4all",
+        llm_model=llm_model,
+        prompt_template_file=config.QUERY_TEMPLATE_FILE.format(
+            os="fedora", llm_model=llm_model, query_template_path=config.QUERY_TEMPLATE_PATH,
+            template_alternative="-prompt1v2"),
+        attributes=ATTRIBUTES,
+        api_key=None,
+        host=None)
+    tasks, results = queue.Queue(), queue.Queue()
+    for task in (0, 1, None):
+        tasks.put(task)
+    _run_worker(0, "1", shard_dir, execute_parameters, tasks, results)
+
+    # the model is loaded once, on the GPU given by index
+    assert AnsweringGPT4All.loaded == [(f"{llm_model}.gguf", "cuda")]
+    assert os.environ["CUDA_VISIBLE_DEVICES"] == "1"
+    assert [results.get_nowait() for _ in range(3)] == [("ready", 0, None), ("done", 0, 0), ("done", 0, 1)]
+    csv_file_out = str(tmp_path / "results.csv")
+    assert merge_results(package_list, shard_dir, 2, csv_file_out) == len(PACKAGES)
+    with open(csv_file_out, mode='r', newline='') as file:
+        rows = list(csv.reader(file))
+    assert [row[0] for row in rows[1:]] == PACKAGES
+    assert all(row[1] == "True" for row in rows[1:])
@@ -0,0 +1,127 @@
+import csv
+import threading
+import time
+
+import config
+import voting
+from cache import ResponseCache
+from benchmark import BUNDLED_PACKAGE_LIST, synthetic_package_list
+from mock_llm import MockBehaviour, MockLLMServer
+from packages import PACKAGE_COLUMNS
+from query import GPT_5ResponseParser, QueryHandlerCallable
+from ratelimit import RateLimiter
+from store import ResultStore
+from voting import VoteMode, VotingRequestManger, aggregate_votes
+
+ATTRIBUTES = ["package", "cryptographic_relevance", "justification"]
+MODEL = ("ollama", "deepseek-r1:latest", config.QUERY_TEMPLATE_FILE.format(
+    os="fedora", llm_model="deepseek-r1:latest",
+    query_template_path=config.QUERY_TEMPLATE_PATH, template_alternative="-prompt1v2"))
+
+class SlowQueryHandler(QueryHandlerCallable):
+    """Answers after a delay and records the concurrent calls of all handlers."""
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def __init__(self, model_id, answer):
+        super().__init__(lambda name, description, dependencies: name, GPT_5ResponseParser(ATTRIBUTES))
+        self.model_id = model_id
+        self.answer = answer
+
+    def __call__(self, question):
+        super().__call__(question)
+        with SlowQueryHandler.lock:
+            SlowQueryHandler.running += 1
+            SlowQueryHandler.peak = max(SlowQueryHandler.peak, SlowQueryHandler.running)
+        time.sleep(0.05)
+        with SlowQueryHandler.lock:
+            SlowQueryHandler.running -= 1
+        return f'{{"package": "{question}", "cryptographic_relevance": {self.answer}, "justification": "x"}}'
+
+def write_packages(package_list, count):
+    with open(package_list, mode='w', newline='') as file:
+        package_writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+        package_writer.writerow(PACKAGE_COLUMNS)
+        for idx in range(count):
+            package_writer.writerow([f"pkg-{idx}", "", "", ""])
+
+def test_aggregate_votes():
+    assert aggregate_votes(["True", "False", "True"], VoteMode.MAJORITY) == "True"
+    assert aggregate_votes(["True", "False"], VoteMode.MAJORITY) == ""
+    assert aggregate_votes(["True", ""], VoteMode.UNANIMOUS) == ""
+    assert aggregate_votes(["True", "False"], VoteMode.WEIGHTED, [0.4, 0.6]) == "False"
+
+def test_models_are_asked_for_max_in_flight_packages(tmp_path):
+    write_packages(str(tmp_path / "packages.csv"), 8)
+    SlowQueryHandler.peak = 0
+    request_manger = VotingRequestManger(
+        query_handlers=[SlowQueryHandler("model-a", "true"), SlowQueryHandler("model-b", "false")],
+        package_file_in=str(tmp_path / "packages.csv"),
+        package_file_out=str(tmp_path / "results.csv"),
+        vote_attribute="cryptographic_relevance",
+        vote_mode=VoteMode.UNANIMOUS,
+        max_in_flight=2,
+        rate_limiter=RateLimiter())
+    request_manger.run()
+
+    # both models answer two packages at once
+    assert SlowQueryHandler.peak == 4
+    with open(tmp_path / "results.csv", mode='r', newline='') as file:
+        rows = list(csv.reader(file))
+    assert rows[0][-1] == "verdict"
+    assert [row[0] for row in rows[1:]] == [f"pkg-{idx}" for idx in range(8)]
+    assert all(row[-1] == "" for row in rows[1:])
+
+def run_parameters(tmp_path, server):
+    package_list = str(tmp_path / "packages.csv")
+    synthetic_package_list(BUNDLED_PACKAGE_LIST, 20, package_list)
+    return dict(
+        csv_file_out=str(tmp_path / "results.csv"),
+        attributes=ATTRIBUTES,
+        base_package_list=package_list,
+        api_keys={},
+        host=server.url,
+        max_in_flight=4,
+        cache_file=str(tmp_path / "cache.sqlite"),
+        metrics_file=str(tmp_path / "metrics.json"),
+        result_store=str(tmp_path / "results.sqlite"))
+
+def read_results(tmp_path):
+    with open(tmp_path / "results.csv", mode='r', newline='') as file:
+        return list(csv.reader(file))
+
+def test_voting_run(tmp_path):
+    server = MockLLMServer(MockBehaviour(latency_median=0.01, seed=2)).start()
+    try:
+        voting.execute(**run_parameters(tmp_path, server), models=[MODEL, MODEL],
+                       vote_attribute="cryptographic_relevance")
+    finally:
+        server.stop()
+
+    rows = read_results(tmp_path)
+    assert rows[0][-1] == voting.VERDICT_ATTRIBUTE
+    assert len(rows) == 21
+    # both models answer alike, every package has a verdict
+    assert all(row[-1] in ("True", "False") for row in rows[1:])
+    store = ResultStore(str(tmp_path / "results.sqlite"))
+    _, runs = store.runs()
+    assert len(runs) == 1 and runs[0][1].startswith("vote:")
+    store.close()
+
+def reparsed_models(monkeypatch):
+    models = []
+    monkeypatch.setattr(ResponseCache, "reparse",
+                        lambda self, query_handler: models.append(query_handler.model_id))
+    return models
+
+def test_voting_run_reparses_the_cache_of_every_model(tmp_path, monkeypatch):
+    models = reparsed_models(monkeypatch)
+    server = MockLLMServer(MockBehaviour(latency_median=0.01, seed=2)).start()
+    try:
+        voting.execute(**run_parameters(tmp_path, server), models=[MODEL, MODEL],
+                       vote_attribute="cryptographic_relevance", cache_reparse=True,
+                       query_restriction=0)
+    finally:
+        server.stop()
+    assert models == ["ollama.deepseek-r1:latest"] * 2
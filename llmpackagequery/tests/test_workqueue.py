@@ -0,0 +1,127 @@
+import csv
+import socket
+import threading
+from time import sleep
+
+import httpx
+
+import config
+import request
+import workqueue
+from benchmark import BUNDLED_PACKAGE_LIST, synthetic_package_list
+from mock_llm import MockBehaviour, MockLLMServer
+from writer import CSVResultsWriter, format_results
+
+ATTRIBUTES = ["package", "cryptographic_relevance", "justification"]
+
+def work_queue(tmp_path, packages, lease_timeout=300.0):
+    rows = enumerate([[name, "1.0", "", ""] for name in packages])
+    writer = CSVResultsWriter(open(tmp_path / "results.csv", mode='w', newline=''), ATTRIBUTES)
+    writer.__enter__()
+    return workqueue.WorkQueue(package_reader=rows, writer=writer, header=ATTRIBUTES,
+                               lease_timeout=lease_timeout), writer
+
+def result(name):
+    return format_results([name, "True", "x"])
+
+def written_packages(tmp_path):
+    with open(tmp_path / "results.csv", mode='r', newline='') as file:
+        return [row[0] for row in csv.reader(file)][1:]
+
+def test_results_are_written_in_input_order(tmp_path):
+    queue, writer = work_queue(tmp_path, ["a", "b", "c"])
+    first = queue.lease("w1", 2)
+    second = queue.lease("w2", 2)
+    assert [offset for offset, _ in first["packages"]] == [0, 1]
+    assert [offset for offset, _ in second["packages"]] == [2]
+
+    # the later lease finishes first and waits for the earlier one
+    assert queue.complete(second["lease"], [(2, result("c"))]) == 1
+    assert queue.written == 0
+    assert queue.complete(first["lease"], [(0, result("a")), (1, result("b"))]) == 2
+    writer.close()
+    assert queue.written == 3 and queue.lease("w1", 1)["done"]
+    assert written_packages(tmp_path) == ["a", "b", "c"]
+
+def test_packages_without_results_are_leased_again(tmp_path):
+    queue, writer = work_queue(tmp_path, ["a", "b"])
+    lease = queue.lease("w1", 2)
+    queue.complete(lease["lease"], [(0, result("a"))])
+    again = queue.lease("w2", 2)
+    assert [offset for offset, _ in again["packages"]] == [1]
+    writer.close()
+
+def test_expired_leases_are_leased_again(tmp_path):
+    queue, writer = work_queue(tmp_path, ["a", "b"], lease_timeout=-1.0)
+    expired = queue.lease("w1", 2)
+    again = queue.lease("w2", 2)
+    assert [offset for offset, _ in again["packages"]] == [0, 1]
+    assert not queue.renew(expired["lease"])
+
+    # a late report of the expired lease is accepted for open packages
+    assert queue.complete(expired["lease"], [(0, result("a"))]) == 1
+    assert queue.complete(again["lease"], [(0, result("a")), (1, result("b"))]) == 1
+    writer.close()
+    assert written_packages(tmp_path) == ["a", "b"]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def test_workers_finish_the_lease_of_a_dead_worker(tmp_path, monkeypatch):
+    monkeypatch.setattr(workqueue, "DONE_GRACE_PERIOD", 2.0)
+    package_list = str(tmp_path / "packages.csv")
+    synthetic_package_list(BUNDLED_PACKAGE_LIST, 60, package_list)
+    csv_file_out = str(tmp_path / "results.csv")
+    port = free_port()
+    coordinator_url = f"http://127.0.0.1:{port}"
+
+    server = MockLLMServer(MockBehaviour(latency_median=0.01, error_rate=0.05, seed=3)).start()
+    coordinator = threading.Thread(target=workqueue.serve, kwargs=dict(
+        base_package_list=package_list, csv_file_out=csv_file_out, header=ATTRIBUTES,
+        host="127.0.0.1", port=port, lease_timeout=1.0))
+    coordinator.start()
+    try:
+        for _ in range(50):
+            try:
+                httpx.get(coordinator_url + "/status")
+                break
+            except httpx.HTTPError:
+                sleep(0.1)
+        # a worker which dies after leasing
+        dead = httpx.post(coordinator_url + "/lease",
+                          json={"worker": "dead", "size": 20, "header": ATTRIBUTES}).json()
+        assert len(dead["packages"]) == 20
+
+        def worker(idx, query_stub, llm_model):
+            request.execute(
+                query_stub=query_stub,
+                llm_model=llm_model,
+                prompt_template_file=config.QUERY_TEMPLATE_FILE.format(
+                    os="fedora", llm_model=llm_model, query_template_path=config.QUERY_TEMPLATE_PATH,
+                    template_alternative="-prompt1v2"),
+                csv_file_out=str(tmp_path / f"worker{idx}.csv"),
+                attributes=ATTRIBUTES,
+                base_package_list=None,
+                api_key="x",
+                host=server.url,
+                api_base_url=server.url + ("/v1" if query_stub == "openai" else ""),
+                max_in_flight=2,
+                work_queue=coordinator_url)
+
+        workers = [threading.Thread(target=worker, args=(idx, query_stub, llm_model))
+                   for idx, (query_stub, llm_model) in enumerate(
+                       [("ollama", "deepseek-r1:latest"), ("openai", "gpt-5"), ("ollama", "deepseek-r1:latest")])]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join(timeout=120)
+        coordinator.join(timeout=30)
+    finally:
+        server.stop()
+
+    assert not coordinator.is_alive()
+    with open(package_list, mode='r', newline='') as file:
+        packages = [row[0] for row in csv.reader(file)][1:]
+    assert written_packages(tmp_path) == packages
@@ -0,0 +1,53 @@
+from writer import (CHECKPOINT_FILE, DEFAULT_PACKAGE_HEADER, CSVResultsWriter, format_results,
+                    prepare_resume, read_checkpoint, split_results)
+
+def write_rows(csv_file, rows, offsets=None):
+    checkpoint_file = CHECKPOINT_FILE.format(csv_file=csv_file)
+    with CSVResultsWriter(open(csv_file, mode='w', newline=''), DEFAULT_PACKAGE_HEADER,
+                          checkpoint_file) as writer:
+        for offset, row in enumerate(rows, start=1):
+            writer.write_results(row, input_offset=offset)
+
+def test_split_results_pads_and_cuts():
+    assert split_results('"a", "True", "x, y"', 3) == ["a", "True", "x, y"]
+    assert split_results('"a"', 3) == ["a", "", ""]
+    assert split_results(format_results(["a", "b", "c", "d"]), 2) == ["a", "b"]
+
+def test_resume_keeps_rows_with_newlines(tmp_path):
+    csv_file = str(tmp_path / "results.csv")
+    write_rows(csv_file, [format_results(["a", "True", "first\nsecond"]),
+                          format_results(["b", "False", "plain"])])
+    with open(csv_file, mode='a', newline='') as file:
+        # a killed run cut off within a quoted value
+        file.write('"c","True","half\nwritten')
+    size = len(open(csv_file, mode='rb').read()) - len(b'"c","True","half\nwritten')
+    # the checkpoint is gone, the complete rows are kept
+    (tmp_path / "results.csv.checkpoint").unlink()
+
+    checkpoint, done_packages = prepare_resume(csv_file, DEFAULT_PACKAGE_HEADER)
+    assert done_packages == {"a", "b"}
+    assert checkpoint.rows == 2
+    assert checkpoint.file_size == size
+    assert open(csv_file, mode='rb').read().endswith(b'"plain"\r\n')
+
+def test_resume_truncates_to_checkpoint(tmp_path):
+    csv_file = str(tmp_path / "results.csv")
+    write_rows(csv_file, [format_results(["a", "True", "x"])])
+    with open(csv_file, mode='a', newline='') as file:
+        file.write('"b","False","not synced"\r\n')
+
+    checkpoint, done_packages = prepare_resume(csv_file, DEFAULT_PACKAGE_HEADER)
+    assert done_packages == {"a"}
+    assert checkpoint.input_offset == 1
+
+def test_failed_rows_hold_the_checkpoint(tmp_path):
+    csv_file = str(tmp_path / "results.csv")
+    # the empty second row cannot be parsed and is not written
+    write_rows(csv_file, [format_results(["a", "True", "x"]), '',
+                          format_results(["c", "False", "y"])])
+
+    checkpoint = read_checkpoint(CHECKPOINT_FILE.format(csv_file=csv_file))
+    assert checkpoint.input_offset == 1
+    assert checkpoint.rows == 2
+    _, done_packages = prepare_resume(csv_file, DEFAULT_PACKAGE_HEADER)
+    assert done_packages == {"a", "c"}
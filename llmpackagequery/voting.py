@@ -0,0 +1,249 @@
+import logging
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Dict, List, Tuple
+
+from cache import ResponseCache
+from compaction import compact_query_handlers
+from incremental import PreviousRun
+from metrics import Metrics
+from ratelimit import RateLimit, RateLimiter
+from query import QueryHandlerCallable, TemplateBasedPromptGenerator
+from request import RequestManger, RunSetup, create_query_handler
+from store import RunRecorder, template_name
+from writer import format_results, split_results
+
+log = logging.getLogger(__name__)
+
+VERDICT_ATTRIBUTE = "verdict"
+
+class VoteMode (Enum):
+    """Aggregation of the votes of several models."""
+    MAJORITY = "majority"
+    UNANIMOUS = "unanimous"
+    WEIGHTED = "weighted"
+
+def aggregate_votes(votes: List[str],
+                    mode: VoteMode,
+                    weights: List[float] | None = None) -> str:
+    """
+    Aggregate the boolean answers ("True"/"False") of several models.
+    Other answers count as abstention. Returns "True", "False" or
+    an empty string if no verdict can be reached.
+    """
+    if mode == VoteMode.UNANIMOUS:
+        # every model has to answer and all answers have to agree
+        if votes and all(vote == votes[0] for vote in votes) and votes[0] in ("True", "False"):
+            return votes[0]
+        return ""
+
+    if mode == VoteMode.MAJORITY or weights is None:
+        weights = [1.0] * len(votes)
+
+    score_true = sum(w for vote, w in zip(votes, weights) if vote == "True")
+    score_false = sum(w for vote, w in zip(votes, weights) if vote == "False")
+    if score_true > score_false:
+        return "True"
+    if score_false > score_true:
+        return "False"
+    return ""
+
+def voting_attributes(attributes: List[str], model_ids: List[str]) -> List[str]:
+    """Package name, the attributes of every model and the verdict."""
+    header = [attributes[0]]
+    for model_id in model_ids:
+        header += [f"{model_id}:{attr}" for attr in attributes[1:]]
+    return header + [VERDICT_ATTRIBUTE]
+
+class VotingRequestManger(RequestManger):
+    """
+    Ask every package to several models and write their answers side by
+    side together with an aggregated verdict. The prompt of a package is
+    rendered once per template and sent to all models using it.
+    """
+    _query_handlers: List[QueryHandlerCallable]
+    _vote_attribute: str
+    _vote_mode: VoteMode
+    _vote_weights: List[float] | None
+    _executor: ThreadPoolExecutor
+
+    def __init__(self,
+                 query_handlers: List[QueryHandlerCallable],
+                 package_file_in: str,
+                 package_file_out: str,
+                 vote_attribute: str,
+                 vote_mode: VoteMode = VoteMode.MAJORITY,
+                 vote_weights: List[float] | None = None,
+                 query_restriction: int = sys.maxsize,
+                 max_in_flight: int = 1,
+                 response_cache: ResponseCache | None = None,
+                 resume: bool = False,
+                 previous_run: PreviousRun | None = None,
+                 metrics: Metrics | None = None,
+                 rate_limiter: RateLimiter | None = None,
+                 result_recorder: RunRecorder | None = None) -> None:
+
+        super().__init__(
+            query_handler=query_handlers[0],
+            package_file_in=package_file_in,
+            package_file_out=package_file_out,
+            query_restriction=query_restriction,
+            max_in_flight=max_in_flight,
+            response_cache=response_cache,
+            resume=resume,
+            previous_run=previous_run,
+            metrics=metrics,
+            rate_limiter=rate_limiter,
+            result_recorder=result_recorder)
+
+        self._query_handlers = query_handlers
+        self._vote_attribute = vote_attribute
+        self._vote_mode = vote_mode
+        self._vote_weights = vote_weights
+
+    def write_attributes(self) -> List[str]:
+        return voting_attributes(
+            self._query_handler.response_parser.attributes_list,
+            [query_handler.model_id for query_handler in self._query_handlers])
+
+    def run(self):
+        # up to max in flight packages are requested at once (RequestManger.run),
+        # each asks all models, so every model gets max in flight requests
+        with ThreadPoolExecutor(max_workers=self._max_in_flight * len(self._query_handlers)) as self._executor:
+            super().run()
+
+    def _request_row(self, row: List[str]) -> str:
+        # unchanged packages keep the result of the previous run
+        if self._previous_run is not None:
+            previous = self._previous_run.lookup(row)
+            if previous is not None:
+                return format_results(previous)
+
+        # render the prompt once per template
+        questions: Dict[int, str] = {}
+        for query_handler in self._query_handlers:
+            generator = id(query_handler.prompt_generator)
+            if generator not in questions:
+                with self._metrics.timer("render"):
+                    questions[generator] = query_handler.generate_question_for_package(
+                        name=row[0], description=row[2], dependencies=row[3])
+
+        futures = [
+            self._executor.submit(
+                self.do_request,
+                package_name=row[0],
+                package_description=row[2],
+                package_tree=row[3],
+                query_handler=query_handler,
+                question=questions[id(query_handler.prompt_generator)])
+            for query_handler in self._query_handlers]
+
+        attributes = self._query_handler.response_parser.attributes_list
+        vote_index = attributes.index(self._vote_attribute)
+        results = [row[0]]
+        votes = []
+        for future in futures:
+            # keep the column count if a model returned a broken row
+            values = split_results(future.result(), len(attributes))
+            results += values[1:]
+            votes.append(values[vote_index])
+
+        results.append(aggregate_votes(votes, self._vote_mode, self._vote_weights))
+        return format_results(results)
+
+def execute(
+        models: List[Tuple[str, str, str]],
+        csv_file_out: str,
+        attributes: List[str],
+        base_package_list: str,
+        api_keys: Dict[str, str | None],
+        host: str,
+        vote_attribute: str,
+        vote_mode: VoteMode = VoteMode.MAJORITY,
+        vote_weights: List[float] | None = None,
+        query_restriction: int = sys.maxsize,
+        max_in_flight: int = 1,
+        cache_file: str | None = None,
+        cache_max_age: float | None = None,
+        cache_max_entries: int | None = None,
+        cache_reparse: bool = False,
+        resume: bool = False,
+        previous_package_list: str | None = None,
+        previous_results: str | None = None,
+        metrics_file: str | None = None,
+        metrics_interval: float = 60.0,
+        metrics_port: int | None = None,
+        rate_limits: Dict[str, RateLimit] | None = None,
+        stream: bool = False,
+        structured_output: bool = False,
+        compact_prompts: bool = False,
+        prompt_token_budget: int | None = None,
+        result_store: str | None = None) -> None:
+    """
+    Query all models given as (query stub, model, prompt template file)
+    for every package and write one results file with their verdict.
+    """
+    # models using the same template share the prompt generator,
+    # templates are compared by content as every model has its own file
+    prompt_generators: Dict[str, TemplateBasedPromptGenerator] = {}
+    query_handlers: List[QueryHandlerCallable] = []
+    for query_stub, llm_model, prompt_template_file in models:
+        with open(prompt_template_file, 'r') as file:
+            template = file.read()
+        if template not in prompt_generators:
+            prompt_generators[template] = TemplateBasedPromptGenerator(
+                full_template_path=prompt_template_file)
+
+        query_handlers.append(create_query_handler(
+            query_stub=query_stub,
+            llm_model=llm_model,
+            prompt_template_file=prompt_template_file,
+            attributes=attributes,
+            api_key=api_keys.get(query_stub),
+            host=host,
+            prompt_generator=prompt_generators[template],
+            stream=stream,
+            structured_output=structured_output))
+
+    if compact_prompts:
+        # every model gets prompts fitting its own token budget,
+        # models sharing template and budget share the prompts
+        query_handlers = compact_query_handlers(query_handlers, base_package_list, prompt_token_budget)
+
+    with RunSetup(
+            query_handlers=query_handlers,
+            csv_file_out=csv_file_out,
+            attributes=attributes,
+            result_attributes=voting_attributes(
+                attributes, [query_handler.model_id for query_handler in query_handlers]),
+            base_package_list=base_package_list,
+            # the voting run is recorded as one model
+            recorded_model="vote:" + ",".join(query_handler.model_id for query_handler in query_handlers),
+            template=template_name(models[0][2]),
+            query_restriction=query_restriction,
+            max_in_flight=max_in_flight,
+            cache_file=cache_file,
+            cache_max_age=cache_max_age,
+            cache_max_entries=cache_max_entries,
+            cache_reparse=cache_reparse,
+            resume=resume,
+            previous_package_list=previous_package_list,
+            previous_results=previous_results,
+            metrics_file=metrics_file,
+            metrics_interval=metrics_interval,
+            metrics_port=metrics_port,
+            rate_limits=rate_limits,
+            result_store=result_store,
+            verdict_attribute=VERDICT_ATTRIBUTE) as run_setup:
+
+        request_manger = VotingRequestManger(
+            **run_setup.manger_parameters,
+            query_handlers=query_handlers,
+            vote_attribute=vote_attribute,
+            vote_mode=vote_mode,
+            vote_weights=vote_weights)
+
+        log.info(f"Starting requests to {len(query_handlers)} models ...")
+        request_manger.run()
@@ -0,0 +1,396 @@
+from __future__ import annotations
+
+import json
+import logging
+import socket
+import sys
+import threading
+import uuid
+
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from time import monotonic, sleep, time
+from typing import TYPE_CHECKING, Deque, Dict, Iterator, List, Set, Tuple
+
+from packages import read_packages
+from ratelimit import classify_error
+from request import RequestManger
+from store import ResultStore, RunRecorder
+from writer import CHECKPOINT_FILE, Checkpoint, CSVResultsWriter, prepare_resume
+
+if TYPE_CHECKING:
+    import httpx
+
+log = logging.getLogger(__name__)
+
+# seconds a worker waits if all packages are leased but not finished
+LEASE_RETRY_AFTER = 1.0
+# seconds the coordinator keeps answering workers after the last result
+DONE_GRACE_PERIOD = 5.0
+# upper bound of the packages of one lease
+MAX_LEASE_SIZE = 1_000
+
+@dataclass
+class Lease:
+    """Packages handed to a worker until the lease expires."""
+    lease_id: str
+    worker: str
+    offsets: List[int]
+    expires: float
+
+class WorkQueue:
+    """
+    Queue of the packages of one package list shared by several workers.
+    Workers lease batches of packages and report their results, the
+    packages of expired leases are leased again. The results are written
+    to one results file in the order of the package list.
+    """
+    _package_reader: Iterator[Tuple[int, List[str]]]
+    _writer: CSVResultsWriter
+    _lease_timeout: float
+    _lock: threading.Lock
+    # packages read from the package list and not finished yet
+    _open: Dict[int, List[str]]
+    # offsets of expired leases to lease again
+    _requeued: Deque[int]
+    # offsets in input order waiting to be written and their results
+    _order: Deque[int]
+    _results: Dict[int, str]
+    _leases: Dict[str, Lease]
+    _workers: Set[str]
+    _exhausted: bool = False
+    written: int = 0
+
+    def __init__(self,
+                 package_reader: Iterator[Tuple[int, List[str]]],
+                 writer: CSVResultsWriter,
+                 header: List[str],
+                 lease_timeout: float = 300.0) -> None:
+        self._package_reader = package_reader
+        self._writer = writer
+        self.header = header
+        self._lease_timeout = lease_timeout
+        self._lock = threading.Lock()
+        self._open = {}
+        self._requeued = deque()
+        self._order = deque()
+        self._results = {}
+        self._leases = {}
+        self._workers = set()
+
+    @property
+    def done(self) -> bool:
+        return self._exhausted and not self._open
+
+    def lease(self, worker: str, size: int) -> Dict:
+        """Lease up to size packages to a worker."""
+        with self._lock:
+            self._workers.add(worker)
+            self._expire()
+            offsets = []
+            while self._requeued and len(offsets) < size:
+                offset = self._requeued.popleft()
+                # finished by a late report of the expired lease
+                if offset in self._open:
+                    offsets.append(offset)
+            while not self._exhausted and len(offsets) < size:
+                package = next(self._package_reader, None)
+                if package is None:
+                    self._exhausted = True
+                    break
+                offset, row = package
+                self._open[offset] = row
+                self._order.append(offset)
+                offsets.append(offset)
+
+            if not offsets:
+                return {"done": self.done, "packages": [], "retry_after": LEASE_RETRY_AFTER}
+
+            lease = Lease(lease_id=uuid.uuid4().hex, worker=worker, offsets=offsets,
+                          expires=monotonic() + self._lease_timeout)
+            self._leases[lease.lease_id] = lease
+            return {"done": False, "lease": lease.lease_id, "timeout": self._lease_timeout,
+                    "packages": [[offset, self._open[offset]] for offset in offsets]}
+
+    def renew(self, lease_id: str) -> bool:
+        """Extend a lease, False if it already expired."""
+        with self._lock:
+            lease = self._leases.get(lease_id)
+            if lease is None:
+                return False
+            lease.expires = monotonic() + self._lease_timeout
+            return True
+
+    def complete(self, lease_id: str, results: List[Tuple[int, str]]) -> int:
+        """
+        Record the results of a lease, returns the number of results
+        accepted. Results of an expired lease are accepted for packages
+        not finished by another worker yet.
+        """
+        with self._lock:
+            lease = self._leases.pop(lease_id, None)
+            if lease is None:
+                log.warning(f"Results of expired lease {lease_id} reported.")
+            accepted = 0
+            for offset, result in results:
+                if self._open.pop(offset, None) is not None:
+                    self._results[offset] = result
+                    accepted += 1
+            if lease is not None:
+                # packages of the lease without results are leased again
+                self._requeued.extend(offset for offset in lease.offsets if offset in self._open)
+            self._write_finished()
+            return accepted
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {"done": self.done, "written": self.written, "open": len(self._open),
+                    "leases": len(self._leases), "workers": sorted(self._workers)}
+
+    def _expire(self) -> None:
+        # called with the lock held
+        now = monotonic()
+        for lease in [lease for lease in self._leases.values() if lease.expires < now]:
+            del self._leases[lease.lease_id]
+            offsets = [offset for offset in lease.offsets if offset in self._open]
+            log.warning(f"Lease {lease.lease_id} of worker {lease.worker} expired, " \
+                        f"leasing {len(offsets)} packages again.")
+            self._requeued.extend(offsets)
+
+    def _write_finished(self) -> None:
+        # called with the lock held, write results in input order
+        while self._order and self._order[0] in self._results:
+            offset = self._order.popleft()
+            self._writer.write_results(self._results.pop(offset), input_offset=offset + 1)
+            self.written += 1
+
+class _WorkQueueHandler(BaseHTTPRequestHandler):
+    server: "WorkQueueServer"
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _send(self, status: int, payload: Dict) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._send(200, self.server.queue.status())
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError as e:
+            self._send(400, {"error": f"Invalid request: {e}"})
+            return
+
+        queue = self.server.queue
+        if self.path == "/lease":
+            if body.get("header") != queue.header:
+                self._send(409, {"error": f"Results header {body.get('header')} " \
+                                          f"does not match {queue.header}."})
+                return
+            size = max(1, min(MAX_LEASE_SIZE, int(body.get("size", 1))))
+            self._send(200, queue.lease(str(body.get("worker")), size))
+        elif self.path == "/renew":
+            if queue.renew(body.get("lease")):
+                self._send(200, {})
+            else:
+                self._send(410, {"error": "Lease expired."})
+        elif self.path == "/complete":
+            accepted = queue.complete(body.get("lease"), [tuple(result) for result in body.get("results", [])])
+            self._send(200, {"accepted": accepted})
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+class WorkQueueServer(ThreadingHTTPServer):
+    """
+    Coordinator serving a work queue over HTTP with JSON bodies:
+    POST /lease {"worker", "size", "header"}, POST /renew {"lease"},
+    POST /complete {"lease", "results": [[offset, result], ...]} and
+    GET /status. The header of the worker must match the results file.
+    """
+    daemon_threads = True
+    queue: WorkQueue
+
+    def __init__(self, queue: WorkQueue, host: str = "", port: int = 0) -> None:
+        super().__init__((host, port), _WorkQueueHandler)
+        self.queue = queue
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        # listening on all interfaces, workers connect to the host name
+        if host in ("", "0.0.0.0"):
+            host = socket.gethostname()
+        return f"http://{host}:{port}"
+
+def serve(base_package_list: str,
+          csv_file_out: str,
+          header: List[str],
+          host: str = "",
+          port: int = 0,
+          lease_timeout: float = 300.0,
+          query_restriction: int = sys.maxsize,
+          resume: bool = False,
+          log_interval: float = 60.0,
+          result_store: str | None = None,
+          model: str = "",
+          template: str = "") -> None:
+    """
+    Serve the packages of the package list to workers until all results
+    are written to the results file. With a result store the results are
+    recorded in it as a run of the model and template of the workers.
+    """
+    checkpoint = Checkpoint(input_offset=0, rows=0, file_size=0)
+    done_packages: Set[str] = set()
+    if resume:
+        checkpoint, done_packages = prepare_resume(csv_file_out, header)
+        log.info(f"Resuming {csv_file_out} at input offset " \
+                 f"{checkpoint.input_offset} with {checkpoint.rows} rows written.")
+
+    rows = islice(enumerate(read_packages(base_package_list)), checkpoint.input_offset, None)
+    rows = ((offset, row) for offset, row in rows if row[0] not in done_packages)
+    rows = islice(rows, query_restriction)
+
+    store = ResultStore(result_store) if result_store else None
+    result_recorder = None
+    if store is not None:
+        log.info(f"Recording results in {result_store}")
+        result_recorder = RunRecorder(store=store, model=model, template=template,
+                                      package_list=base_package_list, results_file=csv_file_out,
+                                      resume=resume)
+
+    with open(csv_file_out, mode='a' if resume else 'w', newline='') as file_write:
+        with CSVResultsWriter(
+                file_dst=file_write,
+                package_header=header,
+                checkpoint_file=CHECKPOINT_FILE.format(csv_file=csv_file_out),
+                checkpoint=checkpoint,
+                recorder=result_recorder) as writer:
+            queue = WorkQueue(package_reader=rows, writer=writer, header=header,
+                              lease_timeout=lease_timeout)
+            server = WorkQueueServer(queue, host=host, port=port)
+            log.info(f"Serving {base_package_list} to workers at {server.url}")
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                start_time = time()
+                last_log = start_time
+                while not queue.done:
+                    sleep(0.5)
+                    if time() - last_log >= log_interval:
+                        last_log = time()
+                        log.info(f"Work queue: {queue.status()}, overall: {last_log - start_time:,.2f}")
+                # let the workers learn that the queue is done
+                sleep(DONE_GRACE_PERIOD)
+            finally:
+                server.shutdown()
+                server.server_close()
+            log.info(f"Wrote {queue.written} results to {csv_file_out}")
+    if store is not None:
+        store.close()
+
+class WorkQueueRequestManger(RequestManger):
+    """
+    Worker of a work queue served by another process or host. Leased
+    packages are requested like the packages of a package list, results
+    are reported to the coordinator which writes the results file. A
+    background thread renews the lease while the packages are requested.
+    """
+    _coordinator_url: str
+    _worker_id: str
+    _lease_size: int
+
+    def __init__(self,
+                 *args,
+                 coordinator_url: str,
+                 worker_id: str | None = None,
+                 lease_size: int | None = None,
+                 **kwargs) -> None:
+
+        super().__init__(*args, **kwargs)
+        self._coordinator_url = coordinator_url.rstrip("/")
+        self._worker_id = worker_id or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        # enough packages to keep all requests in flight busy
+        self._lease_size = lease_size or 4 * self._max_in_flight * self._batch_size
+
+    def _post(self, client: httpx.Client, path: str, body: Dict) -> Dict:
+        # connection problems with the coordinator are retried
+        import httpx
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = client.post(path, json=body)
+                response.raise_for_status()
+                return response.json()
+            except httpx.HTTPStatusError as e:
+                raise RuntimeError(f"Coordinator rejected {path}: {e.response.text}") from e
+            except Exception as e:
+                if classify_error(e) is None or attempt >= self.RETRY_COUNT:
+                    raise
+                log.warning(f"Request {path} to the coordinator failed on attempt {attempt}: {e}")
+                sleep(LEASE_RETRY_AFTER * 2 ** attempt)
+
+    @contextmanager
+    def _renewing(self, client: httpx.Client, lease_id: str, timeout: float) -> Iterator[None]:
+        # renew the lease three times per timeout until the results are reported
+        import httpx
+        stopped = threading.Event()
+
+        def renew():
+            while not stopped.wait(timeout / 3):
+                try:
+                    if client.post("/renew", json={"lease": lease_id}).status_code != 200:
+                        log.warning(f"Lease {lease_id} expired, results may be discarded.")
+                        return
+                except httpx.HTTPError as e:
+                    log.warning(f"Renewing lease {lease_id} failed: {e}")
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def run(self):
+        # the HTTP client is only loaded by workers
+        import httpx
+        write_attributes = self.write_attributes()
+        log.info(f"Worker {self._worker_id} leasing from {self._coordinator_url}")
+        start_time = time()
+        idx = 0
+        with httpx.Client(base_url=self._coordinator_url, timeout=60.0) as client:
+            while True:
+                lease = self._post(client, "/lease", {
+                    "worker": self._worker_id, "size": self._lease_size, "header": write_attributes})
+                if lease["done"]:
+                    break
+                if not lease["packages"]:
+                    sleep(lease.get("retry_after", LEASE_RETRY_AFTER))
+                    continue
+
+                results = []
+                with self._renewing(client, lease["lease"], lease["timeout"]):
+                    for offset, result in self._ordered_results(
+                            (offset, row) for offset, row in lease["packages"]):
+                        results.append([offset, result])
+                        self._log_progress(idx, start_time)
+                        idx += 1
+                self._post(client, "/complete", {"lease": lease["lease"], "results": results})
+
+        log.info(f"Worker {self._worker_id} finished {idx} packages.")
+        self._log_summary()
@@ -1,31 +1,180 @@
+from dataclasses import asdict, dataclass
 from io import StringIO, TextIOWrapper
 import csv
+import json
 import logging
-from typing import List
+from typing import TYPE_CHECKING, BinaryIO, Iterator, List, Sequence, Set, Tuple
 import os
 
+if TYPE_CHECKING:
+    from store import RunRecorder
+
 log = logging.getLogger(__name__)
 
 DEFAULT_PACKAGE_HEADER = ["package_name", "is_security_relevant", "explanation"]
+# column naming the model or stage which decided a package
+DECIDED_BY_ATTRIBUTE = "decided_by"
+# sidecar file storing the last durable state of a results file
+CHECKPOINT_FILE = "{csv_file}.checkpoint"
+
+@dataclass
+class Checkpoint:
+    """
+    Durable state of a results file. All rows up to file_size are
+    synced to disk, they contain the results of the first input_offset
+    rows of the package list (rows is the number of written packages).
+    """
+    input_offset: int
+    rows: int
+    file_size: int
+
+def read_checkpoint(checkpoint_file: str) -> Checkpoint | None:
+    """Read a checkpoint, returns None if there is none."""
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, mode='r') as file:
+        return Checkpoint(**json.load(file))
+
+def write_checkpoint(checkpoint_file: str, checkpoint: Checkpoint) -> None:
+    """Atomically replace the checkpoint."""
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, mode='w') as file:
+        json.dump(asdict(checkpoint), file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_file, checkpoint_file)
+
+def _read_complete_rows(csv_file: str) -> Tuple[List[List[str]], int]:
+    """
+    Read the complete rows of a results file. Quoted values may contain
+    newlines, so rows are split by csv.reader and each row ends with the
+    last line it consumed. Returns the rows and the size they take up.
+    """
+    position = 0
+    last_line = b""
+
+    def lines(file: BinaryIO) -> Iterator[str]:
+        nonlocal position, last_line
+        for last_line in file:
+            position += len(last_line)
+            yield last_line.decode(errors="replace")
+
+    rows: List[List[str]] = []
+    complete_size = 0
+    with open(csv_file, mode='rb') as file:
+        result_reader = csv.reader(lines(file), delimiter=',', quotechar='"', strict=True)
+        try:
+            for row in result_reader:
+                # a row without its line ending was cut off
+                if not last_line.endswith(b"\n"):
+                    break
+                rows.append(row)
+                complete_size = position
+        except csv.Error:
+            # cut off within a quoted value
+            pass
+    return rows, complete_size
+
+def prepare_resume(csv_file: str, package_header: List[str]) -> Tuple[Checkpoint, Set[str]]:
+    """
+    Prepare a partial results file to be continued. Anything written after
+    the last checkpoint is cut off, those packages are queried again.
+    Returns the checkpoint and the package names already in the file.
+    """
+    checkpoint = read_checkpoint(CHECKPOINT_FILE.format(csv_file=csv_file))
+    if checkpoint is None:
+        # no checkpoint, keep all complete rows and skip their packages
+        log.warning(f"No checkpoint found for {csv_file}, resuming from written packages.")
+        checkpoint = Checkpoint(input_offset=0, rows=0, file_size=0)
+    elif os.path.getsize(csv_file) < checkpoint.file_size:
+        raise ValueError(f"Results file {csv_file} is shorter than its checkpoint.")
+    else:
+        with open(csv_file, mode='r+') as file:
+            file.truncate(checkpoint.file_size)
+
+    rows, complete_size = _read_complete_rows(csv_file)
+    # drop an incomplete last row of a killed run
+    if complete_size < os.path.getsize(csv_file):
+        with open(csv_file, mode='r+') as file:
+            file.truncate(complete_size)
+
+    header = rows[0] if rows else None
+    if header is not None and header != list(package_header):
+        raise ValueError(f"Header of {csv_file} does not match the attributes {package_header}.")
+    done_packages: Set[str] = {row[0] for row in rows[1:] if row}
+
+    checkpoint.rows = len(done_packages)
+    checkpoint.file_size = os.path.getsize(csv_file)
+    return checkpoint, done_packages
+
+class ResultRecord(str):
+    """
+    Result row formatted as CSV which keeps its values, the writer and
+    split_results use them instead of parsing the row again. Being a
+    string, records are cached, reported and compared like plain rows.
+    """
+    values: Tuple[str, ...]
+
+    def __new__(cls, values: Sequence[str]) -> "ResultRecord":
+        values = tuple(str(value).strip() for value in values)
+        results = StringIO()
+        csv.writer(results, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL,
+                   lineterminator='').writerow(values)
+        record = super().__new__(cls, results.getvalue())
+        record.values = values
+        return record
+
+    def __getnewargs__(self):
+        return (self.values,)
+
+def format_results(row: Sequence[str]) -> ResultRecord:
+    """Format a result row as accepted by CSVResultsWriter.write_results."""
+    return ResultRecord(row)
+
+def split_results(results: str, length: int) -> List[str]:
+    """
+    Split a result row formatted by a ResponseParser into its values,
+    padded or cut to the given number of attributes.
+    """
+    if isinstance(results, ResultRecord):
+        values = list(results.values)
+    else:
+        values = next(csv.reader([results], delimiter=',', quotechar='"',
+                                 skipinitialspace=True), [])
+        values = [value.strip() for value in values]
+    return (values + [""] * length)[:length]
 
 class CSVResultsWriter:
     _csv_writer: csv.writer
     _file_dst: TextIOWrapper
     _package_header: List[str]
+    _checkpoint_file: str | None
+    _checkpoint: Checkpoint
+    _recorder: "RunRecorder | None"
+    _failed_offset: int | None = None
     _flush_counter: int = 0
     __FLUSH_BATCH_SIZE: int = 10
 
     def __init__(self,
                  file_dst: TextIOWrapper,
-                 package_header: List[str] = DEFAULT_PACKAGE_HEADER) -> None:
+                 package_header: List[str] = DEFAULT_PACKAGE_HEADER,
+                 checkpoint_file: str | None = None,
+                 checkpoint: Checkpoint | None = None,
+                 recorder: "RunRecorder | None" = None) -> None:
 
         self._file_dst = file_dst
         self._package_header = package_header
+        self._checkpoint_file = checkpoint_file
+        self._checkpoint = checkpoint or Checkpoint(input_offset=0, rows=0, file_size=0)
+        # rows are also recorded in the result store
+        self._recorder = recorder
 
     def _init_csv_file(self):
         try:
-            # Write the header
-            self._csv_writer.writerow(self._package_header)
+            # Write the header, a resumed file already has one
+            if self._file_dst.tell() == 0:
+                self._csv_writer.writerow(self._package_header)
+                self._sync()
         except:
             self.close()
 
@@ -37,35 +186,71 @@ class CSVResultsWriter:
             quotechar='"',
             quoting=csv.QUOTE_NONNUMERIC)
         self._init_csv_file()
+        if self._recorder is not None:
+            self._recorder.begin(self._package_header)
 
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
+        if self._recorder is not None and exc_type is None:
+            self._recorder.finish()
 
-    def write_results(self, results: str) -> None:
-        # Use csv.reader to handle quoted content properly
+    def write_results(self, results: str | ResultRecord, input_offset: int | None = None) -> None:
+        """
+        Write the parsed results of one package. input_offset is the number
+        of input rows processed including this package, it is stored with
+        the next checkpoint.
+        """
+        # records keep their values, other rows are parsed with
+        # csv.reader to handle quoted content properly
         row = None
-        try:
-            result_reader = csv.reader(StringIO(results), delimiter=',', quotechar='"', skipinitialspace=True)
-            row = next(result_reader)
-            row = [col.strip() for col in row]
-        except:
-            log.error("skipping ...")
-            row = None
+        if isinstance(results, ResultRecord):
+            row = list(results.values)
+        else:
+            try:
+                result_reader = csv.reader(StringIO(results), delimiter=',', quotechar='"', skipinitialspace=True)
+                row = next(result_reader)
+                row = [col.strip() for col in row]
+            except:
+                log.error("skipping ...")
+                row = None
 
         if row is None:
             log.error(f"Cannot parse results: {results}")
         else:
             self._csv_writer.writerow(row)
             self._flush_counter += 1
+            self._checkpoint.rows += 1
+            if self._recorder is not None:
+                self._recorder.add(row, input_offset)
 
-        # Flush the file every __FLUSH_BATCH_SIZE rows
+        if input_offset is not None:
+            if row is None and self._failed_offset is None:
+                # resume before the first package which was not written,
+                # the packages written after it are skipped by their name
+                self._failed_offset = input_offset - 1
+            self._checkpoint.input_offset = input_offset if self._failed_offset is None \
+                else min(input_offset, self._failed_offset)
+
+        # Sync the file every __FLUSH_BATCH_SIZE rows
         if not (self._flush_counter % self.__FLUSH_BATCH_SIZE):
-            self._file_dst.flush()
-            os.fsync(self._file_dst.fileno())
+            self._sync()
+
+    def _sync(self) -> None:
+        # make the written rows durable, then record them in the checkpoint
+        self._file_dst.flush()
+        os.fsync(self._file_dst.fileno())
+        if self._checkpoint_file is not None:
+            self._checkpoint.file_size = self._file_dst.tell()
+            write_checkpoint(self._checkpoint_file, self._checkpoint)
+        if self._recorder is not None:
+            # group commit of the rows synced to the results file
+            self._recorder.commit()
 
     # Close the file
     def close(self):
         if self._file_dst:
+            if not self._file_dst.closed:
+                self._sync()
             self._file_dst.close()